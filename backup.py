@@ -0,0 +1,263 @@
+# Write an archive of polycules, by id range, by hash or all of them
+#
+# Rows are read in batches by id and the archive is written as it goes, so
+# memory use stays flat however large the database is. Each polycule gets a
+# directory named after its hash holding graph.json, meta.json and, with
+# --renders, its text, DOT and SVG exports. Hashes may be shortened as in
+# the app's URLs. meta.json leaves out the bcrypt hashes of the view and
+# edit passwords unless --password-hashes is given; without them a restored
+# polycule cannot be protected or edited as before.
+#
+#     python backup.py --database db/prod.db --output backup.tar.gz
+
+import argparse
+import json
+import sys
+import tarfile
+import time
+import zipfile
+
+import model
+import storage
+
+
+DATABASE = "db/prod.db"
+FORMATS = ["tar", "tar.gz", "zip"]
+# The meta.json fields only written with `password_hashes`
+PASSWORD_FIELDS = ["view_pass", "delete_pass"]
+RENDERS = [
+    ("polycule.txt", lambda polycule: polycule.as_text()),
+    ("polycule.dot", lambda polycule: polycule.as_dot()),
+    ("polycule.svg", lambda polycule: polycule.as_svg()),
+]
+
+
+class UnknownHash(Exception):
+    """ Raised for a hash that names no polycule, or several. """
+
+
+def resolve(db, hashes):
+    """ Return the full hashes for `hashes`, which may be prefixes.
+
+    Prefixes are matched as `Polycule.get` matches them, and each must name
+    exactly one polycule.
+    """
+    resolved = []
+    for graph_hash in hashes:
+        prefix = graph_hash.strip().lower()
+        found = []
+        if 7 <= len(prefix) <= 40:
+            found = db.execute(
+                "select hash from polycules where hash >= ? and hash < ? limit 2",
+                [prefix, prefix + "g"],
+            ).fetchall()
+        if len(found) != 1:
+            raise UnknownHash(graph_hash)
+        if found[0][0] not in resolved:
+            resolved.append(found[0][0])
+    return resolved
+
+
+def rows(db, start_id=0, end_id=None, hashes=None, batch_size=500):
+    """ Yield the selected rows, reading `batch_size` at a time.
+
+    Rows are selected by `hashes` if given, full hashes as from `resolve`,
+    else by id: after `start_id`, up to and including `end_id`.
+    """
+    columns = (
+        "id, graph, hash, view_pass, delete_pass, modified, editable, view_protected"
+    )
+    if hashes is not None:
+        for i in range(0, len(hashes), batch_size):
+            batch = hashes[i:i + batch_size]
+            for row in db.execute(
+                "select {} from polycules where hash in ({}) order by id".format(
+                    columns, ", ".join("?" * len(batch))
+                ),
+                batch,
+            ):
+                yield row
+        return
+    last_id = start_id
+    while True:
+        batch = db.execute(
+            "select {} from polycules where id > ? and id <= ? "
+            "order by id limit ?".format(columns),
+            [last_id, end_id if end_id is not None else sys.maxsize, batch_size],
+        ).fetchall()
+        if not batch:
+            return
+        last_id = batch[-1][0]
+        for row in batch:
+            yield row
+
+
+def entries(rows, renders=False, password_hashes=False):
+    """ Yield (name, bytes, mtime) for each file to archive for `rows`. """
+    for (
+        id,
+        stored,
+        graph_hash,
+        view_pass,
+        delete_pass,
+        modified,
+        editable,
+        view_protected,
+    ) in rows:
+        polycule = model.Polycule(graph=stored, graph_hash=graph_hash)
+        directory = graph_hash or "id-{}".format(id)
+        mtime = modified or 0
+        meta = {
+            "id": id,
+            "hash": graph_hash,
+            "view_pass": view_pass,
+            "delete_pass": delete_pass,
+            "modified": modified,
+            "editable": editable,
+            "view_protected": view_protected,
+        }
+        if not password_hashes:
+            for field in PASSWORD_FIELDS:
+                del meta[field]
+        yield directory + "/meta.json", json.dumps(meta).encode("utf-8"), mtime
+        yield directory + "/graph.json", polycule.graph.encode("utf-8"), mtime
+        if not renders:
+            continue
+        for name, render in RENDERS:
+            try:
+                output = render(polycule)
+            except Exception as e:
+                # Old rows were never validated and may not render
+                output = "Could not render: {!r}\n".format(e)
+                name += ".error"
+            yield directory + "/" + name, output.encode("utf-8"), mtime
+
+
+class Spool(object):
+    """ A write-only file whose contents are collected with `take`. """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream(entries, fmt="tar.gz"):
+    """ Yield the archive of `entries` in chunks, one or so per entry.
+
+    Tar archives are written in constant memory. Zip archives end with a
+    directory of every file, so they hold about a hundred bytes per file
+    until the end.
+    """
+    if fmt not in FORMATS:
+        raise ValueError("Unknown archive format: {}".format(fmt))
+    spool = Spool()
+    if fmt == "zip":
+        archive = zipfile.ZipFile(spool, "w", zipfile.ZIP_DEFLATED)
+    else:
+        archive = tarfile.open(fileobj=spool, mode="w|gz" if fmt == "tar.gz" else "w|")
+    with archive:
+        for name, data, mtime in entries:
+            if fmt == "zip":
+                # Zip dates start in 1980
+                info = zipfile.ZipInfo(name, time.gmtime(max(mtime, 315532800))[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                archive.writestr(info, data)
+            else:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = mtime
+                archive.addfile(info, _Reader(data))
+                # TarFile remembers every member it wrote, which we never need
+                archive.members = []
+            chunk = spool.take()
+            if chunk:
+                yield chunk
+    chunk = spool.take()
+    if chunk:
+        yield chunk
+
+
+class _Reader(object):
+    # tarfile only needs read(), and a BytesIO would copy the data
+    def __init__(self, data):
+        self._data = memoryview(data)
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self._data)
+        data, self._data = self._data[:size], self._data[size:]
+        return bytes(data)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write an archive of polycules.")
+    parser.add_argument("--database", default=DATABASE)
+    parser.add_argument("--output", default="-", help="archive file, - for stdout")
+    parser.add_argument("--format", choices=FORMATS, default=None)
+    parser.add_argument("--start-id", type=int, default=0)
+    parser.add_argument("--end-id", type=int, default=None)
+    parser.add_argument(
+        "--hash",
+        action="append",
+        dest="hashes",
+        help="a polycule to include, by its hash or a prefix of 7 or more",
+    )
+    parser.add_argument("--hashes-file", help="file with one hash per line")
+    parser.add_argument(
+        "--renders", action="store_true", help="include text, DOT and SVG exports"
+    )
+    parser.add_argument(
+        "--password-hashes",
+        action="store_true",
+        help="include the bcrypt hashes of view and edit passwords in meta.json",
+    )
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args(argv)
+
+    fmt = args.format
+    if fmt is None:
+        fmt = next(
+            (f for f in FORMATS[::-1] if args.output.endswith("." + f)), "tar.gz"
+        )
+    hashes = args.hashes
+    if args.hashes_file is not None:
+        with open(args.hashes_file) as f:
+            hashes = (hashes or []) + [line.strip() for line in f if line.strip()]
+
+    db = storage.connect(args.database, readonly=True)
+    if hashes is not None:
+        try:
+            hashes = resolve(db, hashes)
+        except UnknownHash as e:
+            db.close()
+            parser.error("no single polycule has the hash {}".format(e))
+    output = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    written = 0
+    try:
+        selected = rows(db, args.start_id, args.end_id, hashes, args.batch_size)
+        for chunk in stream(
+            entries(selected, args.renders, args.password_hashes), fmt
+        ):
+            output.write(chunk)
+            written += len(chunk)
+    finally:
+        db.close()
+        if output is not sys.stdout.buffer:
+            output.close()
+    sys.stderr.write("Done: {} bytes written\n".format(written))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+""" Build a database of synthetic polycules to benchmark against.
+
+    python -m benchmarks.database --rows 1000000 --output bench.db
+"""
+import argparse
+import hashlib
+import random
+import time
+from contextlib import closing
+
+import model
+import passwords
+import storage
+from benchmarks.graphs import make_graph
+from migrations import runner
+
+# Node counts to draw each row's graph from, most polycules being small
+SIZES = [2, 3, 5, 8, 13, 30, 100]
+PASSWORD = "secret"
+
+
+def graph_texts(sizes=SIZES, variants=20, seed=0):
+    """ Return a pool of graphs to build rows from, as JSON text. """
+    rnd = random.Random(seed)
+    return [
+        make_graph(rnd.choice(sizes), seed=rnd.randrange(1 << 30))
+        for _ in range(variants * len(sizes))
+    ]
+
+
+def unique(text, i):
+    # make_graph starts every graph with its lastId; swapping in the row
+    # number makes each row's graph, and so its hash, unique
+    return '{{"lastId": {:d},{}'.format(i, text.split(",", 1)[1])
+
+
+def make_database(path, rows, protected=0.1, batch_size=10000, seed=0, log=print):
+    """ Add `rows` polycules to the database at `path`, creating it if need be.
+
+    A `protected` fraction of them get view and edit passwords, all
+    PASSWORD, hashed once and shared so that building the database does not
+    take one bcrypt run per row. Returns the hashes of the rows added.
+    """
+    rnd = random.Random(seed)
+    pool = graph_texts(seed=seed)
+    hashed = passwords.hash_password(PASSWORD)
+    hashes = []
+    started = time.monotonic()
+    with closing(storage.connect(path)) as db:
+        runner.migrate(db, log=lambda message: None)
+        (start,) = db.execute("select coalesce(max(id), 0) from polycules").fetchone()
+        for first in range(start, start + rows, batch_size):
+            batch = []
+            for i in range(first, min(first + batch_size, start + rows)):
+                graph = unique(rnd.choice(pool), i)
+                graph_hash = hashlib.sha1(graph.encode("utf-8")).hexdigest()
+                locked = hashed if rnd.random() < protected else None
+                batch.append(
+                    [
+                        model.encode_graph(graph),
+                        locked,
+                        locked,
+                        graph_hash,
+                        int(time.time()),
+                        locked is not None,
+                        locked is not None,
+                    ]
+                )
+                hashes.append(graph_hash)
+            db.executemany(
+                "insert into polycules "
+                "(graph, view_pass, delete_pass, hash, modified, editable, "
+                "view_protected) values (?, ?, ?, ?, ?, ?, ?)",
+                batch,
+            )
+            db.commit()
+            elapsed = time.monotonic() - started
+            log(
+                "{} rows, {:.0f} rows/s".format(
+                    len(hashes), len(hashes) / elapsed if elapsed else 0
+                )
+            )
+    return hashes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", default="bench.db")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--protected", type=float, default=0.1)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    make_database(
+        args.output,
+        args.rows,
+        protected=args.protected,
+        batch_size=args.batch_size,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    main()
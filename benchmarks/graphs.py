@@ -0,0 +1,46 @@
+import json
+import random
+
+NAMES = ["Alice", "Bob", "Carol", "Dave", "Eve", "Frank", "Zoë", 'Quinn "Q"']
+
+
+def make_graph(nodes, links_per_node=1.5, labels=0.5, dashed=0.2, seed=0):
+    """ Build a random graph shaped like the ones polycule.js saves.
+
+    Returns the JSON text, with every link carrying full copies of its source
+    and target nodes as the client sends them.
+    """
+    rnd = random.Random(seed)
+    node_list = [
+        {
+            "id": i + 1,
+            "name": "{} {}".format(rnd.choice(NAMES), i),
+            "x": round(rnd.uniform(0, 960), 3),
+            "y": round(rnd.uniform(0, 500), 3),
+            "r": 12,
+            "index": i,
+            "weight": 0,
+            "px": round(rnd.uniform(0, 960), 3),
+            "py": round(rnd.uniform(0, 500), 3),
+        }
+        for i in range(nodes)
+    ]
+    links = []
+    if nodes > 1:
+        for _ in range(int(nodes * links_per_node)):
+            source, target = rnd.sample(node_list, 2)
+            link = {
+                "source": source,
+                "target": target,
+                "strength": rnd.randint(1, 10),
+            }
+            for text in ("sourceText", "centerText", "targetText"):
+                if rnd.random() < labels:
+                    link[text] = rnd.choice(["partner", "nesting", "meta", "crush"])
+            if rnd.random() < dashed:
+                link["dashed"] = True
+            links.append(link)
+    for link in links:
+        link["source"]["weight"] += 1
+        link["target"]["weight"] += 1
+    return json.dumps({"lastId": nodes, "nodes": node_list, "links": links})
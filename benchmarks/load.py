@@ -0,0 +1,399 @@
+""" Replay a mix of requests against the app at a target rate.
+
+    python -m benchmarks.load --workers 4 --rate 50 --duration 30
+    python -m benchmarks.load --mix view=60,embed=20,protected=10,save=5,png=5
+
+By default the app is started on a fresh database of --rows polycules from
+benchmarks.database, forked into --workers processes sharing one listening
+socket the way a pre-forking server runs it. To load a server started some
+other way, pass its --url and the --database it serves, which must have
+been built by benchmarks.database for protected views to know the password.
+
+Scenarios are started at --rate a second, spread over --users visitors,
+each keeping its own cookies and so its own session, CSRF token and view
+grants, as a browser would. Scenarios which have to wait for a free
+visitor are counted as late; if many are, add users. Latency is measured
+per request from when it is sent.
+"""
+import argparse
+import http.cookiejar
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import random
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from contextlib import closing
+
+import storage
+from benchmarks.database import PASSWORD, graph_texts, make_database, unique
+
+MIX = "view=50,embed=20,protected=10,save=5,png=5"
+# A scenario starting this many seconds after it was due counts as late
+LATE = 0.1
+CSRF_TOKEN = re.compile(rb'name="_csrf_token" value="([^"]*)"')
+# Error pages are served as 200s, as is the view password form on a refusal
+ERROR_PAGE = b"<h2>Whoops...</h2>"
+VIEW_PASSWORD_FORM = b'name="view_pass"'
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args):
+        return None
+
+
+class Stats(object):
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.late = 0
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, ok):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def record_late(self):
+        with self._lock:
+            self.late += 1
+
+    def report(self, elapsed):
+        """ Per endpoint, then for all of them: counts, rates and latencies. """
+        rows = []
+        everything = []
+        for endpoint in sorted(self.latencies):
+            latencies = self.latencies[endpoint]
+            everything.extend(latencies)
+            rows.append(summary(endpoint, latencies, self.errors[endpoint], elapsed))
+        rows.append(summary("all", everything, sum(self.errors.values()), elapsed))
+        return rows
+
+
+def percentile(ordered, fraction):
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summary(endpoint, latencies, errors, elapsed):
+    ordered = sorted(latencies) or [0.0]
+    return {
+        "endpoint": endpoint,
+        "requests": len(latencies),
+        "errors": errors,
+        "error_rate": errors / len(latencies) if latencies else 0.0,
+        "throughput": len(latencies) / elapsed,
+        "p50": percentile(ordered, 0.5),
+        "p99": percentile(ordered, 0.99),
+        "max": ordered[-1],
+    }
+
+
+class Client(object):
+    """ One visitor: a cookie jar, and with it a session on the app. """
+
+    def __init__(self, url, stats, timeout=30):
+        self.url = url
+        self.stats = stats
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            NoRedirect,
+        )
+
+    def request(self, endpoint, path, data=None, expect=200, refused=ERROR_PAGE):
+        """ Send a request, recording it under `endpoint`, and return the body.
+
+        It counts as an error unless it is answered with `expect` and,
+        for a 200, without `refused` in the page.
+        """
+        body = None if data is None else urllib.parse.urlencode(data).encode()
+        start = time.perf_counter()
+        try:
+            with self.opener.open(self.url + path, body, self.timeout) as response:
+                status, page = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, page = e.code, e.read()
+        except OSError:
+            status, page = None, b""
+        ok = status == expect and not (status == 200 and refused in page)
+        self.stats.record(endpoint, time.perf_counter() - start, ok)
+        return page
+
+    def post(self, endpoint, page, path, data, **kwargs):
+        """ Post a form from `page`, with the CSRF token it carries. """
+        token = CSRF_TOKEN.search(page)
+        if token is None:
+            self.stats.record(endpoint, 0.0, False)
+            return b""
+        data = dict(data, _csrf_token=token.group(1).decode("utf-8"))
+        return self.request(endpoint, path, data, **kwargs)
+
+
+class Targets(object):
+    """ The polycules to request, and what a save should submit. """
+
+    def __init__(self, plain, protected, graphs, png_source="svg"):
+        self.plain = plain
+        self.protected = protected
+        self.graphs = graphs
+        self.png_source = png_source
+        # Saves must not submit a graph already stored, even by an earlier run
+        self.saves = itertools.count(int(time.time() * 1000))
+
+    @classmethod
+    def from_database(cls, path, limit=1000, **kwargs):
+        with closing(storage.connect(path, readonly=True)) as db:
+            rows = db.execute(
+                "select hash, view_protected is not 0 and view_pass is not null "
+                "from polycules "
+                "where hash is not null order by random() limit ?",
+                [limit],
+            ).fetchall()
+        return cls(
+            [graph_hash for graph_hash, locked in rows if not locked],
+            [graph_hash for graph_hash, locked in rows if locked],
+            graph_texts(),
+            **kwargs
+        )
+
+
+def view(client, targets, rnd):
+    client.request("view", "/" + rnd.choice(targets.plain)[:7])
+
+
+def embed(client, targets, rnd):
+    client.request("embed", "/embed/" + rnd.choice(targets.plain)[:7])
+
+
+def png(client, targets, rnd):
+    client.request(
+        "png",
+        "/export/{}/polycule.png?from={}".format(
+            rnd.choice(targets.plain)[:7], targets.png_source
+        ),
+    )
+
+
+def protected(client, targets, rnd):
+    path = "/" + rnd.choice(targets.protected)[:7]
+    # Without a view grant yet, this is the password form
+    page = client.request("protected_form", path)
+    client.post(
+        "protected_view",
+        page,
+        path,
+        {"view_pass": PASSWORD},
+        refused=VIEW_PASSWORD_FORM,
+    )
+
+
+def save(client, targets, rnd):
+    page = client.request("create", "/create")
+    graph = unique(rnd.choice(targets.graphs), next(targets.saves))
+    client.post(
+        "save",
+        page,
+        "/save",
+        {"graph": graph, "view_pass": "", "edit_pass": ""},
+        expect=302,
+    )
+
+
+SCENARIOS = {
+    "view": view,
+    "embed": embed,
+    "png": png,
+    "protected": protected,
+    "save": save,
+}
+
+
+def parse_mix(text):
+    """ Parse "view=50,save=5" into [(scenario, weight)]. """
+    mix = []
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in SCENARIOS:
+            raise ValueError("Unknown scenario: {}".format(name))
+        mix.append((name.strip(), float(weight or 1)))
+    return mix
+
+
+def run(url, targets, mix, rate, duration, users=32, seed=0):
+    """ Start scenarios from `mix` at `rate` a second for `duration` seconds.
+
+    Returns the stats and the seconds taken, including the time to finish
+    the scenarios still running at the end.
+    """
+    stats = Stats()
+    due = queue.Queue()
+    mix = [(name, weight) for name, weight in mix if weight > 0]
+    if not targets.protected:
+        mix = [(name, weight) for name, weight in mix if name != "protected"]
+
+    def visit(number):
+        client = Client(url, stats)
+        rnd = random.Random("{}-{}".format(seed, number))
+        while True:
+            item = due.get()
+            if item is None:
+                return
+            when, scenario = item
+            if time.monotonic() - when > LATE:
+                stats.record_late()
+            SCENARIOS[scenario](client, targets, rnd)
+
+    visitors = [threading.Thread(target=visit, args=(i,)) for i in range(users)]
+    for visitor in visitors:
+        visitor.start()
+    rnd = random.Random(seed)
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    start = time.monotonic()
+    try:
+        for i in range(int(rate * duration)):
+            when = start + i / rate
+            time.sleep(max(0, when - time.monotonic()))
+            due.put((when, rnd.choices(names, weights)[0]))
+    finally:
+        for _ in visitors:
+            due.put(None)
+        for visitor in visitors:
+            visitor.join()
+    return stats, time.monotonic() - start
+
+
+def serve_forever(sock):
+    # Imported here, as the app reads its config when imported
+    import polycules
+    from werkzeug.serving import make_server
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    host, port = sock.getsockname()
+    make_server(
+        host, port, polycules.app, threaded=True, fd=sock.fileno()
+    ).serve_forever()
+
+
+def serve(database, workers, host="127.0.0.1"):
+    """ Fork `workers` processes serving the app from one socket.
+
+    Returns the app's URL and the processes, which are daemons.
+    """
+    import polycules
+
+    polycules.app.config["DATABASE"] = database
+    polycules.migrate()
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, 0))
+    sock.listen(128)
+    port = sock.getsockname()[1]
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=serve_forever, args=(sock,), daemon=True)
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    sock.close()
+    return "http://{}:{:d}".format(host, port), processes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mix", default=MIX, help="scenario=weight, ...")
+    parser.add_argument("--rate", type=float, default=20, help="scenarios a second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--users", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--url", help="load this server instead of starting one")
+    parser.add_argument("--database", help="the database --url serves")
+    parser.add_argument("--png-source", choices=["svg", "dot"], default="svg")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the report here as JSON")
+    args = parser.parse_args(argv)
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.url and not args.database:
+        parser.error("--url needs the --database it serves")
+
+    tmpdir = None
+    processes = []
+    try:
+        if args.url:
+            url, database = args.url.rstrip("/"), args.database
+        else:
+            tmpdir = tempfile.mkdtemp()
+            database = os.path.join(tmpdir, "load.db")
+            make_database(database, args.rows, log=lambda message: None)
+            url, processes = serve(database, args.workers)
+        targets = Targets.from_database(database, png_source=args.png_source)
+        print(
+            "Loading {} at {:g} scenarios/s for {:g}s".format(
+                url, args.rate, args.duration
+            )
+        )
+        stats, elapsed = run(
+            url, targets, mix, args.rate, args.duration, args.users, args.seed
+        )
+    finally:
+        for process in processes:
+            process.terminate()
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    rows = stats.report(elapsed)
+    print(
+        "{:<16} {:>9} {:>7} {:>8} {:>10} {:>10} {:>10}".format(
+            "endpoint", "requests", "errors", "req/s", "p50 ms", "p99 ms", "max ms"
+        )
+    )
+    for row in rows:
+        print(
+            "{endpoint:<16} {requests:>9} {errors:>7} {throughput:>8.1f} "
+            "{p50:>10.1f} {p99:>10.1f} {max:>10.1f}".format(
+                **dict(
+                    row,
+                    p50=row["p50"] * 1000,
+                    p99=row["p99"] * 1000,
+                    max=row["max"] * 1000,
+                )
+            )
+        )
+    if stats.late:
+        print("{} scenarios started late; try more --users".format(stats.late))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "options": vars(args),
+                    "elapsed": elapsed,
+                    "late": stats.late,
+                    "endpoints": rows,
+                },
+                f,
+                indent=2,
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,318 @@
+""" Time lookups, saves, exporters and routes, and compare runs.
+
+    python -m benchmarks.suite --output before.json
+    python -m benchmarks.suite --output after.json --compare before.json
+
+Each case is run enough times to fill about --min-time seconds per sample,
+and the best and median of --repeat samples are kept, in seconds per call.
+With --compare, cases whose best time grew by more than --threshold times
+are reported and the exit status is 1. Cases needing bcrypt take about a
+tenth of a second a call by design, so they get few calls.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import closing
+
+import layout
+import model
+import rendering
+import storage
+from benchmarks.database import PASSWORD, make_database, unique
+from benchmarks.graphs import make_graph
+
+SIZES = [10, 100, 1000, 10000]
+QUICK_SIZES = [10, 100]
+ROWS = 100000
+QUICK_ROWS = 1000
+# The graph size lookups, saves and routes are timed with
+ROUTE_SIZE = 30
+
+
+def measure(fn, min_time=0.2, repeat=5):
+    """ Time `fn`, returning the number of calls per sample and the samples. """
+    start = time.perf_counter()
+    fn()
+    first = time.perf_counter() - start
+    number = max(1, min(100000, int(min_time / max(first, 1e-7))))
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - start) / number)
+    return number, samples
+
+
+class Suite(object):
+    def __init__(self, min_time=0.2, repeat=5, log=print):
+        self.min_time = min_time
+        self.repeat = repeat
+        self.log = log
+        self.results = []
+
+    def time(self, name, fn, **params):
+        try:
+            number, samples = measure(fn, self.min_time, self.repeat)
+        except (rendering.RenderFailed, OSError) as e:
+            self.log("{:<24} {:<44} skipped: {}".format(name, describe(params), e))
+            return
+        result = {
+            "name": name,
+            "params": params,
+            "number": number,
+            "samples": samples,
+            "best": min(samples),
+            "median": statistics.median(samples),
+        }
+        self.results.append(result)
+        self.log(
+            "{:<24} {:<44} {:>12.3f} ms".format(
+                name, describe(params), result["best"] * 1000
+            )
+        )
+
+
+def describe(params):
+    return " ".join("{}={}".format(k, v) for k, v in sorted(params.items()))
+
+
+def key(result):
+    return (result["name"], describe(result["params"]))
+
+
+def unplaced(graph):
+    """ The same graph with its nodes' positions dropped, to be laid out. """
+    parsed = json.loads(graph)
+    for node in parsed["nodes"]:
+        for name in ("x", "y", "px", "py"):
+            node.pop(name, None)
+    return json.dumps(parsed)
+
+
+def bench_exporters(suite, sizes):
+    for size in sizes:
+        graph = make_graph(size)
+        stored = model.encode_graph(graph)
+        polycule = model.Polycule(graph=graph, graph_hash="0" * 40)
+        suite.time("Graph.from_json", lambda: model.Graph.from_json(graph), nodes=size)
+        suite.time("encode_graph", lambda: model.encode_graph(graph), nodes=size)
+        suite.time("decode_graph", lambda: model.decode_graph(stored), nodes=size)
+        if layout.available():
+            bare = model.Graph.from_json(unplaced(graph))
+            suite.time("Graph.laid_out", bare.laid_out, nodes=size)
+        suite.time("as_text", polycule.as_text, nodes=size)
+        suite.time("as_html", polycule.as_html, nodes=size)
+        for labels in (False, True):
+            suite.time(
+                "as_dot",
+                lambda: polycule.as_dot(edge_labels=labels),
+                nodes=size,
+                labels=labels,
+            )
+            suite.time(
+                "as_svg",
+                lambda: polycule.as_svg(edge_labels=labels, include_style=True),
+                nodes=size,
+                labels=labels,
+            )
+        suite.time("as_png_from_svg", polycule.as_png_from_svg, nodes=size)
+        suite.time("as_png_from_dot", polycule.as_png_from_dot, nodes=size)
+
+
+def bench_database(suite, path, rows):
+    suite.log("Building a database of {} rows".format(rows))
+    hashes = make_database(path, rows, log=lambda message: None)
+    graph = make_graph(ROUTE_SIZE, seed=1)
+    counter = itertools.count(len(hashes) + 1)
+    with closing(storage.connect(path)) as db:
+        protected = model.Polycule.create(
+            db, unique(graph, next(counter)), PASSWORD, PASSWORD
+        )
+        plain = hashes[len(hashes) // 2]
+        suite.time(
+            "Polycule.get",
+            lambda: model.Polycule.get(db, plain[:7], None),
+            rows=rows,
+            prefix=7,
+            bcrypt=False,
+        )
+        suite.time(
+            "Polycule.get",
+            lambda: model.Polycule.get(db, plain, None),
+            rows=rows,
+            prefix=40,
+            bcrypt=False,
+        )
+        suite.time(
+            "Polycule.get",
+            lambda: model.Polycule.get(db, protected.graph_hash[:7], PASSWORD),
+            rows=rows,
+            prefix=7,
+            bcrypt=True,
+        )
+        for password in (None, PASSWORD):
+            suite.time(
+                "Polycule.create",
+                lambda: model.Polycule.create(
+                    db, unique(graph, next(counter)), password, password
+                ),
+                rows=rows,
+                bcrypt=password is not None,
+            )
+            suite.time(
+                "Polycule.save",
+                lambda: protected.save(
+                    unique(graph, next(counter)), password, password
+                ),
+                rows=rows,
+                bcrypt=password is not None,
+            )
+
+
+def bench_routes(suite, path):
+    # Imported here as the app reads its config when imported
+    import polycules
+
+    polycules.app.config["DATABASE"] = path
+    polycules.app.config["TESTING"] = True
+    # Time renders rather than render cache hits
+    polycules.app.config["RENDER_CACHE_SIZE"] = 0
+    client = polycules.app.test_client()
+    graph = make_graph(ROUTE_SIZE, seed=2)
+    counter = itertools.count(1 << 30)
+    with closing(polycules.connect_db()) as db:
+        plain = model.Polycule.create(db, unique(graph, next(counter)), None, None)
+        protected = model.Polycule.create(
+            db, unique(graph, next(counter)), PASSWORD, PASSWORD
+        )
+
+    def get(url):
+        def fetch():
+            response = client.get(url)
+            if response.status_code != 200:
+                raise OSError("{} answered {}".format(url, response.status_code))
+
+        return fetch
+
+    def post(url, status, data):
+        def send():
+            # Each post needs a fresh token, and a session without a view
+            # grant so that protected views check the password again
+            with client.session_transaction() as sess:
+                sess.clear()
+                sess["_csrf_token"] = "token"
+            response = client.post(url, data=dict(data(), _csrf_token="token"))
+            if response.status_code != status:
+                raise OSError("{} answered {}".format(url, response.status_code))
+
+        return send
+
+    prefix = plain.graph_hash[:7]
+    for route, url in [
+        ("view", "/{}"),
+        ("view_text_only", "/{}.html"),
+        ("embed", "/embed/{}"),
+        ("export_text", "/export/{}/polycule.txt"),
+        ("export_dot", "/export/{}/polycule.dot"),
+        ("export_svg", "/export/{}/polycule.svg"),
+        ("export_png", "/export/{}/polycule.png?from=svg"),
+        ("export_png", "/export/{}/polycule.png?from=dot"),
+    ]:
+        url = url.format(prefix)
+        suite.time("GET " + route, get(url), url=url.replace(prefix, "<id>"))
+    suite.time(
+        "POST view",
+        post(
+            "/{}".format(protected.graph_hash[:7]),
+            200,
+            lambda: {"view_pass": PASSWORD},
+        ),
+        bcrypt=True,
+    )
+    suite.time(
+        "POST save",
+        post("/save", 302, lambda: {"graph": unique(graph, next(counter))}),
+        # The form's empty passwords are hashed too
+        bcrypt=True,
+    )
+
+
+def compare(old, new, threshold=1.25):
+    """ Return (name, params, old best, new best) for cases that slowed down. """
+    before = {key(result): result for result in old["results"]}
+    regressions = []
+    for result in new["results"]:
+        previous = before.get(key(result))
+        if previous is not None and result["best"] > previous["best"] * threshold:
+            regressions.append(key(result) + (previous["best"], result["best"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", help="write the results here as JSON")
+    parser.add_argument("--compare", help="results of an earlier run")
+    parser.add_argument("--threshold", type=float, default=1.25)
+    parser.add_argument("--rows", type=int, help="rows in the database")
+    parser.add_argument("--min-time", type=float, default=0.2)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--quick", action="store_true", help="smaller sizes")
+    parser.add_argument(
+        "--only", choices=["exporters", "database", "routes"], action="append"
+    )
+    args = parser.parse_args(argv)
+
+    rows = args.rows or (QUICK_ROWS if args.quick else ROWS)
+    suite = Suite(args.min_time, args.repeat)
+    sections = args.only or ["exporters", "database", "routes"]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        if "exporters" in sections:
+            bench_exporters(suite, QUICK_SIZES if args.quick else SIZES)
+        if "database" in sections:
+            bench_database(suite, os.path.join(tmpdir, "bench.db"), rows)
+        if "routes" in sections:
+            path = os.path.join(tmpdir, "routes.db")
+            make_database(path, min(rows, QUICK_ROWS), log=lambda message: None)
+            bench_routes(suite, path)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    run = {
+        "meta": {
+            "time": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": layout.available(),
+            "min_time": args.min_time,
+            "repeat": args.repeat,
+        },
+        "results": suite.results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(run, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), run, args.threshold)
+        for name, params, before, after in regressions:
+            print(
+                "Slower: {} {} {:.3f} ms -> {:.3f} ms".format(
+                    name, params, before * 1000, after * 1000
+                )
+            )
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
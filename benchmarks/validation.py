@@ -0,0 +1,44 @@
+""" Time graph validation across graph sizes, against the old jsonschema call.
+
+    python -m benchmarks.validation
+"""
+import json
+import timeit
+
+import jsonschema
+
+import validation
+from benchmarks.graphs import make_graph
+
+SIZES = [10, 100, 1000, 10000]
+
+
+def old_parse(graph):
+    # What /save did before validation.py: parse, then validate from scratch
+    jsonschema.validate(json.loads(graph), validation.SCHEMA)
+
+
+def main():
+    print(
+        "{:>8} {:>10} {:>12} {:>12} {:>8}".format(
+            "nodes", "bytes", "ms/validate", "ms/old", "speedup"
+        )
+    )
+    for size in SIZES:
+        graph = make_graph(size)
+        number = max(1, 2000 // size)
+        seconds = timeit.timeit(lambda: validation.parse(graph), number=number)
+        old = timeit.timeit(lambda: old_parse(graph), number=number)
+        print(
+            "{:>8} {:>10} {:>12.3f} {:>12.3f} {:>7.1f}x".format(
+                size,
+                len(graph),
+                seconds / number * 1000,
+                old / number * 1000,
+                old / seconds,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
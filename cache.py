@@ -0,0 +1,281 @@
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class RenderCache(object):
+    """ Rendered exports, kept in a size-bounded LRU with an optional disk tier.
+
+    Entries are keyed on the hash of the graph's current content as well as
+    its address, so a worker never serves a render of a version that was
+    since saved through another worker; `invalidate` frees the space early.
+    The disk tier is shared between workers and kept under `max_disk_bytes`
+    by `prune_disk`, which deletes the files least recently used first.
+    """
+
+    def __init__(
+        self, max_bytes=64 * 1024 * 1024, directory=None, max_disk_bytes=1024 ** 3
+    ):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        # Starts due, so a new worker prunes what earlier ones left behind
+        self._disk_written = max_disk_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get_or_render(self, polycule, fmt, render, **options):
+        """ Return the cached bytes for a render, calling `render` on a miss. """
+        value = self.get(polycule, fmt, **options)
+        if value is None:
+            with self._lock:
+                self.misses += 1
+            value = render()
+            if not isinstance(value, bytes):
+                value = value.encode("utf-8")
+            self.put(polycule, fmt, value, **options)
+        return value
+
+    def get(self, polycule, fmt, **options):
+        """ Return the cached bytes for a render, or None. """
+        key = self._key(polycule, fmt, options)
+        value = self._get_memory(key)
+        if value is None:
+            value = self._get_disk(key)
+            if value is not None:
+                self._put_memory(key, value)
+        return value
+
+    def put(self, polycule, fmt, value, **options):
+        key = self._key(polycule, fmt, options)
+        self._put_disk(key, value)
+        self._put_memory(key, value)
+
+    def stream(self, polycule, fmt, render, **options):
+        """ Return the cached render as an iterable of byte chunks.
+
+        On a miss, `render` should return an iterable of chunks, which are
+        passed on as they are produced and cached once the render finishes.
+        """
+        value = self.get(polycule, fmt, **options)
+        if value is not None:
+            return [value]
+        with self._lock:
+            self.misses += 1
+        return self._tee(self._key(polycule, fmt, options), render())
+
+    def tee(self, polycule, fmt, chunks, **options):
+        """ Pass on an iterable of byte chunks, caching them once all are seen. """
+        return self._tee(self._key(polycule, fmt, options), chunks)
+
+    def _tee(self, key, chunks):
+        # Keep the render in memory only while it could fit in the cache, and
+        # spool it to disk as it goes if there is a disk tier.
+        parts = []
+        length = 0
+        spool = None
+        try:
+            if self.directory is not None:
+                spool = self._open_spool(key)
+            for chunk in chunks:
+                if not isinstance(chunk, bytes):
+                    chunk = chunk.encode("utf-8")
+                length += len(chunk)
+                if parts is not None:
+                    parts.append(chunk)
+                    if length > self.max_bytes:
+                        parts = None
+                if spool is not None:
+                    spool[0].write(chunk)
+                yield chunk
+            if spool is not None:
+                (f, tmp), spool = spool, None
+                f.close()
+                try:
+                    os.replace(tmp, self._path(key))
+                except OSError:
+                    pass
+                else:
+                    self._wrote_disk(length)
+            if parts is not None:
+                self._put_memory(key, b"".join(parts))
+        finally:
+            # The client went away or the render failed part way through
+            if spool is not None:
+                spool[0].close()
+                try:
+                    os.unlink(spool[1])
+                except OSError:
+                    pass
+
+    def _open_spool(self, key):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        except OSError:
+            return None
+        return os.fdopen(fd, "wb"), tmp
+
+    def invalidate(self, graph_hash):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == graph_hash]:
+                self._size -= len(self._entries.pop(key))
+        if self.directory is not None:
+            shutil.rmtree(os.path.join(self.directory, graph_hash), ignore_errors=True)
+
+    def prune_disk(self):
+        """ Delete the least recently used files until the disk tier fits. """
+        files = []
+        total = 0
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass  # Not empty yet
+
+    def _wrote_disk(self, length):
+        # Pruning walks the whole directory, so it waits until a tenth of
+        # the limit has been written since it last ran
+        with self._lock:
+            self._disk_written += length
+            if self._disk_written < self.max_disk_bytes // 10:
+                return
+            self._disk_written = 0
+        self.prune_disk()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+            }
+
+    def _key(self, polycule, fmt, options):
+        return (
+            polycule.graph_hash,
+            polycule.content_hash,
+            fmt,
+            tuple(sorted(options.items())),
+        )
+
+    def _get_memory(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return value
+
+    def _put_memory(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                self._size -= len(self._entries.popitem(last=False)[1])
+
+    def _path(self, key):
+        graph_hash, content_hash, fmt, options = key
+        name = "-".join(
+            [content_hash, fmt]
+            + ["{}={}".format(option, value) for option, value in options]
+        )
+        return os.path.join(self.directory, graph_hash, name)
+
+    def _get_disk(self, key):
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+        except IOError:
+            return None
+        try:
+            # Mark it used, for prune_disk
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.disk_hits += 1
+        return value
+
+    def _put_disk(self, key, value):
+        if self.directory is None:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename, so readers never see a partial file
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(value)
+            os.replace(tmp, path)
+        except OSError:
+            return
+        self._wrote_disk(len(value))
+
+
+renders = RenderCache()
+
+
+def configure(max_bytes, directory=None, max_disk_bytes=1024 ** 3):
+    """ Replace the shared cache, e.g. with sizes from the app config. """
+    global renders
+    renders = RenderCache(
+        max_bytes=max_bytes, directory=directory, max_disk_bytes=max_disk_bytes
+    )
+
+
+def get_or_render(polycule, fmt, render, **options):
+    return renders.get_or_render(polycule, fmt, render, **options)
+
+
+def get(polycule, fmt, **options):
+    return renders.get(polycule, fmt, **options)
+
+
+def put(polycule, fmt, value, **options):
+    renders.put(polycule, fmt, value, **options)
+
+
+def stream(polycule, fmt, render, **options):
+    return renders.stream(polycule, fmt, render, **options)
+
+
+def tee(polycule, fmt, chunks, **options):
+    return renders.tee(polycule, fmt, chunks, **options)
+
+
+def invalidate(graph_hash):
+    renders.invalidate(graph_hash)
@@ -0,0 +1,48 @@
+import gzip
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Most preferred first, when the client likes several equally
+ENCODINGS = ["br", "gzip"] if brotli is not None else ["gzip"]
+
+COMPRESSIBLE = {"text/html", "text/plain", "image/svg+xml"}
+
+
+def negotiate(accept_encodings):
+    """ Pick the encoding to use from a request's parsed Accept-Encoding.
+
+    Returns None if the client accepts none of ours.
+    """
+    return accept_encodings.best_match(ENCODINGS)
+
+
+def compress(data, encoding, level):
+    if encoding == "gzip":
+        # A fixed mtime, so the same input always compresses to the same bytes
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    if encoding == "br" and brotli is not None:
+        return brotli.compress(data, quality=level)
+    raise ValueError("Unsupported encoding: {}".format(encoding))
+
+
+def compress_stream(chunks, encoding, level):
+    """ Compress an iterable of byte chunks as they come, yielding the output. """
+    if encoding == "gzip":
+        # A gzip wrapper with a zero mtime, so the output is stable as above
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        process, finish = compressor.compress, compressor.flush
+    elif encoding == "br" and brotli is not None:
+        compressor = brotli.Compressor(quality=level)
+        process, finish = compressor.process, compressor.finish
+    else:
+        raise ValueError("Unsupported encoding: {}".format(encoding))
+    for chunk in chunks:
+        data = process(chunk)
+        if data:
+            yield data
+    yield finish()
@@ -0,0 +1,329 @@
+# Render exports in the background, queued in the export_jobs table
+#
+# The app queues a job instead of rendering when an export is asked for with
+# ?async=1, and serves the result once a worker has stored it. Jobs are keyed
+# on the graph and the export options, so asking again, or at the same time
+# as someone else, gets the same job. Run the workers next to the app:
+#
+#     python jobs.py --database db/prod.db --workers 2
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+from contextlib import closing
+
+import model
+import rendering
+import storage
+
+
+DATABASE = "db/prod.db"
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+# A job running for longer than this is taken to have lost its worker
+STALE_AFTER = 5 * 60
+# Give up on a job once it has been tried this many times
+MAX_ATTEMPTS = 3
+# Finished jobs, and their results, are kept for this long
+LIFETIME = 24 * 60 * 60
+POLL_INTERVAL = 0.5
+# Limits on each render, as the app's RENDER_TIMEOUT and RENDER_MEMORY_LIMIT
+RENDER_TIMEOUT = 20
+RENDER_MEMORY_LIMIT = 512 * 1024 * 1024
+
+
+def render_svg(polycule, options):
+    return polycule.as_svg(
+        edge_labels=options["edge_labels"],
+        include_style=options["style"],
+        embed=options["embed"],
+    )
+
+
+def render_png(polycule, options):
+    if options["source"] == "dot":
+        return polycule.as_png_from_dot(edge_labels=options["edge_labels"])
+    if options["source"] == "svg":
+        return polycule.as_png_from_svg(
+            edge_labels=options["edge_labels"],
+            include_style=options["style"],
+            embed=options["embed"],
+        )
+    raise ValueError("Unknown PNG source: {}".format(options["source"]))
+
+
+RENDERS = {"svg": (render_svg, "image/svg+xml"), "png": (render_png, "image/png")}
+# What a PNG can be drawn from, as the export's `from` argument
+PNG_SOURCES = ["dot", "svg"]
+
+
+class Job(object):
+    def __init__(
+        self,
+        id,
+        graph_hash,
+        content_hash,
+        format,
+        options,
+        status,
+        attempts=0,
+        mimetype=None,
+        error=None,
+        created=None,
+        started=None,
+        finished=None,
+    ):
+        self.id = id
+        self.graph_hash = graph_hash
+        self.content_hash = content_hash
+        self.format = format
+        self.options = options
+        self.status = status
+        self.attempts = attempts
+        self.mimetype = mimetype
+        self.error = error
+        self.created = created
+        self.started = started
+        self.finished = finished
+
+    COLUMNS = (
+        "id, graph_hash, content_hash, format, options, status, attempts, "
+        "mimetype, error, created, started, finished"
+    )
+
+    @classmethod
+    def from_row(cls, row):
+        job = cls(*row)
+        job.options = json.loads(job.options)
+        return job
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "format": self.format,
+            "error": self.error,
+        }
+
+
+def job_key(polycule, fmt, options):
+    return hashlib.sha1(
+        "\0".join(
+            [polycule.content_hash, fmt, json.dumps(options, sort_keys=True)]
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+def enqueue(db, polycule, fmt, options):
+    """ Queue an export of `polycule` and return its job's id.
+
+    If the same export is already queued, running or done, that job's id is
+    returned instead; a failed one is queued again.
+    """
+    if fmt not in RENDERS:
+        raise ValueError("Unknown export format: {}".format(fmt))
+    if fmt == "png" and options.get("source") not in PNG_SOURCES:
+        raise ValueError("Unknown PNG source: {}".format(options.get("source")))
+    key = job_key(polycule, fmt, options)
+
+    def queue(conn):
+        row = conn.execute(
+            "select id, status from export_jobs where key = ?", [key]
+        ).fetchone()
+        if row is not None:
+            if row[1] == FAILED:
+                conn.execute(
+                    "update export_jobs set status = ?, attempts = 0, error = null, "
+                    "created = ?, started = null, finished = null where id = ?",
+                    [QUEUED, int(time.time()), row[0]],
+                )
+            return row[0]
+        job_id = os.urandom(16).hex()
+        conn.execute(
+            "insert into export_jobs (id, key, graph_hash, content_hash, format, "
+            "options, status, created) values (?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                job_id,
+                key,
+                polycule.graph_hash,
+                polycule.content_hash,
+                fmt,
+                json.dumps(options, sort_keys=True),
+                QUEUED,
+                int(time.time()),
+            ],
+        )
+        return job_id
+
+    return storage.write(db, queue)
+
+
+def get(db, job_id):
+    row = db.execute(
+        "select {} from export_jobs where id = ?".format(Job.COLUMNS), [job_id]
+    ).fetchone()
+    return None if row is None else Job.from_row(row)
+
+
+def result(db, job_id):
+    """ Return (data, mimetype) for a finished job, or None. """
+    row = db.execute(
+        "select result, mimetype from export_jobs where id = ? and status = ?",
+        [job_id, DONE],
+    ).fetchone()
+    return None if row is None else (bytes(row[0]), row[1])
+
+
+def claim(db, now=None):
+    """ Mark the oldest waiting job as running and return it, or None.
+
+    Jobs left running for STALE_AFTER seconds, whose worker presumably
+    died, are taken over.
+    """
+    now = int(time.time()) if now is None else now
+
+    def take(conn):
+        row = conn.execute(
+            "select {} from export_jobs where status = ? "
+            "or (status = ? and started < ?) order by created limit 1".format(
+                Job.COLUMNS
+            ),
+            [QUEUED, RUNNING, now - STALE_AFTER],
+        ).fetchone()
+        if row is None:
+            return None
+        job = Job.from_row(row)
+        if job.attempts >= MAX_ATTEMPTS:
+            conn.execute(
+                "update export_jobs set status = ?, error = ?, finished = ? "
+                "where id = ?",
+                [FAILED, "Gave up after {} attempts".format(job.attempts), now, job.id],
+            )
+            return take(conn)
+        job.status, job.started = RUNNING, now
+        job.attempts += 1
+        conn.execute(
+            "update export_jobs set status = ?, started = ?, attempts = ? "
+            "where id = ?",
+            [RUNNING, now, job.attempts, job.id],
+        )
+        return job
+
+    return storage.write(db, take)
+
+
+def finish(db, job, data, mimetype):
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    storage.write(
+        db,
+        lambda conn: conn.execute(
+            "update export_jobs set status = ?, result = ?, mimetype = ?, "
+            "finished = ? where id = ?",
+            [DONE, data, mimetype, int(time.time()), job.id],
+        ),
+    )
+
+
+def fail(db, job, error):
+    storage.write(
+        db,
+        lambda conn: conn.execute(
+            "update export_jobs set status = ?, error = ?, finished = ? "
+            "where id = ?",
+            [FAILED, error, int(time.time()), job.id],
+        ),
+    )
+
+
+def purge(db, lifetime=LIFETIME):
+    """ Delete jobs that finished over `lifetime` seconds ago. """
+    cutoff = int(time.time()) - lifetime
+    return storage.write(
+        db,
+        lambda conn: conn.execute(
+            "delete from export_jobs where finished < ? and status in (?, ?)",
+            [cutoff, DONE, FAILED],
+        ).rowcount,
+    )
+
+
+def run(db, job):
+    """ Render `job` and store the result or the reason it failed. """
+    polycule = model.Polycule.get(db, job.graph_hash, None, force=True)
+    if polycule is None or polycule.content_hash != job.content_hash:
+        fail(db, job, "The polycule has changed since the export was asked for")
+        return
+    render, mimetype = RENDERS[job.format]
+    try:
+        data = render(polycule, job.options)
+    except Exception as e:
+        fail(db, job, str(e) or e.__class__.__name__)
+        return
+    finish(db, job, data, mimetype)
+
+
+def work(database, once=False, poll_interval=POLL_INTERVAL, lifetime=LIFETIME):
+    """ Run jobs from `database` as they are queued.
+
+    With `once`, return when no job is waiting instead of polling.
+    """
+    with closing(storage.connect(database)) as db:
+        last_purge = 0
+        while True:
+            if time.time() - last_purge > 60:
+                purge(db, lifetime)
+                last_purge = time.time()
+            job = claim(db)
+            if job is not None:
+                run(db, job)
+            elif once:
+                return
+            else:
+                time.sleep(poll_interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render queued exports.")
+    parser.add_argument("--database", default=DATABASE)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL)
+    parser.add_argument(
+        "--lifetime", type=int, default=LIFETIME, help="seconds to keep results"
+    )
+    parser.add_argument("--render-timeout", type=float, default=RENDER_TIMEOUT)
+    parser.add_argument(
+        "--render-memory-limit",
+        type=int,
+        default=RENDER_MEMORY_LIMIT,
+        help="bytes of address space for each renderer",
+    )
+    args = parser.parse_args(argv)
+
+    # Each worker renders one job at a time; forked workers inherit the pool
+    rendering.configure(1, 0, args.render_timeout, args.render_memory_limit)
+
+    options = {"poll_interval": args.poll_interval, "lifetime": args.lifetime}
+    if args.workers == 1:
+        work(args.database, **options)
+        return 0
+    workers = [
+        multiprocessing.Process(target=work, args=(args.database,), kwargs=options)
+        for _ in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
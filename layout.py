@@ -0,0 +1,173 @@
+""" Force-directed layout for graphs saved without positions.
+
+Links pull their ends towards a rest length taken from their strength, the
+same length `as_dot` hands to neato, and every pair of nodes pushes apart.
+Runs need NumPy, which is optional; check `available()` first.
+"""
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+WIDTH = 1000
+HEIGHT = 540
+MARGIN = 20
+# Pixels per unit of `link_length`, which neato reads as inches
+LENGTH_SCALE = 20
+ITERATIONS = 100
+# Above this many nodes, repulsion is worked out per cell of nodes, not per pair
+EXACT_LIMIT = 300
+# Bound on the floats held while working out repulsion
+CHUNK_SIZE = 1 << 20
+# The strength build.js gives new links
+DEFAULT_STRENGTH = 10
+
+
+def available():
+    return numpy is not None
+
+
+def link_length(strength, link_count):
+    """ The rest length of a link, as `as_dot` writes it for neato.
+
+    schema.json lets strength be any string, so one that is not a positive
+    number counts as DEFAULT_STRENGTH.
+    """
+    try:
+        strength = float(strength)
+    except (TypeError, ValueError):
+        strength = DEFAULT_STRENGTH
+    if not 0 < strength < math.inf:
+        strength = DEFAULT_STRENGTH
+    return 1 / strength * 10 + (1 / float(link_count))
+
+
+def _push(positions, centres, weights, k2):
+    # The push on each node from masses `weights` at `centres`, that is the
+    # sum over centres of k2 * weight * delta / |delta|^2, in slices of rows
+    # so no more than CHUNK_SIZE floats are held at once.
+    forces = numpy.empty_like(positions)
+    norms = (centres ** 2).sum(axis=1)
+    step = max(1, CHUNK_SIZE // max(len(centres), 1))
+    for start in range(0, len(positions), step):
+        rows = positions[start:start + step]
+        distance2 = (rows ** 2).sum(axis=1)[:, None] + norms - 2 * rows @ centres.T
+        # Coincident points, a node and itself included, do not push
+        numpy.maximum(distance2, 1e-9, out=distance2)
+        w = weights / distance2
+        w[distance2 <= 1e-9] = 0
+        forces[start:start + step] = k2 * (
+            rows * w.sum(axis=1)[:, None] - w @ centres
+        )
+    return forces
+
+
+def _repulsion_exact(positions, k2):
+    return _push(positions, positions, numpy.ones(len(positions)), k2)
+
+
+def _repulsion_cells(positions, k2):
+    # The nodes are split into strips by x and each strip into cells by y,
+    # every cell holding the same number of nodes, about the square root of
+    # their count. A node is pushed exactly by the nodes in its own cell and
+    # by every other cell as a whole, from the cell's centre of mass.
+    count = len(positions)
+    strips = max(1, int(round(count ** 0.25)))
+    cells = strips * strips
+    rank = numpy.empty(count, dtype=int)
+    rank[numpy.argsort(positions[:, 0], kind="stable")] = numpy.arange(count)
+    order = numpy.lexsort((positions[:, 1], rank * strips // count))
+    positions = positions[order]
+    cell = numpy.arange(count) * cells // count
+    mass = numpy.bincount(cell, minlength=cells).astype(float)
+    centres = numpy.stack(
+        [
+            numpy.bincount(cell, positions[:, 0], cells),
+            numpy.bincount(cell, positions[:, 1], cells),
+        ],
+        axis=1,
+    ) / mass[:, None]
+
+    # Every cell, then taking back the node's own cell
+    forces = _push(positions, centres, mass, k2)
+    delta = positions - centres[cell]
+    forces -= delta * (
+        k2 * mass[cell] / numpy.maximum((delta ** 2).sum(axis=1), 1e-9)
+    )[:, None]
+
+    # The node's own cell, node by node. Cells that are a node short are
+    # padded out with a point too far off to push.
+    slot = numpy.arange(count) - numpy.searchsorted(cell, cell)
+    padded = numpy.full((cells, int(mass.max()), 2), 1e12)
+    padded[cell, slot] = positions
+    norms = (padded ** 2).sum(axis=2)
+    distance2 = (
+        norms[:, :, None] + norms[:, None, :] - 2 * padded @ padded.transpose(0, 2, 1)
+    )
+    numpy.maximum(distance2, 1e-9, out=distance2)
+    w = k2 / distance2
+    w[distance2 <= 1e-9] = 0
+    near = padded * w.sum(axis=2)[:, :, None] - w @ padded
+    forces += near[cell, slot]
+
+    result = numpy.empty_like(forces)
+    result[order] = forces
+    return result
+
+
+def layout(count, links, seed=0, iterations=ITERATIONS, width=WIDTH, height=HEIGHT):
+    """ Lay out `count` nodes, returning an array of their (x, y) positions.
+
+    `links` holds (source index, target index, length) for each link, with
+    lengths as from `link_length`. The same arguments always give the same
+    layout, which is scaled down if need be to fit `width` by `height`.
+    """
+    if count == 0:
+        return numpy.zeros((0, 2))
+    rng = numpy.random.default_rng(seed)
+    links = [link for link in links if link[0] != link[1]]
+    sources = numpy.array([link[0] for link in links], dtype=int)
+    targets = numpy.array([link[1] for link in links], dtype=int)
+    rest = numpy.array([link[2] for link in links], dtype=float) * LENGTH_SCALE
+    spacing = float(numpy.median(rest)) if len(rest) else 5.0 * LENGTH_SCALE
+    k2 = spacing ** 2 / 4
+    repulsion = _repulsion_exact if count <= EXACT_LIMIT else _repulsion_cells
+
+    # Short links are stiffer, as in neato's stress model, and each node
+    # moves by its force over its stiffness so stiff nodes don't overshoot
+    stiffness = (spacing / rest) ** 2
+    damping = 1 + numpy.bincount(sources, stiffness, count)
+    damping += numpy.bincount(targets, stiffness, count)
+
+    radius = spacing * math.sqrt(count)
+    positions = rng.uniform(-radius, radius, (count, 2)) / 2
+    temperature = radius / 4
+    cooling = (0.01 * spacing / temperature) ** (1.0 / max(iterations, 1))
+    for _ in range(iterations):
+        forces = repulsion(positions, k2)
+        if len(rest):
+            delta = positions[targets] - positions[sources]
+            distance = numpy.maximum(numpy.sqrt((delta ** 2).sum(axis=1)), 1e-9)
+            pull = delta * ((distance - rest) / distance * stiffness)[:, None]
+            for axis in (0, 1):
+                forces[:, axis] += numpy.bincount(sources, pull[:, axis], count)
+                forces[:, axis] -= numpy.bincount(targets, pull[:, axis], count)
+        # A little gravity keeps separate pieces of the graph together
+        forces -= positions * 0.01
+        forces /= damping[:, None]
+        length = numpy.maximum(numpy.sqrt((forces ** 2).sum(axis=1)), 1e-9)
+        moves = forces * (numpy.minimum(length, temperature) / length)[:, None]
+        positions += moves
+        temperature *= cooling
+        if numpy.abs(moves).max() < 0.01:
+            break
+
+    low, high = positions.min(axis=0), positions.max(axis=0)
+    size = numpy.maximum(high - low, 1e-9)
+    scale = min(1.0, (width - 2 * MARGIN) / size[0], (height - 2 * MARGIN) / size[1])
+    centre = numpy.array([width, height]) / 2.0
+    return (positions - (low + high) / 2) * scale + centre
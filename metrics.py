@@ -0,0 +1,237 @@
+import bisect
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REQUEST_SECONDS = "polycules_request_seconds"
+STAGE_SECONDS = "polycules_stage_seconds"
+POOL_WAIT_SECONDS = "polycules_db_pool_wait_seconds"
+
+HELP = {
+    REQUEST_SECONDS: "Time taken to build each response, by route and status.",
+    STAGE_SECONDS: "Time spent in each stage of handling a request.",
+    POOL_WAIT_SECONDS: "Time spent waiting for a database connection.",
+}
+
+
+class Histogram(object):
+    """ Counts of observations falling in each of `buckets`, and their sum. """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        """ The histogram as (name, labels, value), with cumulative buckets. """
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            le = "+Inf" if bound == float("inf") else "{:g}".format(bound)
+            yield name + "_bucket", dict(labels, le=le), total
+        yield name + "_sum", labels, self.sum
+        yield name + "_count", labels, total
+
+
+class Timer(object):
+    __slots__ = ("registry", "name", "labels", "start")
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.registry.observe(
+            self.name, time.perf_counter() - self.start, **self.labels
+        )
+
+
+class NullTimer(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Registry(object):
+    """ Labelled latency histograms for this process.
+
+    Each worker process keeps its own, so a scrape only sees the worker that
+    answered it. Switched off, timers and observations do nothing.
+    """
+
+    def __init__(self, enabled=True, buckets=BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        """ A context manager observing the time spent inside it. """
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name, labels)
+
+    def families(self):
+        samples = {}
+        with self._lock:
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                samples.setdefault(name, []).extend(
+                    histogram.samples(name, dict(labels))
+                )
+        return [
+            (name, "histogram", HELP.get(name, name), samples[name])
+            for name in sorted(samples)
+        ]
+
+
+def family(name, kind, help, values):
+    """ A metric family from a single value or a list of (labels, value). """
+    if not isinstance(values, list):
+        values = [({}, values)]
+    return (name, kind, help, [(name, labels, value) for labels, value in values])
+
+
+def _escape(text, quotes=True):
+    text = text.replace("\\", "\\\\").replace("\n", "\\n")
+    return text.replace('"', '\\"') if quotes else text
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(name, _escape(str(value)))
+            for name, value in sorted(labels.items())
+        )
+    )
+
+
+def render(families):
+    """ Format metric families in the Prometheus text format.
+
+    A family is (name, type, help, samples), each sample being
+    (name, labels, value).
+    """
+    lines = []
+    for name, kind, help, samples in families:
+        lines.append("# HELP {} {}".format(name, _escape(help, quotes=False)))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for sample, labels, value in samples:
+            lines.append("{}{} {!r}".format(sample, _labels(labels), float(value)))
+    return "\n".join(lines) + "\n"
+
+
+class Sampler(object):
+    """ Samples the stacks of threads being watched, for profiling requests.
+
+    While any thread is watched, a background thread wakes every `interval`
+    seconds and counts the stack each watched thread is in. `stop` returns
+    the counts, keyed on stacks written outermost frame first.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._watched = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        with self._lock:
+            self._watched[threading.get_ident()] = Counter()
+            # Threads do not survive a fork
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._wake.set()
+
+    def stop(self):
+        with self._lock:
+            return self._watched.pop(threading.get_ident(), Counter())
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            frames = sys._current_frames()
+            with self._lock:
+                if not self._watched:
+                    self._wake.clear()
+                    continue
+                for ident, counts in self._watched.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        counts[stack(frame)] += 1
+            del frames
+            time.sleep(self.interval)
+
+
+def stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(
+            "{}:{}".format(os.path.basename(code.co_filename), code.co_name)
+        )
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def folded(counts, limit=None):
+    """ Sampled stacks in the folded format read by flame graph tools. """
+    return "\n".join(
+        "{} {}".format(stack, count) for stack, count in counts.most_common(limit)
+    )
+
+
+registry = Registry()
+
+
+def configure(enabled):
+    """ Replace the shared registry, e.g. to switch it off from the app config. """
+    global registry
+    registry = Registry(enabled=enabled)
+
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+
+def timer(name, **labels):
+    return registry.timer(name, **labels)
+
+
+def stage(name):
+    """ Time a stage of handling a request, such as a lookup or a render. """
+    return registry.timer(STAGE_SECONDS, stage=name)
@@ -6,5 +6,3 @@ create table if not exists polycules (
 create table if not exists migrations (
     migration integer
 );
-
-insert into migrations values ( 0 );
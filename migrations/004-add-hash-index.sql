@@ -0,0 +1,8 @@
+-- Rows sharing a hash could never be looked up, since every prefix of that
+-- hash was ambiguous. Keep the oldest one addressable so the index can be
+-- unique.
+update polycules set hash = null
+    where hash is not null
+    and id not in (select min(id) from polycules group by hash);
+
+create unique index if not exists polycules_hash on polycules (hash);
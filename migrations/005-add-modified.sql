@@ -0,0 +1,10 @@
+-- When each row last changed, for Last-Modified, and whether it can still
+-- change at all, so responses for rows that cannot may be cached for good.
+-- A null editable means unknown: the row predates this column.
+alter table polycules
+    add column modified integer;
+
+alter table polycules
+    add column editable integer;
+
+update polycules set editable = 0 where delete_pass is null;
@@ -0,0 +1,23 @@
+-- Exports rendered in the background by jobs.py. Jobs are keyed on what
+-- they render, the graph as it is now and the export options, so identical
+-- requests share one job; `result` holds the export once it is done.
+create table if not exists export_jobs (
+    id text primary key,
+    key text not null,
+    graph_hash text not null,
+    content_hash text not null,
+    format text not null,
+    options text not null,
+    status text not null,
+    attempts integer not null default 0,
+    result blob,
+    mimetype text,
+    error text,
+    created integer not null,
+    started integer,
+    finished integer
+);
+
+create unique index if not exists export_jobs_key on export_jobs (key);
+
+create index if not exists export_jobs_status on export_jobs (status, created);
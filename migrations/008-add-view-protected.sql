@@ -0,0 +1,8 @@
+-- Whether viewing takes a password. The create and edit forms post an empty
+-- view password when none is wanted, which was hashed and stored like any
+-- other, so a stored hash alone does not tell. A null means unknown: the
+-- row predates this column.
+alter table polycules
+    add column view_protected integer;
+
+update polycules set view_protected = 0 where view_pass is null;
@@ -0,0 +1,51 @@
+import time
+
+
+CHECKPOINTS = '''
+    create table if not exists migration_checkpoints (
+        name text primary key,
+        last_id integer not null
+    )
+'''
+
+
+def migrate_rows(db, name, columns, update, transform, table='polycules',
+                 batch_size=1000, log=print):
+    """ Rewrite every row of a table in batches, resumably.
+
+    Rows are read in id order, `batch_size` at a time, selecting `id` plus
+    `columns`. `transform` is called with each row and returns the
+    parameters for the `update` statement, or None to leave the row alone.
+    Each batch is written with executemany and committed together with a
+    checkpoint of the last id, so an interrupted run named `name` picks up
+    where it left off. The checkpoint is removed once every row is done.
+    """
+    db.execute(CHECKPOINTS)
+    row = db.execute(
+        'select last_id from migration_checkpoints where name = ?',
+        [name]).fetchone()
+    last_id = row[0] if row is not None else 0
+    if row is not None:
+        log('{}: resuming after id {}'.format(name, last_id))
+    select = 'select id, {} from {} where id > ? order by id limit ?'.format(
+        columns, table)
+    done = 0
+    start = time.monotonic()
+    while True:
+        rows = db.execute(select, [last_id, batch_size]).fetchall()
+        if not rows:
+            break
+        params = [p for p in (transform(row) for row in rows) if p is not None]
+        db.executemany(update, params)
+        last_id = rows[-1][0]
+        db.execute(
+            'insert or replace into migration_checkpoints (name, last_id) '
+            'values (?, ?)', [name, last_id])
+        db.commit()
+        done += len(rows)
+        elapsed = time.monotonic() - start
+        log('{}: {} rows, {:.0f} rows/s, at id {}'.format(
+            name, done, done / elapsed if elapsed else 0, last_id))
+    db.execute('delete from migration_checkpoints where name = ?', [name])
+    db.commit()
+    return done
@@ -1,13 +1,13 @@
 import hashlib
 
+from migrations.data import migrate_rows
 
-def migrate(db):
-    rows = db.execute('select * from polycules')
-    cur = db.cursor()
-    for row in rows.fetchall():
-        sha = hashlib.sha1(row[1].encode('utf-8')).hexdigest()
-        cur.execute('update polycules set hash = ? where id = ?', [
-            sha,
-            row[0],
-        ])
-    db.commit()
+
+def rehash(row):
+    return [hashlib.sha1(row[1].encode('utf-8')).hexdigest(), row[0]]
+
+
+def migrate(db, log=print):
+    migrate_rows(
+        db, 'hashify', 'graph', 'update polycules set hash = ? where id = ?',
+        rehash, log=log)
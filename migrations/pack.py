@@ -0,0 +1,18 @@
+from migrations.data import migrate_rows
+import model
+
+
+def pack(row):
+    if not isinstance(row[1], str):
+        return None
+    stored = model.encode_graph(row[1])
+    if isinstance(stored, str):
+        # Not JSON, so there is nothing to pack
+        return None
+    return [stored, row[0]]
+
+
+def migrate(db, log=print):
+    migrate_rows(
+        db, 'pack', 'graph', 'update polycules set graph = ? where id = ?',
+        pack, log=log)
@@ -0,0 +1,172 @@
+import os
+import sqlite3
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+from migrations import data, hashify, pack
+
+
+MIGRATIONS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Migration(object):
+    """ One schema version: an SQL script, a Python step, or both.
+
+    The SQL runs first, then the Python step, then the version bump, all in
+    one transaction. A Python step that commits on its own, as the batched
+    steps built on `migrations.data.migrate_rows` do, gives that up and must
+    be safe to run again after an interruption. The version is only bumped
+    once it has finished, and a checkpoint committed along with the SQL
+    keeps the SQL from running twice.
+    """
+
+    def __init__(self, number, sql=None, python=None):
+        self.number = number
+        self.sql = sql
+        self.python = python
+
+    @property
+    def checkpoint(self):
+        return "migration-{}-sql".format(self.number)
+
+    def apply(self, db, log=print):
+        if self.sql is not None and not self.sql_applied(db):
+            with open(os.path.join(MIGRATIONS_DIR, self.sql)) as f:
+                # Not executescript, which commits the open transaction first
+                for statement in statements(f.read()):
+                    db.execute(statement)
+            if self.python is not None:
+                db.execute(
+                    "insert into migration_checkpoints (name, last_id) values (?, 0)",
+                    [self.checkpoint],
+                )
+        if self.python is not None:
+            # Back to the usual transaction handling for the Python step: in
+            # autocommit mode, once the step had committed, every statement
+            # after that would be committed on its own.
+            db.isolation_level = "DEFERRED"
+            try:
+                self.python(db, log)
+            except BaseException:
+                if db.in_transaction:
+                    db.rollback()
+                raise
+            finally:
+                db.isolation_level = None
+
+    def sql_applied(self, db):
+        if self.python is None:
+            return False
+        db.execute(data.CHECKPOINTS)
+        return (
+            db.execute(
+                "select 1 from migration_checkpoints where name = ?",
+                [self.checkpoint],
+            ).fetchone()
+            is not None
+        )
+
+    def finish(self, db):
+        if self.sql is not None and self.python is not None:
+            db.execute(
+                "delete from migration_checkpoints where name = ?", [self.checkpoint]
+            )
+
+
+def statements(script):
+    statement = ""
+    for line in script.splitlines(True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement
+            statement = ""
+    if statement.strip():
+        yield statement
+
+
+MIGRATIONS = [
+    Migration(0, "000-initial.sql"),
+    Migration(1, "001-add-view-pass.sql"),
+    Migration(2, "002-add-delete-pass.sql"),
+    Migration(3, "003-add-hash.sql", hashify.migrate),
+    Migration(4, "004-add-hash-index.sql"),
+    Migration(5, "005-add-modified.sql"),
+    Migration(6, python=pack.migrate),
+    Migration(7, "007-add-export-jobs.sql"),
+    Migration(8, "008-add-view-protected.sql"),
+]
+
+LATEST = MIGRATIONS[-1].number
+
+
+def current_version(db):
+    try:
+        row = db.execute("select migration from migrations").fetchone()
+    except sqlite3.OperationalError:
+        # If there was no migrations table, the DB does not exist yet.
+        return -1
+    return -1 if row is None else row[0]
+
+
+def migrate(db, log=print, busy_timeout=60000):
+    """ Bring the database up to the latest schema version.
+
+    When the schema is current this costs a single query. Otherwise every
+    migration is applied under SQLite's write lock (begin immediate), and the
+    version is checked again once the lock is held, so workers starting
+    together wait for each other instead of applying migrations twice.
+    Python steps that commit on their own let go of that lock part way, so
+    the whole run also holds a lock file next to the database.
+    """
+    if current_version(db) >= LATEST:
+        return
+    isolation_level = db.isolation_level
+    db.isolation_level = None
+    db.execute("pragma busy_timeout = {:d}".format(busy_timeout))
+    try:
+        with lock_file(db):
+            apply_all(db, log)
+    finally:
+        db.isolation_level = isolation_level
+
+
+def apply_all(db, log):
+    for migration in MIGRATIONS:
+        db.execute("begin immediate")
+        try:
+            if current_version(db) >= migration.number:
+                db.execute("rollback")
+                continue
+            log("Applying migration {}".format(migration.number))
+            migration.apply(db, log)
+            if not db.in_transaction:
+                # The Python step committed on its own
+                db.execute("begin immediate")
+            migration.finish(db)
+            db.execute("delete from migrations")
+            db.execute("insert into migrations values (?)", [migration.number])
+            if db.in_transaction:
+                db.execute("commit")
+        except BaseException:
+            if db.in_transaction:
+                db.execute("rollback")
+            raise
+
+
+@contextmanager
+def lock_file(db):
+    """ Hold an exclusive lock on a file beside the database, if it has one. """
+    path = db.execute("pragma database_list").fetchone()[2]
+    if not path or fcntl is None:
+        yield
+        return
+    with open(path + "-migrate", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
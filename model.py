@@ -1,9 +1,265 @@
-import bcrypt
 import hashlib
 import json
 import markdown
-import subprocess
-import tempfile
+import sqlite3
+import time
+import zlib
+
+import cache
+import layout
+import metrics
+import passwords
+import raster
+import rendering
+import storage
+
+CHUNK_SIZE = 16 * 1024
+GRAPH_MAGIC = b"PCZ1"
+GRAPH_COMPRESSION_LEVEL = 6
+# The radius build.js gives new nodes
+NODE_RADIUS = 12
+
+
+def chunked(pieces, size=CHUNK_SIZE):
+    """ Join small pieces of rendered output into chunks of roughly `size`. """
+    buffered = []
+    length = 0
+    for piece in pieces:
+        buffered.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield "".join(buffered)
+            buffered = []
+            length = 0
+    if buffered:
+        yield "".join(buffered)
+
+
+def pack_links(parsed):
+    """ Replace link ends which name a listed node by that node's id.
+
+    polycule.js and `Graph` both swap each end for the listed node with the
+    same id, so the copy stored in the link is never used. Returns None if
+    the graph is not shaped for that.
+    """
+    nodes = parsed.get("nodes") if isinstance(parsed, dict) else None
+    links = parsed.get("links") if isinstance(parsed, dict) else None
+    if not isinstance(nodes, list) or not isinstance(links, list):
+        return None
+    if not all(isinstance(node, dict) for node in nodes):
+        return None
+    ids = {node.get("id") for node in nodes}
+    packed = []
+    for link in links:
+        if not isinstance(link, dict):
+            return None
+        link = dict(link)
+        for end in ("source", "target"):
+            if end not in link:
+                continue
+            if not isinstance(link[end], dict):
+                return None
+            if type(link[end].get("id")) is int and link[end]["id"] in ids:
+                link[end] = link[end]["id"]
+        packed.append(link)
+    return packed
+
+
+def unpack_links(parsed):
+    # Like polycule.js, the last listed node with an id wins
+    nodes = {node.get("id"): node for node in parsed["nodes"]}
+    for link in parsed["links"]:
+        for end in ("source", "target"):
+            if isinstance(link.get(end), int):
+                link[end] = nodes[link[end]]
+
+
+def encode_graph(graph):
+    """ Pack graph JSON text for the database.
+
+    The graph is stored as zlib compressed JSON behind `GRAPH_MAGIC`, with
+    links packed by `pack_links` where possible. Text which isn't JSON is
+    stored as it is.
+    """
+    try:
+        parsed = json.loads(graph)
+    except ValueError:
+        return graph
+    links = pack_links(parsed)
+    if links is None:
+        document = [0, parsed]
+    else:
+        document = [1, dict(parsed, links=links)]
+    return GRAPH_MAGIC + zlib.compress(
+        json.dumps(document, separators=(",", ":")).encode("utf-8"),
+        GRAPH_COMPRESSION_LEVEL,
+    )
+
+
+def decode_graph(stored):
+    """ Turn a stored graph back into the JSON text polycule.js expects. """
+    if isinstance(stored, str):
+        return stored
+    if not stored.startswith(GRAPH_MAGIC):
+        return stored.decode("utf-8")
+    packed, parsed = json.loads(zlib.decompress(stored[len(GRAPH_MAGIC):]))
+    if packed:
+        unpack_links(parsed)
+    return json.dumps(parsed, separators=(",", ":"))
+
+
+def stored_hash(stored):
+    """ The content hash of a graph as stored, packed or not. """
+    if isinstance(stored, str):
+        stored = stored.encode("utf-8")
+    return hashlib.sha1(stored).hexdigest()
+
+
+class Node(object):
+    __slots__ = ("id", "name", "x", "y", "r")
+
+    def __init__(self, id, name, x=None, y=None, r=None):
+        self.id = id
+        self.name = name
+        self.x = x
+        self.y = y
+        self.r = r
+
+    @classmethod
+    def from_dict(cls, node):
+        return cls(
+            node.get("id"),
+            node.get("name"),
+            node.get("x"),
+            node.get("y"),
+            node.get("r"),
+        )
+
+
+class Edge(object):
+    __slots__ = (
+        "source",
+        "target",
+        "strength",
+        "dashed",
+        "source_text",
+        "center_text",
+        "target_text",
+    )
+
+    def __init__(
+        self,
+        source,
+        target,
+        strength,
+        dashed=False,
+        source_text=None,
+        center_text=None,
+        target_text=None,
+    ):
+        self.source = source
+        self.target = target
+        self.strength = strength
+        self.dashed = dashed
+        self.source_text = source_text
+        self.center_text = center_text
+        self.target_text = target_text
+
+
+class Graph(object):
+    """ A compact, read-only view of a polycule's graph for the renderers.
+
+    Links in the stored JSON carry full copies of their source and target
+    nodes; here edges refer to nodes by their index in `nodes` instead.
+    Like polycule.js, link ends are matched to listed nodes by id. Ends
+    which match no listed node are kept after the first `listed` nodes.
+    """
+
+    __slots__ = ("nodes", "listed", "edges", "translate", "scale")
+
+    def __init__(self, nodes, edges, listed=None, translate=None, scale=None):
+        self.nodes = nodes
+        self.listed = len(nodes) if listed is None else listed
+        self.edges = edges
+        self.translate = translate
+        self.scale = scale
+
+    @classmethod
+    def from_json(cls, graph):
+        with metrics.stage("json"):
+            parsed = json.loads(graph)
+        return cls.from_parsed(parsed)
+
+    @classmethod
+    def from_parsed(cls, parsed):
+        nodes = [Node.from_dict(node) for node in parsed.get("nodes", [])]
+        listed = len(nodes)
+        indices = {node.id: i for i, node in enumerate(nodes)}
+
+        def index(node):
+            if node["id"] not in indices:
+                indices[node["id"]] = len(nodes)
+                nodes.append(Node.from_dict(node))
+            return indices[node["id"]]
+
+        edges = [
+            Edge(
+                index(link["source"]),
+                index(link["target"]),
+                link["strength"],
+                dashed="dashed" in link,
+                source_text=link.get("sourceText"),
+                center_text=link.get("centerText"),
+                target_text=link.get("targetText"),
+            )
+            for link in parsed.get("links", [])
+        ]
+        return cls(
+            nodes,
+            edges,
+            listed=listed,
+            translate=parsed.get("translate"),
+            scale=parsed.get("scale"),
+        )
+
+    def listed_nodes(self):
+        return self.nodes[: self.listed]
+
+    def laid_out(self, seed=0):
+        """ Return the graph with its nodes placed, if any are missing a place.
+
+        The whole graph is laid out again rather than just the missing
+        nodes, so the picture hangs together. Without NumPy, or with every
+        node already placed, the graph is returned as it is.
+        """
+        if not layout.available() or all(
+            node.x is not None and node.y is not None for node in self.nodes
+        ):
+            return self
+        positions = layout.layout(
+            len(self.nodes),
+            [
+                (
+                    edge.source,
+                    edge.target,
+                    layout.link_length(edge.strength, len(self.edges)),
+                )
+                for edge in self.edges
+            ],
+            seed=seed,
+        )
+        nodes = [
+            Node(
+                node.id,
+                node.name,
+                int(round(x)),
+                int(round(y)),
+                NODE_RADIUS if node.r is None else node.r,
+            )
+            for node, (x, y) in zip(self.nodes, positions.tolist())
+        ]
+        # The layout already fits the canvas
+        return Graph(nodes, self.edges, listed=self.listed)
 
 
 class Polycule(object):
@@ -15,6 +271,9 @@ class Polycule(object):
         view_pass=None,
         edit_pass=None,
         graph_hash=None,
+        modified=None,
+        editable=None,
+        view_protected=None,
     ):
         self._db = db
         self.id = id
@@ -22,18 +281,77 @@ class Polycule(object):
         self.view_pass = view_pass
         self.edit_pass = edit_pass
         self.graph_hash = graph_hash
+        self.modified = modified
+        self.editable = editable
+        self.view_protected = view_protected
+        self._parsed = None
+
+    @property
+    def graph(self):
+        """ The graph as JSON text, decoded from storage on first use. """
+        if self._graph is None and self._stored is not None:
+            self._graph = decode_graph(self._stored)
+        return self._graph
+
+    @graph.setter
+    def graph(self, graph):
+        # Rows from the database may hold graphs packed by `encode_graph`
+        if isinstance(graph, bytes):
+            self._stored, self._graph = graph, None
+        else:
+            self._stored, self._graph = None, graph
+
+    @property
+    def parsed(self):
+        """ The graph, parsed once and shared by every renderer. """
+        if self._parsed is None or self._parsed[0] is not self.graph:
+            self._parsed = (self.graph, Graph.from_json(self.graph))
+        return self._parsed[1]
+
+    @property
+    def content_hash(self):
+        """ The hash of the graph as it is now, which changes on every save.
+
+        Packed graphs are hashed as stored, which spares decoding them.
+        """
+        return stored_hash(self._stored if self._stored is not None else self.graph)
+
+    @property
+    def immutable(self):
+        """ Whether the graph can never be saved again.
+
+        That is the case once the edit password is removed or was left
+        empty, since `can_save` refuses an empty one. Rows from before the
+        `editable` column are assumed to be editable.
+        """
+        return self.edit_pass is None or self.editable == 0
+
+    @property
+    def protected(self):
+        """ Whether viewing the graph takes a password.
+
+        The forms post an empty view password when none is wanted, which
+        is hashed and stored like any other, so a stored hash alone does
+        not tell. Rows from before the `view_protected` column are assumed
+        to be protected until an empty password is seen to open them.
+        """
+        return self.view_pass is not None and self.view_protected != 0
 
     @classmethod
     def get(cls, db, graph_hash, password, force=False):
-        if len(graph_hash) < 7:
+        if len(graph_hash) < 7 or len(graph_hash) > 40:
             return None
-        graph_hash = graph_hash + "_" * (40 - len(graph_hash))
-        result = db.execute(
-            """select id, graph, view_pass, delete_pass, hash
-            from polycules where hash like ?""",
-            [graph_hash],
-        )
-        graph = result.fetchall()
+        # Hashes are lowercase hex, so every hash starting with the prefix
+        # sorts between the prefix itself and the prefix followed by "g".
+        # That turns the lookup into a range scan over the hash index.
+        graph_hash = graph_hash.lower()
+        with metrics.stage("lookup"):
+            graph = db.execute(
+                """select id, graph, view_pass, delete_pass, hash, modified, editable,
+                view_protected
+                from polycules where hash >= ? and hash < ? limit 2""",
+                [graph_hash, graph_hash + "g"],
+            ).fetchall()
         if len(graph) != 1:
             return None
         graph = graph[0]
@@ -44,51 +362,83 @@ class Polycule(object):
             view_pass=graph[2],
             edit_pass=graph[3],
             graph_hash=graph[4],
+            modified=graph[5],
+            editable=graph[6],
+            view_protected=graph[7],
         )
-        if not force and (
-            polycule.view_pass is not None
-            and not bcrypt.checkpw(
-                password.encode("utf-8"), polycule.view_pass.encode("utf-8")
-            )
-        ):
-            raise Polycule.PermissionDenied
+        if not force:
+            polycule.can_view(password)
         return polycule
 
     @classmethod
-    def create(cls, db, graph, raw_view_pass, raw_edit_pass):
+    def create(cls, db, graph, raw_view_pass, raw_edit_pass, parsed=None):
+        graph_hash = hashlib.sha1(graph.encode("utf-8")).hexdigest()
+        # Probe the hash index before spending time on bcrypt; the unique
+        # index still catches a concurrent insert that wins the race.
+        existing = db.execute(
+            "select 1 from polycules where hash = ?", [graph_hash]
+        ).fetchone()
+        if existing is not None:
+            raise Polycule.IdenticalGraph
         if raw_view_pass is not None:
-            view_pass = bcrypt.hashpw(raw_view_pass.encode(), bcrypt.gensalt()).decode()
+            view_pass = passwords.hash_password(raw_view_pass)
         else:
             view_pass = None
         if raw_edit_pass is not None:
-            edit_pass = bcrypt.hashpw(raw_edit_pass.encode(), bcrypt.gensalt()).decode()
+            edit_pass = passwords.hash_password(raw_edit_pass)
         else:
             edit_pass = None
-        result = db.execute("select count(*) from polycules where graph = ?", [graph])
-        existing = result.fetchone()[0]
-        if existing != 0:
+        modified = int(time.time())
+        editable = bool(raw_edit_pass)
+        view_protected = bool(raw_view_pass)
+        stored = encode_graph(graph)
+
+        def insert(conn):
+            return conn.execute(
+                """insert into polycules
+                (graph, view_pass, delete_pass, hash, modified, editable,
+                view_protected)
+                values (?, ?, ?, ?, ?, ?, ?)""",
+                [
+                    stored,
+                    view_pass,
+                    edit_pass,
+                    graph_hash,
+                    modified,
+                    editable,
+                    view_protected,
+                ],
+            ).lastrowid
+
+        try:
+            id = storage.write(db, insert)
+        except sqlite3.IntegrityError:
             raise Polycule.IdenticalGraph
-        cur = db.cursor()
-        result = cur.execute(
-            """insert into polycules
-            (graph, view_pass, delete_pass, hash) values (?, ?, ?, ?)""",
-            [
-                graph,
-                view_pass,
-                edit_pass,
-                hashlib.sha1(graph.encode("utf-8")).hexdigest(),
-            ],
+        polycule = Polycule(
+            db=db,
+            id=id,
+            graph=stored,
+            view_pass=view_pass,
+            edit_pass=edit_pass,
+            graph_hash=graph_hash,
+            modified=modified,
+            editable=editable,
+            view_protected=view_protected,
         )
-        db.commit()
-        new_hash = db.execute(
-            "select hash from polycules where id = ?", [result.lastrowid]
-        ).fetchone()[0]
-        return Polycule.get(db, new_hash, None, force=True)
+        # What was submitted reads the same as what was stored
+        polycule._graph = graph
+        if parsed is not None:
+            polycule._parsed = (graph, Graph.from_parsed(parsed))
+        return polycule
+
+    def can_view(self, view_pass):
+        if self.protected and not passwords.check_password(
+            view_pass, self.view_pass
+        ):
+            raise Polycule.PermissionDenied
 
     def can_save(self, edit_pass):
-        result = bcrypt.checkpw(
-            edit_pass.encode("utf-8"), self.edit_pass.encode("utf-8")
-        )
+        result = passwords.check_password(edit_pass, self.edit_pass)
         if result and len(edit_pass) == 0:
             raise Polycule.NoPassword
         if not result:
@@ -102,48 +452,101 @@ class Polycule(object):
         force=False,
         remove_view_pass=False,
         remove_edit_pass=False,
+        parsed=None,
+        base=None,
     ):
+        """ Save a new version of the graph and passwords.
+
+        If `base` is given, the save only goes ahead if the graph stored is
+        still the one with that content hash, else StaleGraph is raised.
+        """
         if remove_view_pass:
             view_pass = None
+            view_protected = False
         else:
             if raw_view_pass:
-                view_pass = bcrypt.hashpw(
-                    raw_view_pass.encode(), bcrypt.gensalt()
-                ).decode()
+                view_pass = passwords.hash_password(raw_view_pass)
+                view_protected = True
             else:
                 view_pass = self.view_pass
+                view_protected = self.view_protected
         if remove_edit_pass:
             edit_pass = None
+            editable = False
         else:
             if raw_edit_pass:
-                edit_pass = bcrypt.hashpw(
-                    raw_edit_pass.encode(), bcrypt.gensalt()
-                ).decode()
+                edit_pass = passwords.hash_password(raw_edit_pass)
+                editable = True
             else:
                 edit_pass = self.edit_pass
-        cur = self._db.cursor()
-        cur.execute(
-            """update polycules
-        set graph = ?, view_pass = ?, delete_pass = ?
-        where id = ?""",
-            [graph, view_pass, edit_pass, self.id],
-        )
-        self._db.commit()
-        self.graph = graph
+                editable = self.editable
+        modified = int(time.time())
+        stored = encode_graph(graph)
+
+        def update(conn):
+            if base is not None:
+                row = conn.execute(
+                    "select graph from polycules where id = ?", [self.id]
+                ).fetchone()
+                if row is None or stored_hash(row[0]) != base:
+                    raise Polycule.StaleGraph
+            conn.execute(
+                """update polycules
+            set graph = ?, view_pass = ?, delete_pass = ?, modified = ?,
+            editable = ?, view_protected = ?
+            where id = ?""",
+                [
+                    stored,
+                    view_pass,
+                    edit_pass,
+                    modified,
+                    editable,
+                    view_protected,
+                    self.id,
+                ],
+            )
+
+        storage.write(self._db, update)
+        cache.invalidate(self.graph_hash)
+        self.graph = stored
+        self._graph = graph
         self.view_pass = view_pass
         self.edit_pass = edit_pass
+        self.modified = modified
+        self.editable = editable
+        self.view_protected = view_protected
+        if parsed is not None:
+            self._parsed = (graph, Graph.from_parsed(parsed))
+
+    def record_unprotected(self):
+        """ Note that an empty password opens a row of unknown protection. """
+        storage.write(
+            self._db,
+            lambda conn: conn.execute(
+                "update polycules set view_protected = 0 "
+                "where id = ? and view_pass = ?",
+                [self.id, self.view_pass],
+            ),
+        )
+        self.view_protected = 0
 
     def delete(self, password, force=False):
-        if not force and not bcrypt.checkpw(
-            password.encode("utf-8"), self.edit_pass.encode("utf-8")
-        ):
+        if not force and not passwords.check_password(password, self.edit_pass):
             raise Polycule.PermissionDenied
-        cur = self._db.cursor()
-        cur.execute("delete from polycules where id = ?", [self.id])
-        self._db.commit()
+        storage.write(
+            self._db,
+            lambda conn: conn.execute("delete from polycules where id = ?", [self.id]),
+        )
+        cache.invalidate(self.graph_hash)
 
     def as_text(self):
-        text = """# Polycule
+        return "".join(self.iter_text())
+
+    def iter_text(self):
+        return chunked(self._text_pieces())
+
+    def _text_pieces(self):
+        yield """# Polycule
 
 This is our relationship graph. You can see a visual representation of it
 online at <https://polycul.es/{}>.
@@ -151,62 +554,59 @@ online at <https://polycul.es/{}>.
 """.format(
             self.graph_hash
         )
-        parsed = json.loads(self.graph)
-        for edge in parsed["links"]:
-            text += "* _{}_{} is in a {}relationship{} with _{}_{}\n".format(
-                edge["source"]["name"].encode("utf-8"),
-                " ({})".format(edge["sourceText"].encode("utf-8"))
-                if "sourceText" in edge
-                else "",
-                "loosely defined " if "dashed" in edge else "",
-                " ({})".format(edge["centerText"].encode("utf-8"))
-                if "centerText" in edge
-                else "",
-                edge["target"]["name"].encode("utf-8"),
-                " ({})".format(edge["targetText"].encode("utf-8"))
-                if "targetText" in edge
-                else "",
+
+        def aside(text):
+            return "" if text is None else " ({})".format(text)
+
+        graph = self.parsed
+        for edge in graph.edges:
+            yield "* _{}_{} is in a {}relationship{} with _{}_{}\n".format(
+                graph.nodes[edge.source].name,
+                aside(edge.source_text),
+                "loosely defined " if edge.dashed else "",
+                aside(edge.center_text),
+                graph.nodes[edge.target].name,
+                aside(edge.target_text),
             )
-        return text
 
     def as_html(self):
-        return markdown.markdown(self.as_text().decode("utf-8"))
+        return markdown.markdown(self.as_text())
 
     def as_dot(self, edge_labels=False):
-        dot = "graph polycule {\n"
-        parsed = json.loads(self.graph)
-        for node in parsed["nodes"]:
-            dot += '\tnode{id} [label="{label}"]\n'.format(
-                id=node["id"], label=node["name"].encode("utf-8").replace('"', '\\"')
+        return "".join(self.iter_dot(edge_labels=edge_labels))
+
+    def iter_dot(self, edge_labels=False):
+        return chunked(self._dot_pieces(edge_labels))
+
+    def _dot_pieces(self, edge_labels):
+        yield "graph polycule {\n"
+        graph = self.parsed
+        for node in graph.listed_nodes():
+            yield '\tnode{id} [label="{label}"]\n'.format(
+                id=node.id, label=node.name.replace('"', '\\"')
             )
-        dot += "\n"
-        for edge in parsed["links"]:
-            dot += "\tnode{id1} -- node{id2} [len={len}".format(
-                id1=edge["source"]["id"],
-                id2=edge["target"]["id"],
-                len=1 / float(edge["strength"]) * 10
-                + (1 / float(len(parsed["links"]))),
+        yield "\n"
+        for edge in graph.edges:
+            yield "\tnode{id1} -- node{id2} [len={len}".format(
+                id1=graph.nodes[edge.source].id,
+                id2=graph.nodes[edge.target].id,
+                len=layout.link_length(edge.strength, len(graph.edges)),
             )
             if edge_labels:
-                dot += ',label="{label}"'.format(label=edge.get("centerText", ""))
-            if "dashed" in edge:
-                dot += ",style=dashed"
-            elif int(edge["strength"]) > 5:
-                dot += ",style=bold"
-            dot += "]\n"
-        dot += "}"
-        return dot
+                yield ',label="{label}"'.format(
+                    label=edge.center_text if edge.center_text is not None else ""
+                )
+            if edge.dashed:
+                yield ",style=dashed"
+            elif int(edge.strength) > 5:
+                yield ",style=bold"
+            yield "]\n"
+        yield "}"
 
     def as_png_from_dot(self, edge_labels=False):
-        source = tempfile.NamedTemporaryFile()
-        dest = tempfile.NamedTemporaryFile()
-        source.write(self.as_dot(edge_labels=edge_labels))
-        source.flush()
-        subprocess.check_call(["neato", "-Tpng", "-o", dest.name, source.name])
-        png = dest.read()
-        source.close()
-        dest.close()
-        return png
+        return rendering.run(
+            ["neato", "-Tpng"], self.as_dot(edge_labels=edge_labels).encode("utf-8")
+        )
 
     def as_svg(
         self,
@@ -215,26 +615,27 @@ online at <https://polycul.es/{}>.
         embed=False,
         labels_by_default=False,
     ):
-        svg = """{header}
-        <svg width="{width}" height="{height}" viewbox="0 0 {width} {height}"
-            xmlns="http://www.w3.org/2000/svg">
-            {style}
-            <g transform="translate({translate})">
-                <g transform="scale({scale})">
-                    <g class="polycul_es-links">
-                        {links}
-                    </g>
-                    <g class="polycul_es-nodes">
-                        {nodes}
-                    </g>
-                    <g class="polycul_es-meanings">
-                        {meanings}
-                    </g>
-                </g>
-            </g>
-        </svg>
-        """
+        return "".join(
+            self.iter_svg(
+                edge_labels=edge_labels,
+                include_style=include_style,
+                embed=embed,
+                labels_by_default=labels_by_default,
+            )
+        )
+
+    def iter_svg(
+        self,
+        edge_labels=False,
+        include_style=False,
+        embed=False,
+        labels_by_default=False,
+    ):
+        return chunked(
+            self._svg_pieces(edge_labels, include_style, embed, labels_by_default)
+        )
 
+    def _svg_pieces(self, edge_labels, include_style, embed, labels_by_default):
         header = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
         <!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN"
           "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">"""
@@ -268,10 +669,45 @@ online at <https://polycul.es/{}>.
             "" if labels_by_default else "opacity: 1;",
         )
 
-        parsed = json.loads(self.graph)
-        nodes_el = ""
-        for node in parsed["nodes"]:
-            nodes_el += """
+        graph = self.parsed.laid_out()
+        yield """{header}
+        <svg width="{width}" height="{height}" viewbox="0 0 {width} {height}"
+            xmlns="http://www.w3.org/2000/svg">
+            {style}
+            <g transform="translate({translate})">
+                <g transform="scale({scale})">
+                    <g class="polycul_es-links">
+                        """.format(
+            header="" if embed else header,
+            style=style if include_style else "",
+            width=1000,
+            height=540,
+            translate="0, 0" if graph.translate is None else graph.translate,
+            scale=1 if graph.scale is None else graph.scale,
+        )
+        for edge in graph.edges:
+            source, target = graph.nodes[edge.source], graph.nodes[edge.target]
+            yield """
+            <g class="link">
+                <line x1="{x1}" y1="{y1}" x2="{x2}" y2="{y2}"
+                    stroke-width="{width}"{dasharray} />
+            </g>
+            """.format(
+                x1=source.x,
+                y1=source.y,
+                x2=target.x,
+                y2=target.y,
+                width=edge.strength,
+                dasharray=' stroke-dasharray="{s} {s}"'.format(s=edge.strength)
+                if edge.dashed
+                else "",
+            )
+        yield """
+                    </g>
+                    <g class="polycul_es-nodes">
+                        """
+        for node in graph.listed_nodes():
+            yield """
             <g class="node">
                 <circle cx="{x}" cy="{y}" r="{r}" />
                 <text x="{textx}" y="{texty}" text-anchor="middle">
@@ -279,69 +715,47 @@ online at <https://polycul.es/{}>.
                 </text>
             </g>
             """.format(
-                x=node["x"],
-                y=node["y"],
-                r=node["r"],
-                textx=node["x"],
-                texty=int(node["y"]) - int(node["r"]) - 5,
-                name=node["name"].encode("utf-8"),
+                x=node.x,
+                y=node.y,
+                r=node.r,
+                textx=node.x,
+                texty=int(node.y) - int(node.r) - 5,
+                name=node.name,
             )
-        links_el = ""
-        meanings_el = ""
-        for edge in parsed["links"]:
-            if edge_labels and "centerText" in edge:
-                meanings_el += """
+        yield """
+                    </g>
+                    <g class="polycul_es-meanings">
+                        """
+        if edge_labels:
+            for edge in graph.edges:
+                if edge.center_text is not None:
+                    source, target = graph.nodes[edge.source], graph.nodes[edge.target]
+                    yield """
                 <text x="{x}" y="{y}" text-anchor="middle">{meaning}</text>
                 """.format(
-                    x=(edge["source"]["x"] + edge["target"]["x"]) / 2,
-                    y=(edge["source"]["y"] + edge["target"]["y"]) / 2,
-                    meaning=edge["centerText"],
-                )
-            links_el += """
-            <g class="link">
-                <line x1="{x1}" y1="{y1}" x2="{x2}" y2="{y2}"
-                    stroke-width="{width}"{dasharray} />
+                        x=(source.x + target.x) / 2,
+                        y=(source.y + target.y) / 2,
+                        meaning=edge.center_text,
+                    )
+        yield """
+                    </g>
+                </g>
             </g>
-            """.format(
-                x1=edge["source"]["x"],
-                y1=edge["source"]["y"],
-                x2=edge["target"]["x"],
-                y2=edge["target"]["y"],
-                width=edge["strength"],
-                dasharray=' stroke-dasharray="{s} {s}"'.format(s=edge["strength"])
-                if "dashed" in edge
-                else "",
-            )
-        return svg.format(
-            header="" if embed else header,
-            style=style if include_style else "",
-            width=1000,
-            height=540,
-            translate=parsed.get("translate", "0, 0"),
-            scale=parsed.get("scale", 1),
-            nodes=nodes_el,
-            links=links_el,
-            meanings=meanings_el if edge_labels else "",
-        )
+        </svg>
+        """
 
     def as_png_from_svg(self, edge_labels=False, include_style=False, embed=False):
-        source = tempfile.NamedTemporaryFile()
-        dest = tempfile.NamedTemporaryFile()
-        source.write(
-            self.as_svg(
-                edge_labels=edge_labels,
-                include_style=True,
-                labels_by_default=edge_labels,
-            )
-        )
-        source.flush()
-        subprocess.check_call(
-            ["convert", "svg:{}".format(source.name), "png:{}".format(dest.name)]
+        svg = self.as_svg(
+            edge_labels=edge_labels,
+            include_style=True,
+            labels_by_default=edge_labels,
         )
-        png = dest.read()
-        source.close()
-        dest.close()
-        return png
+        if raster.available():
+            try:
+                return rendering.call("rasterize", raster.rasterize, svg)
+            except raster.Unsupported:
+                pass
+        return rendering.run(["convert", "svg:-", "png:-"], svg.encode("utf-8"))
 
     class NoPassword(Exception):
         pass
@@ -351,3 +765,6 @@ online at <https://polycul.es/{}>.
 
     class IdenticalGraph(Exception):
         pass
+
+    class StaleGraph(Exception):
+        pass
@@ -0,0 +1,115 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+import metrics
+
+
+class Busy(Exception):
+    """ Raised when too much password work is already queued. """
+
+
+class PasswordPool(object):
+    """ A fixed set of worker threads for bcrypt, with a bounded queue.
+
+    bcrypt releases the GIL while it works, so keeping it on a few
+    dedicated threads stops a burst of password checks from tying up every
+    request thread. Once `workers + queue_size` calls are in flight, new
+    calls fail fast with `Busy` rather than waiting.
+    """
+
+    def __init__(self, workers=2, queue_size=32):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="bcrypt"
+        )
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._rejected = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise Busy
+        with self._lock:
+            self._queued += 1
+        try:
+            future = self._executor.submit(self._call, time.monotonic(), fn, args)
+        except Exception:
+            with self._lock:
+                self._queued -= 1
+            self._slots.release()
+            raise
+        return future.result()
+
+    def _call(self, submitted, fn, args):
+        wait = time.monotonic() - submitted
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+            self._slots.release()
+
+    def hash(self, password):
+        return self.run(
+            bcrypt.hashpw, password.encode("utf-8"), bcrypt.gensalt()
+        ).decode()
+
+    def check(self, password, hashed):
+        return self.run(
+            bcrypt.checkpw, password.encode("utf-8"), hashed.encode("utf-8")
+        )
+
+    def stats(self):
+        with self._lock:
+            started = self._completed + self._running
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "queued": self._queued,
+                "running": self._running,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "wait_seconds_total": self._wait_total,
+                "wait_seconds_mean": self._wait_total / started if started else 0.0,
+                "wait_seconds_max": self._wait_max,
+            }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+pool = PasswordPool()
+
+
+def configure(workers, queue_size):
+    """ Replace the shared pool, e.g. with sizes from the app config. """
+    global pool
+    old, pool = pool, PasswordPool(workers=workers, queue_size=queue_size)
+    old.shutdown(wait=False)
+
+
+def hash_password(password):
+    with metrics.stage("bcrypt"):
+        return pool.hash(password)
+
+
+def check_password(password, hashed):
+    with metrics.stage("bcrypt"):
+        return pool.check(password, hashed)
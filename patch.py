@@ -0,0 +1,125 @@
+import copy
+
+
+class InvalidPatch(Exception):
+    pass
+
+
+def parse_pointer(pointer):
+    """ Split a JSON pointer (RFC 6901) into its unescaped tokens. """
+    if pointer == "":
+        return []
+    if not isinstance(pointer, str) or not pointer.startswith("/"):
+        raise InvalidPatch("Bad path: {!r}".format(pointer))
+    return [
+        token.replace("~1", "/").replace("~0", "~") for token in pointer[1:].split("/")
+    ]
+
+
+def _index(container, token, adding=False):
+    if token == "-" and adding:
+        return len(container)
+    if not token.isdigit() or (token != "0" and token.startswith("0")):
+        raise InvalidPatch("Bad array index: {!r}".format(token))
+    index = int(token)
+    if index > len(container) or (index == len(container) and not adding):
+        raise InvalidPatch("Array index out of range: {}".format(index))
+    return index
+
+
+def _resolve(document, tokens):
+    """ Return the container holding the last token, and that token. """
+    parent = document
+    for token in tokens[:-1]:
+        try:
+            if isinstance(parent, list):
+                parent = parent[_index(parent, token)]
+            elif isinstance(parent, dict):
+                parent = parent[token]
+            else:
+                raise KeyError(token)
+        except KeyError:
+            raise InvalidPatch("No such path: /{}".format("/".join(tokens)))
+    if not isinstance(parent, (list, dict)):
+        raise InvalidPatch("No such path: /{}".format("/".join(tokens)))
+    return parent, tokens[-1]
+
+
+def _get(document, tokens):
+    if not tokens:
+        return document
+    parent, token = _resolve(document, tokens)
+    if isinstance(parent, list):
+        return parent[_index(parent, token)]
+    if token not in parent:
+        raise InvalidPatch("No such path: /{}".format("/".join(tokens)))
+    return parent[token]
+
+
+def _add(document, tokens, value):
+    if not tokens:
+        return value
+    parent, token = _resolve(document, tokens)
+    if isinstance(parent, list):
+        parent.insert(_index(parent, token, adding=True), value)
+    else:
+        parent[token] = value
+    return document
+
+
+def _remove(document, tokens):
+    if not tokens:
+        raise InvalidPatch("Cannot remove the whole document")
+    parent, token = _resolve(document, tokens)
+    if isinstance(parent, list):
+        return parent.pop(_index(parent, token))
+    if token not in parent:
+        raise InvalidPatch("No such path: /{}".format("/".join(tokens)))
+    return parent.pop(token)
+
+
+def apply(document, operations, check=None):
+    """ Apply a JSON patch (RFC 6902) to a copy of `document` and return it.
+
+    After each operation `check`, if given, is called with the document and
+    the tokens of each path the operation changed, so only what changed
+    needs validating; it should raise to reject the patch.
+    """
+    if not isinstance(operations, list):
+        raise InvalidPatch("A patch is a list of operations")
+    document = copy.deepcopy(document)
+    for operation in operations:
+        if not isinstance(operation, dict) or "path" not in operation:
+            raise InvalidPatch("Bad operation: {!r}".format(operation))
+        op = operation.get("op")
+        path = parse_pointer(operation["path"])
+        if op in ("add", "replace", "test") and "value" not in operation:
+            raise InvalidPatch("Missing value: {!r}".format(operation))
+        if op == "add":
+            document = _add(document, path, copy.deepcopy(operation["value"]))
+        elif op == "remove":
+            _remove(document, path)
+        elif op == "replace":
+            if path:
+                _remove(document, path)
+            document = _add(document, path, copy.deepcopy(operation["value"]))
+        elif op in ("move", "copy"):
+            source = parse_pointer(operation.get("from"))
+            if op == "move":
+                if path[: len(source)] == source and path != source:
+                    raise InvalidPatch("Cannot move a value into itself")
+                value = _remove(document, source)
+                if check is not None:
+                    check(document, source)
+            else:
+                value = copy.deepcopy(_get(document, source))
+            document = _add(document, path, value)
+        elif op == "test":
+            if _get(document, path) != operation["value"]:
+                raise InvalidPatch("Test failed: {}".format(operation["path"]))
+            continue
+        else:
+            raise InvalidPatch("Unknown operation: {!r}".format(op))
+        if check is not None:
+            check(document, path)
+    return document
@@ -1,68 +1,202 @@
 import base64
-import os
-import sqlite3
+import hashlib
+import hmac
+import itertools
 import json
+import os
+import threading
+import time
 from contextlib import closing
-from jsonschema import validate
 
+import flask
 from flask import (
     Flask,
     Response,
     g,
+    jsonify,
+    make_response,
     redirect,
-    render_template,
     request,
     session,
+    url_for,
 )
+from werkzeug.http import http_date, is_resource_modified, quote_etag, unquote_etag
 
-from migrations import hashify
-from model import Polycule
+from migrations import runner
+from model import Polycule, decode_graph
+import backup
+import cache
+import compression
+import jobs
+import metrics
+import passwords
+import patch
+import rendering
+import storage
+import validation
 
 # Config
 DATABASE = "db/prod.db"
 DEBUG = False
 SECRET_KEY = "development key"
+DATABASE_POOL_SIZE = 8
+DATABASE_POOL_TIMEOUT = 10
+DATABASE_BUSY_TIMEOUT = 5000
+DATABASE_CACHE_SIZE = -16000
+DATABASE_MMAP_SIZE = 256 * 1024 * 1024
+DATABASE_WRITE_BATCH = 64
+VIEW_GRANT_LIFETIME = 60 * 60
+VIEW_GRANTS_PER_SESSION = 20
+PASSWORD_WORKERS = 2
+PASSWORD_QUEUE_SIZE = 32
+RENDER_CACHE_SIZE = 64 * 1024 * 1024
+RENDER_CACHE_DIR = None
+RENDER_CACHE_DIR_SIZE = 1024 * 1024 * 1024
+RENDER_WORKERS = 2
+RENDER_QUEUE_SIZE = 8
+RENDER_TIMEOUT = 20
+RENDER_MEMORY_LIMIT = 512 * 1024 * 1024
+CACHE_VERSION = "2"
+CACHE_IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+COMPRESSION_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_LEVEL = 5
+BACKUP_TOKEN = None
+# The longest a client may wait on an export job's status, in seconds
+EXPORT_JOB_WAIT = 30
+# Prometheus metrics at /metrics, for holders of METRICS_TOKEN if it is set.
+# Setting METRICS to False also stops requests and their stages being timed.
+METRICS = True
+METRICS_TOKEN = None
+# Log sampled stacks of requests taking longer than this many seconds
+PROFILE_SLOW_REQUESTS = None
+PROFILE_INTERVAL = 0.005
 
 # App initialization
 app = Flask(__name__)
 app.config.from_object(__name__)
+sampler = None
 
 
 # Database initialization
+def database_options():
+    return {
+        "busy_timeout": app.config["DATABASE_BUSY_TIMEOUT"],
+        "cache_size": app.config["DATABASE_CACHE_SIZE"],
+        "mmap_size": app.config["DATABASE_MMAP_SIZE"],
+    }
+
+
 def connect_db():
-    return sqlite3.connect(app.config["DATABASE"])
+    return storage.connect(app.config["DATABASE"], **database_options())
 
 
-def migrate():
-    migrations_dir = os.path.join(
-        os.path.dirname(os.path.abspath(__file__)), "migrations"
+_pool = None
+_writer = None
+_storage_lock = threading.Lock()
+
+
+def current(resource):
+    return (
+        resource is not None
+        and resource.pid == os.getpid()
+        and resource.database == app.config["DATABASE"]
     )
+
+
+def get_pool():
+    """ This worker's pool of read-only connections, replaced after a fork. """
+    global _pool
+    with _storage_lock:
+        if not current(_pool):
+            _pool = storage.ConnectionPool(
+                app.config["DATABASE"],
+                size=app.config["DATABASE_POOL_SIZE"],
+                timeout=app.config["DATABASE_POOL_TIMEOUT"],
+                readonly=True,
+                **database_options()
+            )
+        return _pool
+
+
+def get_writer():
+    """ This worker's single writer, replaced after a fork. """
+    global _writer
+    with _storage_lock:
+        if not current(_writer):
+            _writer = storage.Writer(
+                app.config["DATABASE"],
+                batch_size=app.config["DATABASE_WRITE_BATCH"],
+                **database_options()
+            )
+        return _writer
+
+
+def get_db():
+    """ The request's database, checked out of the pool on first use.
+
+    Reads go through a read-only connection; writes are queued to the
+    worker's writer.
+    """
+    if "db" not in g:
+        g.db_pool = get_pool()
+        g.db = storage.Database(g.db_pool.acquire(), get_writer())
+    return g.db
+
+
+def release_db():
+    """ Return the request's connection to the pool, e.g. before waiting. """
+    db = g.pop("db", None)
+    if db is not None:
+        g.pop("db_pool").release(db.reader)
+
+
+def configure_sampler(interval):
+    global sampler
+    sampler = metrics.Sampler(interval)
+
+
+# The shared pools and caches, with the config each is built from
+SHARED = [
+    (passwords.configure, ("PASSWORD_WORKERS", "PASSWORD_QUEUE_SIZE")),
+    (
+        cache.configure,
+        ("RENDER_CACHE_SIZE", "RENDER_CACHE_DIR", "RENDER_CACHE_DIR_SIZE"),
+    ),
+    (
+        rendering.configure,
+        (
+            "RENDER_WORKERS",
+            "RENDER_QUEUE_SIZE",
+            "RENDER_TIMEOUT",
+            "RENDER_MEMORY_LIMIT",
+        ),
+    ),
+    (metrics.configure, ("METRICS",)),
+    (configure_sampler, ("PROFILE_INTERVAL",)),
+]
+_configured = {}
+
+
+@app.before_request
+def configure():
+    """ Set up the shared pools and caches from the app config.
+
+    Done before each request rather than on import, so config changed after
+    import is used. Each is only replaced when its config has changed, or in
+    a new worker process, as threads do not survive a fork.
+    """
+    with _storage_lock:
+        for setup, names in SHARED:
+            values = tuple(app.config[name] for name in names)
+            if _configured.get(setup) != (os.getpid(), values):
+                setup(*values)
+                _configured[setup] = (os.getpid(), values)
+
+
+def migrate():
     with closing(connect_db()) as db:
-        try:
-            current_migration = db.execute(
-                """
-                select * from migrations
-            """
-            ).fetchall()[0][0]
-        except sqlite3.OperationalError:
-            # If there was no migrations table, the DB does not exist yet.
-            current_migration = -1
-        for filename in sorted(os.listdir(migrations_dir)):
-            if filename[-3:] != "sql":
-                continue
-            migration_number = int(filename[:3])
-            if migration_number <= current_migration:
-                print("migration {} already applied".format(migration_number))
-                continue
-            with open(os.path.join(migrations_dir, filename), "r") as f:
-                try:
-                    db.cursor().executescript(f.read())
-                except Exception as e:
-                    print("Got {} - maybe already applied?".format(e))
-                finally:
-                    pass
-            if filename[:3] == "003":
-                hashify.migrate(db)
+        runner.migrate(db)
 
 
 def generate_csrf_token():
@@ -74,20 +208,266 @@ def generate_csrf_token():
 app.jinja_env.globals["csrf_token"] = generate_csrf_token
 
 
+# View grants
+#
+# Once a visitor has entered the view password for a polycule, a grant is
+# stored in their (signed) session so that further views and exports skip
+# bcrypt. Grants carry a fingerprint of the stored view password hash, so
+# changing or removing the view password revokes them.
+def view_pass_fingerprint(polycule):
+    return hashlib.sha1(polycule.view_pass.encode("utf-8")).hexdigest()[:16]
+
+
+def has_view_grant(polycule):
+    grant = session.get("view_grants", {}).get(polycule.graph_hash)
+    return (
+        grant is not None
+        and grant[0] > time.time()
+        and grant[1] == view_pass_fingerprint(polycule)
+    )
+
+
+def add_view_grant(polycule):
+    now = time.time()
+    grants = {
+        graph_hash: grant
+        for graph_hash, grant in session.get("view_grants", {}).items()
+        if grant[0] > now
+    }
+    grants[polycule.graph_hash] = [
+        now + app.config["VIEW_GRANT_LIFETIME"],
+        view_pass_fingerprint(polycule),
+    ]
+    # Keep the session cookie small by dropping the grants closest to expiry
+    for graph_hash in sorted(grants, key=lambda h: grants[h][0])[
+        : -app.config["VIEW_GRANTS_PER_SESSION"]
+    ]:
+        del grants[graph_hash]
+    session["view_grants"] = grants
+
+
+def get_polycule(polycule_id):
+    """ Fetch a polycule, checking the posted view password if needed. """
+    polycule = Polycule.get(get_db(), polycule_id, None, force=True)
+    if polycule is None or not polycule.protected or has_view_grant(polycule):
+        return polycule
+    view_pass = request.form.get("view_pass", "")
+    polycule.can_view(view_pass)
+    if view_pass == "" and polycule.view_protected is None:
+        # Saved before view_protected with no view password; say so, so
+        # later views skip bcrypt and may be cached publicly
+        polycule.record_unprotected()
+        return polycule
+    add_view_grant(polycule)
+    return polycule
+
+
+# HTTP caching
+#
+# Responses showing a polycule carry an ETag made from the hash of its graph
+# as it is now and from everything else the response depends on, so saving
+# the polycule changes it. Conditional requests are answered once the row
+# has been read and access checked, before anything is rendered. Bump
+# CACHE_VERSION when templates or renderers change their output.
+#
+# Only unprotected polycules which can never be saved again, requested by
+# their full hash, may be cached for good. Anything else is revalidated on
+# every use, and protected polycules or pages carrying a CSRF token are only
+# ever kept by the visitor's own browser.
+def cache_headers(polycule, polycule_id, *variant, **kwargs):
+    parts = [app.config["CACHE_VERSION"], request.endpoint, polycule.content_hash]
+    if kwargs.get("compress", True):
+        parts.append(str(accepted_encoding()))
+    etag = hashlib.sha1(
+        "\0".join(parts + [str(part) for part in variant]).encode("utf-8")
+    ).hexdigest()
+    if polycule.protected or kwargs.get("private"):
+        cache_control = "private, no-cache"
+    elif len(polycule_id) == 40 and polycule.immutable:
+        cache_control = "public, max-age={:d}, immutable".format(
+            app.config["CACHE_IMMUTABLE_MAX_AGE"]
+        )
+    else:
+        cache_control = "public, no-cache"
+    headers = {"ETag": quote_etag(etag), "Cache-Control": cache_control}
+    if kwargs.get("compress", True):
+        headers["Vary"] = "Accept-Encoding"
+    if polycule.modified is not None:
+        headers["Last-Modified"] = http_date(polycule.modified)
+    return headers
+
+
+def not_modified(headers):
+    """ Whether the request's validators show the client's copy is current. """
+    return request.method in ("GET", "HEAD") and not is_resource_modified(
+        request.environ,
+        etag=unquote_etag(headers["ETag"])[0],
+        last_modified=headers.get("Last-Modified"),
+    )
+
+
+# Compression
+#
+# Text responses of at least COMPRESSION_MIN_SIZE bytes are sent compressed
+# when the client accepts it. Exports keep their compressed copies in the
+# render cache next to the plain ones; pages are compressed as they go out.
+def accepted_encoding():
+    return compression.negotiate(request.accept_encodings)
+
+
+def compression_level(encoding):
+    return app.config["BROTLI_LEVEL" if encoding == "br" else "GZIP_LEVEL"]
+
+
+def export(polycule, fmt, render, mimetype, headers, **options):
+    """ Respond with an export from the cache, compressed if worthwhile. """
+    encoding = accepted_encoding()
+    if encoding is None:
+        return vary(
+            Response(
+                cache.stream(polycule, fmt, render, **options),
+                mimetype=mimetype,
+                headers=headers,
+            )
+        )
+    body = cache.get(polycule, fmt, encoding=encoding, **options)
+    if body is None:
+        chunks = iter(cache.stream(polycule, fmt, render, **options))
+        # Render just enough to tell whether it is worth compressing
+        head, length = [], 0
+        for chunk in chunks:
+            head.append(chunk)
+            length += len(chunk)
+            if length >= app.config["COMPRESSION_MIN_SIZE"]:
+                break
+        else:
+            return vary(Response(b"".join(head), mimetype=mimetype, headers=headers))
+        # The rest is compressed as it is rendered, and cached once it is done
+        body = cache.tee(
+            polycule,
+            fmt,
+            compression.compress_stream(
+                itertools.chain(head, chunks), encoding, compression_level(encoding)
+            ),
+            encoding=encoding,
+            **options
+        )
+    response = Response(body, mimetype=mimetype, headers=headers)
+    response.headers["Content-Encoding"] = encoding
+    return vary(response)
+
+
+def vary(response):
+    # compress_response leaves streamed responses alone, so exports say this
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+# Metrics
+#
+# Every response is timed by route, and the stages within it (lookups,
+# bcrypt, parsing, templates and renders) where they happen. Responses are
+# timed until they are handed to the server, so streamed bodies are not
+# counted. When PROFILE_SLOW_REQUESTS is set, the stacks of requests are
+# sampled as they run, and logged for slow ones in the folded format read
+# by flame graph tools.
+def render_template(template, **context):
+    with metrics.stage("template"):
+        return flask.render_template(template, **context)
+
+
+@app.before_request
+def start_request():
+    g.started = time.perf_counter()
+    if app.config["PROFILE_SLOW_REQUESTS"] is not None:
+        sampler.start()
+        g.profiling = True
+
+
+# Registered ahead of compress_response so that it runs after it
+@app.after_request
+def record_request(response):
+    metrics.observe(
+        metrics.REQUEST_SECONDS,
+        time.perf_counter() - g.started,
+        route=request.endpoint or "none",
+        method=request.method,
+        status=response.status_code,
+    )
+    return response
+
+
+def log_slow_request():
+    samples = sampler.stop()
+    elapsed = time.perf_counter() - g.started
+    if elapsed >= app.config["PROFILE_SLOW_REQUESTS"]:
+        app.logger.warning(
+            "Slow request: %s %s took %.3fs, sampled stacks:\n%s",
+            request.method,
+            request.full_path,
+            elapsed,
+            metrics.folded(samples),
+        )
+
+
+@app.after_request
+def compress_response(response):
+    if (
+        response.status_code != 200
+        or response.mimetype not in compression.COMPRESSIBLE
+        or response.is_streamed
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = accepted_encoding()
+    data = response.get_data()
+    if encoding is None or len(data) < app.config["COMPRESSION_MIN_SIZE"]:
+        return response
+    response.set_data(compression.compress(data, encoding, compression_level(encoding)))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
 @app.before_request
 def before_request():
     if request.method == "POST":
         token = session.pop("_csrf_token", None)
         if not token or token != request.form.get("_csrf_token"):
+            if request.endpoint == "patch_existing_polycule":
+                # The patch client reads JSON, and the next token from it
+                return patch_response(403, error="Token expired")
             return render_template("error.jinja2", error="Token expired :(")
-    g.db = connect_db()
 
 
 @app.teardown_request
 def teardown_request(exception):
-    db = getattr(g, "db", None)
-    if db is not None:
-        db.close()
+    if g.pop("profiling", False):
+        log_slow_request()
+    release_db()
+
+
+@app.errorhandler(passwords.Busy)
+@app.errorhandler(rendering.Busy)
+@app.errorhandler(storage.PoolTimeout)
+def too_busy(exception):
+    response = make_response(
+        render_template(
+            "error.jinja2", error="We're a little busy right now, please try again :("
+        ),
+        503,
+    )
+    response.headers["Retry-After"] = "1"
+    return response
+
+
+@app.errorhandler(rendering.RenderFailed)
+def render_failed(exception):
+    app.logger.warning("Render failed: %s", exception)
+    return (
+        render_template("error.jinja2", error="This polycule could not be rendered :("),
+        500,
+    )
 
 
 # Views
@@ -100,8 +480,8 @@ def front():
 @app.route("/example")
 def example():
     """ View an example polycule. """
-    result = g.db.execute("select * from polycules where id = 1")
-    graph = result.fetchone()[1]
+    result = get_db().execute("select graph from polycules where id = 1")
+    graph = decode_graph(result.fetchone()[0])
     return render_template("embed_polycule.jinja2", graph=graph)
 
 
@@ -109,33 +489,49 @@ def example():
 def view_polycule(polycule_id):
     """ View a polycule. """
     try:
-        polycule = Polycule.get(g.db, polycule_id, request.form.get("view_pass", ""))
+        polycule = get_polycule(polycule_id)
     except Polycule.PermissionDenied:
         return render_template("view_auth.jinja2")
     if polycule is None:
         return render_template("error.jinja2", error="Polycule not found :(")
-    return render_template("view_polycule.jinja2", polycule=polycule)
+    if polycule.edit_pass:
+        # The page carries a delete form, and with it this session's token
+        headers = cache_headers(
+            polycule, polycule_id, generate_csrf_token(), private=True
+        )
+    else:
+        headers = cache_headers(polycule, polycule_id)
+    if not_modified(headers):
+        return Response(status=304, headers=headers)
+    return render_template("view_polycule.jinja2", polycule=polycule), headers
 
 
 @app.route("/<string:polycule_id>.html", methods=["GET", "POST"])
 def view_text_only(polycule_id):
     """ View a polycule. """
     try:
-        polycule = Polycule.get(g.db, polycule_id, request.form.get("view_pass", ""))
+        polycule = get_polycule(polycule_id)
     except Polycule.PermissionDenied:
         return render_template("view_auth.jinja2")
     if polycule is None:
         return render_template("error.jinja2", error="Polycule not found :(")
-    return render_template("text_only.jinja2", content=polycule.as_html())
+    headers = cache_headers(polycule, polycule_id)
+    if not_modified(headers):
+        return Response(status=304, headers=headers)
+    html = cache.get_or_render(polycule, "html", polycule.as_html)
+    return render_template("text_only.jinja2", content=html.decode("utf-8")), headers
 
 
 @app.route("/embed/<string:polycule_id>")
 def embed_polycule(polycule_id):
     """ View just a polycule for embedding in an iframe. """
-    polycule = Polycule.get(g.db, polycule_id, request.form.get("view_pass", ""))
+    polycule = get_polycule(polycule_id)
     if polycule is None:
         return render_template("error.jinja2", error="Polycule not found :(")
-    return render_template("embed_polycule.jinja2", graph=polycule.graph)
+    headers = cache_headers(polycule, polycule_id)
+    if not_modified(headers):
+        return Response(status=304, headers=headers)
+    return render_template("embed_polycule.jinja2", graph=polycule.graph), headers
 
 
 @app.route("/inherit/<string:polycule_id>", methods=["GET", "POST"])
@@ -145,7 +541,7 @@ def inherit_polycule(polycule_id):
     already in place
     """
     try:
-        polycule = Polycule.get(g.db, polycule_id, request.form.get("view_pass", ""))
+        polycule = get_polycule(polycule_id)
     except Polycule.PermissionDenied:
         return render_template("view_auth.jinja2")
     if polycule is None:
@@ -167,7 +563,7 @@ def create_polycule():
 @app.route("/edit/<polycule_id>", methods=["GET", "POST"])
 def edit_polycule(polycule_id):
     # Force, as we're relying on edit pass instead of view pass
-    polycule = Polycule.get(g.db, polycule_id, "", force=True)
+    polycule = Polycule.get(get_db(), polycule_id, "", force=True)
     if request.method == "GET":
         return render_template("edit_auth.jinja2")
     try:
@@ -181,40 +577,98 @@ def edit_polycule(polycule_id):
         )
     session["currently_editing"] = polycule_id
     return render_template(
-        "edit_polycule.jinja2", polycule_id=polycule_id, graph=polycule.graph
+        "edit_polycule.jinja2",
+        polycule_id=polycule_id,
+        graph=polycule.graph,
+        version=polycule.content_hash,
     )
 
 
 @app.route("/edit/save", methods=["POST"])
 def save_existing_polycule():
-    polycule = Polycule.get(g.db, session["currently_editing"], "", force=True)
+    try:
+        parsed = validation.parse(request.form.get("graph"))
+    except validation.InvalidGraph:
+        return render_template(
+            "error.jinja2", error="The submitted graph could not be parsed"
+        )
+    polycule = Polycule.get(get_db(), session["currently_editing"], "", force=True)
     polycule.save(
         request.form.get("graph"),
         request.form.get("view_pass"),
         request.form.get("edit_pass"),
         remove_view_pass=request.form.get("remove_view_pass"),
         remove_edit_pass=request.form.get("remove_edit_pass"),
+        parsed=parsed,
     )
     return redirect("/{}".format(session.pop("currently_editing")))
 
 
+def patch_response(status=200, **data):
+    # The token for this request was used up, so hand out the next one
+    return jsonify(csrf_token=generate_csrf_token(), **data), status
+
+
+@app.route("/edit/patch", methods=["POST"])
+def patch_existing_polycule():
+    """ Apply a JSON patch to the polycule being edited.
+
+    The patch must be made against the version of the graph named by
+    `base`, its content hash; if the polycule was saved since, nothing is
+    applied and the current version is returned with a 409.
+    """
+    if "currently_editing" not in session:
+        return patch_response(403, error="Not editing a polycule")
+    polycule = Polycule.get(get_db(), session["currently_editing"], "", force=True)
+    if polycule is None:
+        return patch_response(404, error="Polycule not found")
+    base = request.form.get("base", "")
+    if base != polycule.content_hash:
+        return patch_response(409, error="Stale base", version=polycule.content_hash)
+    try:
+        operations = json.loads(request.form.get("patch", ""))
+        parsed = patch.apply(
+            json.loads(polycule.graph), operations, validation.check_change
+        )
+    except ValueError as e:
+        return patch_response(400, error="Not valid JSON: {}".format(e))
+    except (patch.InvalidPatch, validation.InvalidGraph) as e:
+        return patch_response(400, error=str(e))
+    try:
+        polycule.save(
+            json.dumps(parsed, separators=(",", ":")),
+            None,
+            None,
+            parsed=parsed,
+            base=base,
+        )
+    except Polycule.StaleGraph:
+        # Another save landed between reading the polycule and writing it
+        current = Polycule.get(get_db(), polycule.graph_hash, "", force=True)
+        return patch_response(
+            409,
+            error="Stale base",
+            version=current.content_hash if current is not None else None,
+        )
+    return patch_response(version=polycule.content_hash)
+
+
 @app.route("/save", methods=["POST"])
 def save_new_polycule():
     """ Save a created polycule. """
     try:
-        with open("schema.json") as json_data:
-            schema = json.load(json_data)
-        validate(json.loads(request.form["graph"]), schema)
-    except Exception:
+        parsed = validation.parse(request.form.get("graph"))
+    except validation.InvalidGraph:
         return render_template(
             "error.jinja2", error="The submitted graph could not be parsed"
         )
     try:
         polycule = Polycule.create(
-            g.db,
+            get_db(),
             request.form["graph"],
             request.form.get("view_pass", ""),
             request.form.get("edit_pass", ""),
+            parsed=parsed,
         )
     except Polycule.IdenticalGraph:
         return render_template(
@@ -226,7 +680,7 @@ def save_new_polycule():
 
 @app.route("/delete/<string:polycule_id>", methods=["POST"])
 def delete_polycule(polycule_id):
-    polycule = Polycule.get(g.db, polycule_id, None, force=True)
+    polycule = Polycule.get(get_db(), polycule_id, None, force=True)
     if polycule is None:
         return render_template("error.jinja2", error="Polycule not found :(")
     try:
@@ -239,7 +693,7 @@ def delete_polycule(polycule_id):
 @app.route("/export/<string:polycule_id>", methods=["GET", "POST"])
 def choose_export(polycule_id):
     try:
-        polycule = Polycule.get(g.db, polycule_id, request.form.get("view_pass", ""))
+        polycule = get_polycule(polycule_id)
     except Polycule.PermissionDenied:
         return render_template("view_auth.jinja2")
     if polycule is None:
@@ -250,30 +704,43 @@ def choose_export(polycule_id):
 @app.route("/export/<string:polycule_id>/polycule.txt", methods=["GET", "POST"])
 def export_text(polycule_id):
     try:
-        polycule = Polycule.get(g.db, polycule_id, request.form.get("view_pass", ""))
+        polycule = get_polycule(polycule_id)
     except Polycule.PermissionDenied:
         return render_template("view_auth.jinja2")
     if polycule is None:
         return render_template("error.jinja2", error="Polycule not found :(")
-    return Response(polycule.as_text(), mimetype="text/plain")
+    headers = cache_headers(polycule, polycule_id)
+    if not_modified(headers):
+        return Response(status=304, headers=headers)
+    return export(polycule, "txt", polycule.iter_text, "text/plain", headers)
 
 
 @app.route("/export/<string:polycule_id>/polycule.dot", methods=["GET", "POST"])
 def export_dot(polycule_id):
     try:
-        polycule = Polycule.get(g.db, polycule_id, request.form.get("view_pass", ""))
+        polycule = get_polycule(polycule_id)
     except Polycule.PermissionDenied:
         return render_template("view_auth.jinja2")
     if polycule is None:
         return render_template("error.jinja2", error="Polycule not found :(")
     labels = request.args.get("link-labels", "") != ""
-    return Response(polycule.as_dot(edge_labels=labels), mimetype="text/plain")
+    headers = cache_headers(polycule, polycule_id, labels)
+    if not_modified(headers):
+        return Response(status=304, headers=headers)
+    return export(
+        polycule,
+        "dot",
+        lambda: polycule.iter_dot(edge_labels=labels),
+        "text/plain",
+        headers,
+        edge_labels=labels,
+    )
 
 
 @app.route("/export/<string:polycule_id>/polycule.svg", methods=["GET", "POST"])
 def export_svg(polycule_id):
     try:
-        polycule = Polycule.get(g.db, polycule_id, request.form.get("view_pass", ""))
+        polycule = get_polycule(polycule_id)
     except Polycule.PermissionDenied:
         return render_template("view_auth.jinja2")
     if polycule is None:
@@ -281,31 +748,324 @@ def export_svg(polycule_id):
     labels = request.args.get("link-labels", "") != ""
     style = request.args.get("style", "") != ""
     embed = request.args.get("embed", "") != ""
-    return Response(
-        polycule.as_svg(edge_labels=labels, include_style=style, embed=embed),
-        mimetype="image/svg+xml",
+    if request.args.get("async", "") != "":
+        return export_job(polycule, "svg", edge_labels=labels, style=style, embed=embed)
+    headers = cache_headers(polycule, polycule_id, labels, style, embed)
+    if not_modified(headers):
+        return Response(status=304, headers=headers)
+    return export(
+        polycule,
+        "svg",
+        lambda: polycule.iter_svg(edge_labels=labels, include_style=style, embed=embed),
+        "image/svg+xml",
+        headers,
+        edge_labels=labels,
+        style=style,
+        embed=embed,
     )
 
 
 @app.route("/export/<string:polycule_id>/polycule.png", methods=["GET", "POST"])
 def export_png(polycule_id):
+    source = request.args.get("from", "dot")
+    if source not in jobs.PNG_SOURCES:
+        return render_template("error.jinja2", error="Unknown PNG source :("), 400
     try:
-        polycule = Polycule.get(g.db, polycule_id, request.form.get("view_pass", ""))
+        polycule = get_polycule(polycule_id)
     except Polycule.PermissionDenied:
         return render_template("view_auth.jinja2")
     if polycule is None:
         return render_template("error.jinja2", error="Polycule not found :(")
     labels = request.args.get("link-labels", "") != ""
-    source = request.args.get("from", "dot")
+    style = request.args.get("style", "") != ""
+    embed = request.args.get("embed", "") != ""
+    if request.args.get("async", "") != "":
+        return export_job(
+            polycule, "png", edge_labels=labels, source=source, style=style, embed=embed
+        )
+    headers = cache_headers(
+        polycule, polycule_id, labels, source, style, embed, compress=False
+    )
+    if not_modified(headers):
+        return Response(status=304, headers=headers)
     if source == "dot":
-        png = polycule.as_png_from_dot(edge_labels=labels)
-    elif source == "svg":
-        style = request.args.get("style", "") != ""
-        embed = request.args.get("embed", "") != ""
-        png = polycule.as_png_from_svg(
-            edge_labels=labels, include_style=style, embed=embed
+        png = cache.get_or_render(
+            polycule,
+            "png",
+            lambda: polycule.as_png_from_dot(edge_labels=labels),
+            edge_labels=labels,
+            source=source,
         )
-    return Response(png, mimetype="image/png")
+    else:
+        png = cache.get_or_render(
+            polycule,
+            "png",
+            lambda: polycule.as_png_from_svg(
+                edge_labels=labels, include_style=style, embed=embed
+            ),
+            edge_labels=labels,
+            style=style,
+            embed=embed,
+            source=source,
+        )
+    return Response(png, mimetype="image/png", headers=headers)
+
+
+# Export jobs
+#
+# With ?async=1, the PNG and SVG exports queue a job for the workers in
+# jobs.py and answer 202 with its id, rather than rendering while the
+# request waits. Clients poll the job's status, optionally waiting on it,
+# then fetch the result. Identical exports share one job.
+def job_response(job, status=200):
+    data = job.as_dict()
+    data["status_url"] = url_for("export_job_status", job_id=job.id)
+    if job.status == jobs.DONE:
+        data["result_url"] = url_for("export_job_result", job_id=job.id)
+    headers = {"Cache-Control": "no-store"}
+    if status == 202:
+        headers["Location"] = data["status_url"]
+    return jsonify(data), status, headers
+
+
+def export_job(polycule, fmt, **options):
+    job_id = jobs.enqueue(get_db(), polycule, fmt, options)
+    return job_response(jobs.get(get_db(), job_id), 202)
+
+
+@app.route("/export/jobs/<string:job_id>")
+def export_job_status(job_id):
+    """ Report on an export job, waiting up to `wait` seconds for it to end. """
+    wait = min(request.args.get("wait", 0, type=float), app.config["EXPORT_JOB_WAIT"])
+    deadline = time.monotonic() + wait
+    job = jobs.get(get_db(), job_id)
+    while (
+        job is not None
+        and job.status in (jobs.QUEUED, jobs.RUNNING)
+        and time.monotonic() < deadline
+    ):
+        # Other requests can use the connection while this one sleeps
+        release_db()
+        time.sleep(0.2)
+        job = jobs.get(get_db(), job_id)
+    if job is None:
+        return jsonify(error="No such export job"), 404
+    return job_response(job)
+
+
+@app.route("/export/jobs/<string:job_id>/result")
+def export_job_result(job_id):
+    found = jobs.result(get_db(), job_id)
+    if found is None:
+        return render_template("error.jinja2", error="Export not found :("), 404
+    data, mimetype = found
+    # A job's result never changes; a new version of the polycule is a new job
+    return Response(
+        data,
+        mimetype=mimetype,
+        headers={"Cache-Control": "private, max-age={:d}".format(jobs.LIFETIME)},
+    )
+
+
+def has_bearer_token(token):
+    authorization = request.headers.get("Authorization", "").encode("utf-8")
+    return hmac.compare_digest(authorization, "Bearer {}".format(token).encode())
+
+
+@app.route("/admin/backup")
+def admin_backup():
+    """ Stream an archive of polycules to holders of BACKUP_TOKEN.
+
+    Takes the same selections as backup.py: `start` and `end` ids, or any
+    number of `hash` arguments, full or prefixes, plus `renders`, `format`
+    and `password_hashes`, without which meta.json leaves out the bcrypt
+    hashes of the view and edit passwords.
+    """
+    token = app.config["BACKUP_TOKEN"]
+    if token is None:
+        return render_template("error.jinja2", error="Not found :("), 404
+    if not has_bearer_token(token):
+        return Response(status=401, headers={"WWW-Authenticate": "Bearer"})
+    fmt = request.args.get("format", "tar.gz")
+    if fmt not in backup.FORMATS:
+        return render_template("error.jinja2", error="Unknown format :("), 400
+    start = request.args.get("start", 0, type=int)
+    end = request.args.get("end", None, type=int)
+    hashes = request.args.getlist("hash") or None
+    renders = request.args.get("renders", "") != ""
+    password_hashes = request.args.get("password_hashes", "") != ""
+    if hashes is not None:
+        try:
+            hashes = backup.resolve(get_db(), hashes)
+        except backup.UnknownHash as e:
+            error = "No single polycule has the hash {} :(".format(e)
+            return render_template("error.jinja2", error=error), 404
+    database = app.config["DATABASE"]
+    options = database_options()
+
+    def generate():
+        # Streaming outlives the request, and with it the request's connection
+        with closing(storage.connect(database, readonly=True, **options)) as db:
+            rows = backup.rows(db, start, end, hashes)
+            entries = backup.entries(rows, renders, password_hashes)
+            for chunk in backup.stream(entries, fmt):
+                yield chunk
+
+    return Response(
+        generate(),
+        mimetype="application/zip" if fmt == "zip" else "application/x-tar",
+        headers={
+            "Content-Disposition": "attachment; filename=polycules.{}".format(fmt),
+            "Cache-Control": "no-store",
+        },
+    )
+
+
+def metric_families():
+    """ The timers' histograms, and the counters kept by the pools and cache. """
+    families = metrics.registry.families()
+    hashing = passwords.pool.stats()
+    renders = rendering.pool.stats()
+    commands = sorted(renders["commands"].items())
+    cached = cache.renders.stats()
+    hits = cached["hits"] + cached["disk_hits"]
+    lookups = hits + cached["misses"]
+    families += [
+        metrics.family(
+            "polycules_bcrypt_total",
+            "counter",
+            "Password hashes and checks finished.",
+            hashing["completed"],
+        ),
+        metrics.family(
+            "polycules_bcrypt_rejected_total",
+            "counter",
+            "Password hashes and checks refused for a full queue.",
+            hashing["rejected"],
+        ),
+        metrics.family(
+            "polycules_bcrypt_queued",
+            "gauge",
+            "Password hashes and checks waiting for a worker.",
+            hashing["queued"],
+        ),
+        metrics.family(
+            "polycules_bcrypt_wait_seconds_total",
+            "counter",
+            "Time password hashes and checks spent waiting for a worker.",
+            hashing["wait_seconds_total"],
+        ),
+        metrics.family(
+            "polycules_renders_total",
+            "counter",
+            "External renders run, by command.",
+            [({"command": name}, stats["renders"]) for name, stats in commands],
+        ),
+        metrics.family(
+            "polycules_render_failures_total",
+            "counter",
+            "External renders which failed or timed out, by command.",
+            [({"command": name}, stats["failures"]) for name, stats in commands],
+        ),
+        metrics.family(
+            "polycules_render_timeouts_total",
+            "counter",
+            "External renders which timed out, by command.",
+            [({"command": name}, stats["timeouts"]) for name, stats in commands],
+        ),
+        metrics.family(
+            "polycules_renders_rejected_total",
+            "counter",
+            "External renders refused for a full queue.",
+            renders["rejected"],
+        ),
+        metrics.family(
+            "polycules_renders_running",
+            "gauge",
+            "External renders running.",
+            renders["running"],
+        ),
+        metrics.family(
+            "polycules_render_cache_requests_total",
+            "counter",
+            "Render cache lookups, by result.",
+            [
+                ({"result": "hit"}, cached["hits"]),
+                ({"result": "disk_hit"}, cached["disk_hits"]),
+                ({"result": "miss"}, cached["misses"]),
+            ],
+        ),
+        metrics.family(
+            "polycules_render_cache_hit_ratio",
+            "gauge",
+            "Share of render cache lookups answered from memory or disk.",
+            hits / lookups if lookups else 0,
+        ),
+        metrics.family(
+            "polycules_render_cache_bytes",
+            "gauge",
+            "Size of the renders held in memory.",
+            cached["bytes"],
+        ),
+    ]
+    # Only once this worker has handled a request needing the database
+    if current(_pool):
+        connections = _pool.stats()
+        families += [
+            metrics.family(
+                "polycules_db_connections",
+                "gauge",
+                "Read-only database connections, by state.",
+                [
+                    ({"state": "idle"}, connections["idle"]),
+                    ({"state": "busy"}, connections["open"] - connections["idle"]),
+                ],
+            ),
+            metrics.family(
+                "polycules_db_pool_timeouts_total",
+                "counter",
+                "Requests which gave up waiting for a database connection.",
+                connections["timeouts"],
+            ),
+        ]
+    if current(_writer):
+        writes = _writer.stats()
+        families += [
+            metrics.family(
+                "polycules_db_writes_queued",
+                "gauge",
+                "Writes waiting for the writer.",
+                writes["queued"],
+            ),
+            metrics.family(
+                "polycules_db_writes_total",
+                "counter",
+                "Writes committed.",
+                writes["writes"],
+            ),
+            metrics.family(
+                "polycules_db_commits_total",
+                "counter",
+                "Commits made by the writer, each of one or more writes.",
+                writes["commits"],
+            ),
+        ]
+    return families
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """ Serve metrics in the Prometheus text format, unless switched off. """
+    if not app.config["METRICS"]:
+        return render_template("error.jinja2", error="Not found :("), 404
+    token = app.config["METRICS_TOKEN"]
+    if token is not None and not has_bearer_token(token):
+        return Response(status=401, headers={"WWW-Authenticate": "Bearer"})
+    return Response(
+        metrics.render(metric_families()),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+        headers={"Cache-Control": "no-store"},
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,374 @@
+""" Draw the SVG that `as_svg` writes straight to PNG, without ImageMagick.
+
+Only what `as_svg` uses is understood: groups with translate and scale
+transforms, lines with dash arrays, circles and text. The stylesheet is not
+read; colours come from STYLES, which follows the one `as_svg` includes,
+or from fill and stroke attributes. Anything else raises `Unsupported`, and
+the caller should fall back to a full renderer. Needs NumPy, which is
+optional; check `available()` first.
+"""
+
+import math
+import re
+import struct
+import time
+import unicodedata
+import zlib
+from xml.etree import ElementTree
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+BACKGROUND = "#fff"
+# Colours per element within each class of group, as in as_svg's stylesheet
+STYLES = {
+    "polycul_es-links": {"line": {"stroke": "#ccc"}},
+    "polycul_es-nodes": {"circle": {"fill": "#888"}, "text": {"fill": "#000"}},
+    "polycul_es-meanings": {"text": {"fill": "#55f"}},
+}
+COMPRESSION_LEVEL = 6
+# The largest picture drawn here, in pixels; as_svg's is 1000x540
+MAX_PIXELS = 4096 * 4096
+
+# A 5x7 font for printable ASCII, five columns per character from the
+# left, the lowest bit of each the top row
+FONT = bytes.fromhex(
+    "000000000000005f00000007000700147f147f14242a7f2a122313086462"
+    "36495522500005030000001c2241000041221c00082a1c2a0808083e0808"
+    "00503000000808080808006060000020100804023e5149453e00427f4000"
+    "42615149462141454b311814127f1027454545393c4a4949300171090503"
+    "3649494936064949291e0036360000005636000000081422411414141414"
+    "41221408000201510906324979413e7e1111117e7f494949363e41414122"
+    "7f4141221c7f494949417f090901013e414151327f0808087f00417f4100"
+    "2040413f017f081422417f404040407f0204027f7f0408107f3e4141413e"
+    "7f090909063e4151215e7f09192946464949493101017f01013f4040403f"
+    "1f2040201f7f2018207f63140814630304780403615149454300007f4141"
+    "020408102041417f00000402010204404040404000010204002054545478"
+    "7f484444383844444420384444487f3854545418087e090102081454543c"
+    "7f0804047800447d40002040443d00007f10284400417f40007c04180478"
+    "7c0804047838444444387c14141408081414187c7c080404084854545420"
+    "043f4440203c4040207c1c2040201c3c4030403c44281028440c5050503c"
+    "4464544c44000836410000007f000000413608000804081008"
+)
+GLYPH_WIDTH = 5
+GLYPH_HEIGHT = 7
+# Shown for characters the font lacks
+MISSING = "?"
+
+_glyphs = None
+
+
+class Unsupported(Exception):
+    """ Raised for SVG this module cannot draw. """
+
+
+def available():
+    return numpy is not None
+
+
+def parse_colour(colour):
+    colour = colour.strip().lower()
+    names = {"black": "#000", "white": "#fff"}
+    colour = names.get(colour, colour)
+    if re.match(r"^#[0-9a-f]{3}$", colour):
+        colour = "#" + "".join(c * 2 for c in colour[1:])
+    if not re.match(r"^#[0-9a-f]{6}$", colour):
+        raise Unsupported("Colour: {!r}".format(colour))
+    return [int(colour[i:i + 2], 16) for i in (1, 3, 5)]
+
+
+def parse_transform(transform):
+    """ Return (scale, x, y) for a list of translate and scale transforms. """
+    pattern = r"\s*(\w+)\s*\(([^)]*)\)\s*,?"
+    if not re.match(r"(?:{})*\s*$".format(pattern), transform):
+        raise Unsupported("Transform: {!r}".format(transform))
+    scale, x, y = 1.0, 0.0, 0.0
+    for name, arguments in re.findall(pattern, transform):
+        try:
+            values = [float(v) for v in re.split(r"[\s,]+", arguments.strip())]
+        except ValueError:
+            raise Unsupported("Transform: {!r}".format(transform))
+        if not all(math.isfinite(v) for v in values):
+            raise Unsupported("Transform: {!r}".format(transform))
+        if name == "translate" and len(values) in (1, 2):
+            x += scale * values[0]
+            y += scale * (values[1] if len(values) == 2 else 0)
+        elif name == "scale" and (len(values) == 1 or values[0] == values[1]):
+            scale *= values[0]
+        else:
+            raise Unsupported("Transform: {!r}".format(transform))
+    return scale, x, y
+
+
+class Canvas(object):
+    """ An RGB picture to draw antialiased shapes on, in pixels. """
+
+    def __init__(self, width, height, background=BACKGROUND, deadline=None):
+        if not 0 < width * height <= MAX_PIXELS:
+            raise Unsupported("Size: {}x{}".format(width, height))
+        self.width = width
+        self.height = height
+        self.deadline = deadline
+        self.pixels = numpy.empty((height, width, 3), dtype=numpy.float32)
+        self.pixels[:] = parse_colour(background)
+
+    def _area(self, left, top, right, bottom):
+        # The pixels in a box, clipped to the canvas, and their centres
+        left, top = max(int(math.floor(left)), 0), max(int(math.floor(top)), 0)
+        right = min(int(math.ceil(right)), self.width)
+        bottom = min(int(math.ceil(bottom)), self.height)
+        if left >= right or top >= bottom:
+            return None
+        x = numpy.arange(left, right, dtype=numpy.float32) + 0.5
+        y = numpy.arange(top, bottom, dtype=numpy.float32)[:, None] + 0.5
+        return (slice(top, bottom), slice(left, right)), x, y
+
+    def _blend(self, area, coverage, colour):
+        region = self.pixels[area]
+        region += (numpy.array(colour, numpy.float32) - region) * coverage[:, :, None]
+
+    def _blend_spans(self, rows, columns, coverage, colour):
+        # As _blend, for scattered pixels rather than a box
+        pixels = self.pixels.reshape(-1, 3)
+        index = rows * self.width + columns
+        region = pixels[index]
+        region += (numpy.array(colour, numpy.float32) - region) * coverage[:, None]
+        pixels[index] = region
+
+    def check_deadline(self):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise TimeoutError("Drawing took too long")
+
+    def circle(self, cx, cy, r, colour):
+        area = self._area(cx - r - 1, cy - r - 1, cx + r + 1, cy + r + 1)
+        if area is None:
+            return
+        area, x, y = area
+        distance = numpy.sqrt((x - cx) ** 2 + (y - cy) ** 2)
+        self._blend(area, numpy.clip(r + 0.5 - distance, 0, 1), colour)
+
+    def line(self, x1, y1, x2, y2, width, colour, dasharray=None):
+        length = math.hypot(x2 - x1, y2 - y1)
+        if length == 0 or width <= 0:
+            return
+        half = width / 2.0
+        top = max(int(math.floor(min(y1, y2) - half - 1)), 0)
+        bottom = min(int(math.ceil(max(y1, y2) + half + 1)), self.height)
+        if top >= bottom:
+            return
+        dx, dy = (x2 - x1) / length, (y2 - y1) / length
+        # Only visit the span of each row the stroke can touch: where its
+        # sides and ends cross the row, each linear in x
+        centres = numpy.arange(top, bottom) + 0.5
+        left = numpy.full(len(centres), -numpy.inf)
+        right = numpy.full(len(centres), numpy.inf)
+        for offset, slope, low, high in (
+            ((centres - y1) * dx + x1 * dy, -dy, -half - 0.5, half + 0.5),
+            ((centres - y1) * dy - x1 * dx, dx, -0.5, length + 0.5),
+        ):
+            if slope == 0:
+                inside = (low <= offset) & (offset <= high)
+                left = numpy.where(inside, left, numpy.inf)
+                right = numpy.where(inside, right, -numpy.inf)
+            else:
+                ends = (low - offset) / slope, (high - offset) / slope
+                left = numpy.maximum(left, numpy.minimum(*ends))
+                right = numpy.minimum(right, numpy.maximum(*ends))
+        start = numpy.clip(numpy.ceil(left - 0.5), 0, self.width).astype(int)
+        stop = numpy.clip(numpy.floor(right - 0.5) + 1, 0, self.width).astype(int)
+        counts = numpy.maximum(stop - start, 0)
+        rows = numpy.repeat(numpy.arange(top, bottom), counts)
+        columns = numpy.arange(counts.sum()) - numpy.repeat(
+            numpy.cumsum(counts) - counts - start, counts
+        )
+        if not len(rows):
+            return
+        x = columns.astype(numpy.float32) + 0.5
+        y = rows.astype(numpy.float32) + 0.5
+        along = (x - x1) * dx + (y - y1) * dy
+        across = numpy.abs((y - y1) * dx - (x - x1) * dy)
+        # Butt ends, as SVG draws lines by default
+        coverage = numpy.clip(half + 0.5 - across, 0, 1)
+        coverage *= numpy.clip(along + 0.5, 0, 1)
+        coverage *= numpy.clip(length - along + 0.5, 0, 1)
+        if dasharray:
+            if len(dasharray) % 2:
+                dasharray = dasharray * 2
+            ends = numpy.cumsum(dasharray)
+            position = numpy.mod(along, ends[-1])
+            coverage *= numpy.searchsorted(ends, position, side="right") % 2 == 0
+        self._blend_spans(rows, columns, coverage, colour)
+
+    def text(self, x, y, text, colour, scale=1.0, anchor="start"):
+        """ Write `text` with its baseline at `y`, scaled up from 5x7 pixels. """
+        mask = _text_mask(text)
+        height = max(int(round(mask.shape[0] * scale)), 1)
+        width = max(int(round(mask.shape[1] * scale)), 1)
+        if anchor == "middle":
+            x -= width / 2.0
+        elif anchor == "end":
+            x -= width
+        top, left = int(round(y)) - height, int(round(x))
+        area = self._area(left, top, left + width, top + height)
+        if area is None:
+            return
+        area = area[0]
+        # Scale only the part that lands on the canvas, however large the text
+        rows = [
+            (row - top) * mask.shape[0] // height
+            for row in range(area[0].start, area[0].stop)
+        ]
+        columns = [
+            (column - left) * mask.shape[1] // width
+            for column in range(area[1].start, area[1].stop)
+        ]
+        self._blend(area, mask[rows][:, columns].astype(numpy.float32), colour)
+
+    def png(self, level=COMPRESSION_LEVEL):
+        return write_png(numpy.rint(self.pixels).astype(numpy.uint8), level)
+
+
+def _text_mask(text):
+    global _glyphs
+    if _glyphs is None:
+        columns = numpy.frombuffer(FONT, dtype=numpy.uint8).reshape(-1, GLYPH_WIDTH)
+        bits = (columns[:, None, :] >> numpy.arange(GLYPH_HEIGHT)[:, None]) & 1
+        _glyphs = bits.astype(bool)
+    # Accents are dropped, so names still read in plain ASCII
+    text = unicodedata.normalize("NFKD", text)
+    codes = [
+        ord(c) - 32 if 32 <= ord(c) < 32 + len(_glyphs) else ord(MISSING) - 32
+        for c in text
+        if not unicodedata.combining(c)
+    ]
+    mask = numpy.zeros((GLYPH_HEIGHT, max(len(codes) * (GLYPH_WIDTH + 1) - 1, 1)), bool)
+    for i, code in enumerate(codes):
+        left = i * (GLYPH_WIDTH + 1)
+        mask[:, left:left + GLYPH_WIDTH] = _glyphs[code]
+    return mask
+
+
+def write_png(pixels, level=COMPRESSION_LEVEL):
+    """ Encode an array of 8-bit RGB rows as a PNG. """
+    height, width, _ = pixels.shape
+
+    def chunk(kind, data):
+        return (
+            struct.pack(">I", len(data))
+            + kind
+            + data
+            + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+        )
+
+    # Each row starts with its filter type, 0 for none
+    rows = numpy.zeros((height, width * 3 + 1), dtype=numpy.uint8)
+    rows[:, 1:] = pixels.reshape(height, width * 3)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(rows.tobytes(), level))
+        + chunk(b"IEND", b"")
+    )
+
+
+def _number(element, name, default=None):
+    value = element.get(name, default)
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        number = math.nan
+    if not math.isfinite(number):
+        raise Unsupported("{} {}={!r}".format(_tag(element), name, value))
+    return number
+
+
+def _tag(element):
+    return element.tag.rsplit("}", 1)[-1]
+
+
+def rasterize(svg, level=COMPRESSION_LEVEL, deadline=None):
+    """ Draw `svg`, as written by `as_svg`, and return it as a PNG.
+
+    Raises TimeoutError if drawing is still going at `deadline`, a
+    `time.monotonic()` value.
+    """
+    try:
+        root = ElementTree.fromstring(svg)
+    except ElementTree.ParseError as e:
+        # Names are written into the SVG as they are and may not be XML
+        raise Unsupported("Not XML: {}".format(e))
+    if _tag(root) != "svg":
+        raise Unsupported("Not SVG")
+    canvas = Canvas(
+        int(_number(root, "width")), int(_number(root, "height")), deadline=deadline
+    )
+    _draw(canvas, root, (1.0, 0.0, 0.0), {})
+    canvas.check_deadline()
+    return canvas.png(level)
+
+
+def _draw(canvas, group, transform, styles):
+    for element in group:
+        canvas.check_deadline()
+        tag = _tag(element)
+        style = dict(styles.get(tag, {}))
+        for name in ("fill", "stroke"):
+            if element.get(name) is not None:
+                style[name] = element.get(name)
+        scale, dx, dy = transform
+        if tag == "g":
+            inner = parse_transform(element.get("transform", ""))
+            inner = (scale * inner[0], dx + scale * inner[1], dy + scale * inner[2])
+            if not all(math.isfinite(v) for v in inner):
+                raise Unsupported("Transform: {!r}".format(element.get("transform")))
+            _draw(
+                canvas,
+                element,
+                inner,
+                STYLES.get(element.get("class"), styles),
+            )
+        elif tag == "line":
+            dasharray = element.get("stroke-dasharray")
+            if dasharray is not None:
+                try:
+                    values = [
+                        scale * float(v) for v in re.split(r"[\s,]+", dasharray.strip())
+                    ]
+                except ValueError:
+                    values = [math.nan]
+                if not all(math.isfinite(v) for v in values):
+                    raise Unsupported("line stroke-dasharray={!r}".format(dasharray))
+                dasharray = values
+            if style.get("stroke", "none") != "none":
+                canvas.line(
+                    dx + scale * _number(element, "x1", 0),
+                    dy + scale * _number(element, "y1", 0),
+                    dx + scale * _number(element, "x2", 0),
+                    dy + scale * _number(element, "y2", 0),
+                    scale * _number(element, "stroke-width", 1),
+                    parse_colour(style["stroke"]),
+                    dasharray,
+                )
+        elif tag == "circle":
+            if style.get("fill", "black") != "none":
+                canvas.circle(
+                    dx + scale * _number(element, "cx", 0),
+                    dy + scale * _number(element, "cy", 0),
+                    scale * _number(element, "r", 0),
+                    parse_colour(style.get("fill", "black")),
+                )
+        elif tag == "text":
+            if style.get("fill", "black") != "none":
+                canvas.text(
+                    dx + scale * _number(element, "x", 0),
+                    dy + scale * _number(element, "y", 0),
+                    "".join(element.itertext()).strip(),
+                    parse_colour(style.get("fill", "black")),
+                    scale,
+                    element.get("text-anchor", "start"),
+                )
+        elif tag not in ("style", "title", "desc"):
+            raise Unsupported("Element: {}".format(tag))
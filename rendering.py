@@ -0,0 +1,211 @@
+import contextlib
+import logging
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import metrics
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+log = logging.getLogger(__name__)
+
+# Caps the address space of a fresh interpreter, which then becomes the
+# renderer; for where prlimit is not installed
+LIMIT_MEMORY = (
+    "import os, resource, sys; "
+    "limit = int(sys.argv[1]); "
+    "resource.setrlimit(resource.RLIMIT_AS, (limit, limit)); "
+    "os.execvp(sys.argv[2], sys.argv[2:])"
+)
+
+
+class Busy(Exception):
+    """ Raised when too many renders are already running or queued. """
+
+
+class RenderFailed(Exception):
+    """ Raised when a renderer exits badly, runs out of time or memory. """
+
+
+class RenderPool(object):
+    """ Runs external renderers such as neato and convert with limits.
+
+    At most `workers` renders run at once; up to `queue_size` more wait for
+    a slot for at most `timeout` seconds, and anything beyond that fails
+    fast with `Busy`. Each render gets its input on stdin and returns its
+    stdout, is killed after `timeout` seconds, and has its address space
+    capped at `memory_limit` bytes, by prlimit(1) or else a small Python
+    wrapper; where neither can, a warning is logged once.
+    Renderers that run in this process, such as rasterizing, take the same
+    slots through `call`.
+    """
+
+    def __init__(self, workers=2, queue_size=8, timeout=20, memory_limit=None):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self._limiter = self._find_limiter()
+        self._slots = threading.BoundedSemaphore(workers)
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._running = 0
+        self._rejected = 0
+        self._commands = {}
+
+    def run(self, command, data):
+        with self._slot():
+            return self._render(command, data)
+
+    def call(self, name, function, *args):
+        """ Run `function(*args)` in this process, taking a slot like `run`.
+
+        It is passed a `deadline` keyword, the `time.monotonic()` after which
+        it should give up by raising TimeoutError. There is no memory limit,
+        so it should keep its own use bounded.
+        """
+        with self._slot():
+            with self._lock:
+                self._running += 1
+            start = time.monotonic()
+            timed_out = False
+            try:
+                return function(*args, deadline=start + self.timeout)
+            except TimeoutError:
+                timed_out = True
+                raise RenderFailed("{} timed out".format(name))
+            finally:
+                self._record(name, time.monotonic() - start, timed_out, timed_out)
+
+    @contextlib.contextmanager
+    def _slot(self):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if self._waiting >= self.queue_size:
+                    self._rejected += 1
+                    raise Busy
+                self._waiting += 1
+            try:
+                acquired = self._slots.acquire(timeout=self.timeout)
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+            if not acquired:
+                with self._lock:
+                    self._rejected += 1
+                raise Busy
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    def _render(self, command, data):
+        with self._lock:
+            self._running += 1
+        start = time.monotonic()
+        failed = timed_out = False
+        try:
+            result = subprocess.run(
+                self._limited(command),
+                input=data,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                timeout=self.timeout,
+            )
+            if result.returncode != 0:
+                failed = True
+                raise RenderFailed(
+                    "{} exited with {}: {}".format(
+                        command[0],
+                        result.returncode,
+                        result.stderr.decode("utf-8", "replace").strip(),
+                    )
+                )
+            return result.stdout
+        except subprocess.TimeoutExpired:
+            failed = timed_out = True
+            raise RenderFailed("{} timed out".format(command[0]))
+        except OSError as e:
+            failed = True
+            raise RenderFailed("{} could not be run: {}".format(command[0], e))
+        finally:
+            self._record(command[0], time.monotonic() - start, failed, timed_out)
+
+    def _record(self, name, duration, failed, timed_out):
+        metrics.observe(metrics.STAGE_SECONDS, duration, stage=name)
+        with self._lock:
+            self._running -= 1
+            stats = self._commands.setdefault(
+                name,
+                {
+                    "renders": 0,
+                    "failures": 0,
+                    "timeouts": 0,
+                    "seconds_total": 0.0,
+                    "seconds_max": 0.0,
+                },
+            )
+            stats["renders"] += 1
+            stats["failures"] += failed
+            stats["timeouts"] += timed_out
+            stats["seconds_total"] += duration
+            stats["seconds_max"] = max(stats["seconds_max"], duration)
+
+    def _find_limiter(self):
+        # Setting the limit in a preexec_fn is not safe with threads about,
+        # so another program sets it and then runs the renderer in its place
+        if not self.memory_limit:
+            return None
+        prlimit = shutil.which("prlimit")
+        if prlimit is not None:
+            return [prlimit, "--as={:d}".format(self.memory_limit), "--"]
+        if resource is not None:
+            return [sys.executable, "-c", LIMIT_MEMORY, str(self.memory_limit)]
+        log.warning(
+            "Renderers will run without a memory limit, as it cannot be set here"
+        )
+        return None
+
+    def _limited(self, command):
+        if self._limiter is None:
+            return command
+        return self._limiter + command
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "queued": self._waiting,
+                "running": self._running,
+                "rejected": self._rejected,
+                "commands": {name: dict(s) for name, s in self._commands.items()},
+            }
+
+
+pool = RenderPool()
+
+
+def configure(workers, queue_size, timeout, memory_limit=None):
+    """ Replace the shared pool, e.g. with limits from the app config. """
+    global pool
+    pool = RenderPool(
+        workers=workers,
+        queue_size=queue_size,
+        timeout=timeout,
+        memory_limit=memory_limit,
+    )
+
+
+def run(command, data):
+    return pool.run(command, data)
+
+
+def call(name, function, *args):
+    return pool.call(name, function, *args)
@@ -0,0 +1,277 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+
+
+class PoolTimeout(Exception):
+    """ Raised when no connection frees up in time. """
+
+
+def connect(
+    database,
+    busy_timeout=5000,
+    cache_size=-16000,
+    mmap_size=256 * 1024 * 1024,
+    readonly=False,
+):
+    """ Open a connection to the database with our pragmas applied.
+
+    `busy_timeout` is in milliseconds; a negative `cache_size` is in KiB.
+    WAL lets readers carry on while a write is committed, and with WAL,
+    synchronous=normal is still safe against corruption. Read-only
+    connections rely on a writable connection having switched on WAL,
+    which the database file then remembers.
+    """
+    if readonly:
+        db = sqlite3.connect(
+            "file:{}?mode=ro".format(database),
+            timeout=busy_timeout / 1000.0,
+            check_same_thread=False,
+            uri=True,
+        )
+    else:
+        db = sqlite3.connect(
+            database, timeout=busy_timeout / 1000.0, check_same_thread=False
+        )
+    db.execute("pragma busy_timeout = {:d}".format(busy_timeout))
+    if not readonly:
+        db.execute("pragma journal_mode = wal")
+        db.execute("pragma synchronous = normal")
+    db.execute("pragma cache_size = {:d}".format(cache_size))
+    db.execute("pragma mmap_size = {:d}".format(mmap_size))
+    return db
+
+
+class ConnectionPool(object):
+    """ Up to `size` connections, opened as they are first needed.
+
+    Connections are handed out most recently used first, so a quiet worker
+    keeps reusing one warm connection. When all of them are checked out,
+    callers wait up to `timeout` seconds before `PoolTimeout` is raised.
+    A pool belongs to the process that created it; see `pid`.
+    """
+
+    def __init__(self, database, size=8, timeout=10, **options):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.options = options
+        self.pid = os.getpid()
+        self._idle = []
+        self._open = 0
+        self._cond = threading.Condition()
+        self._acquired = 0
+        self._timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def acquire(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        db = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    db = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout
+                self._cond.wait(remaining)
+            wait = time.monotonic() - start
+            self._acquired += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+        metrics.observe(metrics.POOL_WAIT_SECONDS, wait)
+        if db is None:
+            try:
+                db = connect(self.database, **self.options)
+            except Exception:
+                self._discard()
+                raise
+        return db
+
+    def release(self, db):
+        try:
+            if db.in_transaction:
+                db.rollback()
+        except sqlite3.Error:
+            db.close()
+            self._discard()
+            return
+        with self._cond:
+            self._idle.append(db)
+            self._cond.notify()
+
+    def _discard(self):
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            for db in self._idle:
+                db.close()
+            self._open -= len(self._idle)
+            self._idle = []
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self.size,
+                "open": self._open,
+                "idle": len(self._idle),
+                "acquired": self._acquired,
+                "timeouts": self._timeouts,
+                "wait_seconds_total": self._wait_total,
+                "wait_seconds_max": self._wait_max,
+            }
+
+
+class Writer(object):
+    """ Funnels every write from this process through one connection.
+
+    Writes are functions taking a connection, queued to a single thread.
+    That thread runs whatever has queued up, up to `batch_size` writes, in
+    one short transaction with a savepoint around each write, and commits
+    them together: a burst of writes costs one commit instead of one each,
+    and a failing write only rolls back itself. Writes must not commit.
+    """
+
+    def __init__(self, database, batch_size=64, **options):
+        self.database = database
+        self.batch_size = batch_size
+        self.options = options
+        self.pid = os.getpid()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._commits = 0
+        self._writes = 0
+
+    def write(self, fn):
+        future = Future()
+        self._queue.put((fn, future))
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="sqlite-writer", daemon=True
+                )
+                self._thread.start()
+        return future.result()
+
+    def close(self):
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+
+    def _run(self):
+        db = None
+        try:
+            while True:
+                job = self._queue.get()
+                if job is None:
+                    return
+                jobs = [job]
+                while len(jobs) < self.batch_size:
+                    try:
+                        job = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        self._queue.put(None)
+                        break
+                    jobs.append(job)
+                if db is None:
+                    try:
+                        db = connect(self.database, **self.options)
+                    except Exception as e:
+                        for fn, future in jobs:
+                            future.set_exception(e)
+                        continue
+                    db.isolation_level = None
+                self._commit(db, jobs)
+        finally:
+            if db is not None:
+                db.close()
+
+    def _commit(self, db, jobs):
+        results = []
+        try:
+            db.execute("begin immediate")
+            for fn, future in jobs:
+                db.execute("savepoint write")
+                try:
+                    results.append((future, fn(db), None))
+                    db.execute("release write")
+                except Exception as e:
+                    db.execute("rollback to write")
+                    db.execute("release write")
+                    results.append((future, None, e))
+            db.execute("commit")
+        except Exception as e:
+            if db.in_transaction:
+                db.execute("rollback")
+            for fn, future in jobs:
+                future.set_exception(e)
+            return
+        with self._lock:
+            self._commits += 1
+            self._writes += len(jobs)
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self._queue.qsize(),
+                "commits": self._commits,
+                "writes": self._writes,
+            }
+
+
+class Database(object):
+    """ A request's view of the database: reads go to `reader`, a read-only
+    connection, and writes are handed to the process's `writer`.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def execute(self, *args):
+        return self.reader.execute(*args)
+
+    def write(self, fn):
+        return self.writer.write(fn)
+
+
+def write(db, fn):
+    """ Run `fn` as a write against `db` and commit it.
+
+    `db` is either a `Database`, whose writer batches the commit, or a plain
+    connection as used by scripts and migrations.
+    """
+    if isinstance(db, Database):
+        return db.write(fn)
+    try:
+        result = fn(db)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    return result
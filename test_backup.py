@@ -0,0 +1,111 @@
+import io
+import json
+import os
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+import zipfile
+from unittest import TestCase, mock
+
+import backup
+import model
+from test_model import GRAPH, make_db
+
+
+class TestBackup(TestCase):
+    def setUp(self):
+        self.db = make_db()
+        self.polycules = [
+            model.Polycule.create(self.db, graph, None, None)
+            for graph in [GRAPH, '{"nodes": [], "links": []}', '{"nodes": 1}']
+        ]
+
+    def archive(self, fmt="tar.gz"):
+        rows = backup.rows(self.db, batch_size=2)
+        return b"".join(backup.stream(backup.entries(rows), fmt))
+
+    def test_tar(self):
+        data = self.archive()
+        with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+            names = archive.getnames()
+            graph = archive.extractfile(
+                "{}/graph.json".format(self.polycules[0].graph_hash)
+            ).read()
+        self.assertEqual(len(names), 6)
+        self.assertEqual(json.loads(graph), json.loads(GRAPH))
+
+    def test_zip(self):
+        data = self.archive("zip")
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            meta = json.loads(
+                archive.read("{}/meta.json".format(self.polycules[1].graph_hash))
+            )
+        self.assertEqual(meta["id"], self.polycules[1].id)
+
+    def test_selection(self):
+        rows = list(backup.rows(self.db, start_id=1, end_id=2))
+        self.assertEqual([row[0] for row in rows], [2])
+        graph_hash = self.polycules[2].graph_hash
+        hashes = backup.resolve(self.db, [graph_hash.upper()[:7], graph_hash])
+        self.assertEqual(hashes, [graph_hash])
+        rows = list(backup.rows(self.db, hashes=hashes))
+        self.assertEqual([row[2] for row in rows], [graph_hash])
+
+    def test_unknown_hash(self):
+        for graph_hash in ("f" * 40, "abc", self.polycules[0].graph_hash[:6]):
+            with self.assertRaises(backup.UnknownHash):
+                backup.resolve(self.db, [self.polycules[1].graph_hash, graph_hash])
+
+    def test_password_hashes(self):
+        polycule = model.Polycule.create(self.db, '{"a": 1}', "view", "edit")
+        rows = backup.rows(self.db, hashes=[polycule.graph_hash])
+        meta = json.loads(next(backup.entries(rows))[1])
+        self.assertNotIn("view_pass", meta)
+        self.assertNotIn("delete_pass", meta)
+        rows = backup.rows(self.db, hashes=[polycule.graph_hash])
+        meta = json.loads(next(backup.entries(rows, password_hashes=True))[1])
+        self.assertTrue(meta["view_pass"].startswith("$2"))
+        self.assertIsNotNone(meta["delete_pass"])
+
+    def test_renders(self):
+        entries = dict(
+            (name, data)
+            for name, data, mtime in backup.entries(backup.rows(self.db), True)
+        )
+        prefix = self.polycules[0].graph_hash + "/"
+        self.assertEqual(
+            entries[prefix + "polycule.svg"], self.polycules[0].as_svg().encode()
+        )
+        self.assertIn(self.polycules[2].graph_hash + "/polycule.txt.error", entries)
+
+    def test_streamed(self):
+        for fmt in backup.FORMATS:
+            entries = ((str(i), os.urandom(5000), 0) for i in range(100))
+            chunks = list(backup.stream(entries, fmt))
+            self.assertGreater(len(chunks), 10)
+            self.assertLess(max(len(chunk) for chunk in chunks), 64 * 1024)
+
+
+class TestMain(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.database = os.path.join(self.tmpdir, "test.db")
+        db = make_db()
+        model.Polycule.create(db, GRAPH, None, None)
+        db.backup(sqlite3.connect(self.database))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_main(self):
+        output = os.path.join(self.tmpdir, "backup.zip")
+        self.assertEqual(
+            backup.main(["--database", self.database, "--output", output]), 0
+        )
+        with zipfile.ZipFile(output) as archive:
+            self.assertEqual(len(archive.namelist()), 2)
+
+    def test_unknown_hash(self):
+        with self.assertRaises(SystemExit), mock.patch("sys.stderr"):
+            backup.main(["--database", self.database, "--hash", "f" * 7])
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+from contextlib import closing
+from unittest import TestCase
+
+import model
+import storage
+from benchmarks import database, load, suite
+
+
+class TestMakeDatabase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "bench.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_rows_can_be_looked_up(self):
+        hashes = database.make_database(
+            self.path, 50, protected=0.5, batch_size=20, log=lambda message: None
+        )
+        more = database.make_database(self.path, 10, log=lambda message: None)
+        self.assertEqual(len(set(hashes + more)), 60)
+        with closing(storage.connect(self.path)) as db:
+            for graph_hash in hashes[:5] + more[:5]:
+                polycule = model.Polycule.get(db, graph_hash[:7], None, force=True)
+                self.assertEqual(polycule.graph_hash, graph_hash)
+                self.assertEqual(
+                    model.Polycule.get(db, graph_hash, None, force=True).id, polycule.id
+                )
+            (protected,) = db.execute(
+                "select count(*) from polycules where view_pass is not null"
+            ).fetchone()
+        self.assertTrue(0 < protected < 60)
+
+
+class TestLoad(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "load.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parse_mix(self):
+        self.assertEqual(
+            load.parse_mix("view=3,save=0.5,embed"),
+            [("view", 3), ("save", 0.5), ("embed", 1)],
+        )
+        with self.assertRaises(ValueError):
+            load.parse_mix("view=1,delete=1")
+
+    def test_summary(self):
+        row = load.summary("view", [i / 100.0 for i in range(100, 0, -1)], 5, 10)
+        self.assertEqual((row["p50"], row["p99"], row["max"]), (0.5, 0.99, 1.0))
+        self.assertEqual((row["error_rate"], row["throughput"]), (0.05, 10))
+
+    def test_run(self):
+        database.make_database(self.path, 20, protected=0, log=lambda message: None)
+        url, processes = load.serve(self.path, 1)
+        try:
+            stats, elapsed = load.run(
+                url,
+                load.Targets.from_database(self.path),
+                [("view", 1), ("embed", 1), ("protected", 1)],
+                rate=20,
+                duration=0.5,
+                users=4,
+            )
+        finally:
+            for process in processes:
+                process.terminate()
+        rows = {row["endpoint"]: row for row in stats.report(elapsed)}
+        # With nothing protected in the database, those views are left out
+        self.assertEqual(set(rows), {"view", "embed", "all"})
+        self.assertEqual((rows["all"]["requests"], rows["all"]["errors"]), (10, 0))
+
+
+class TestCompare(TestCase):
+    def result(self, name, best, **params):
+        return {"name": name, "params": params, "best": best}
+
+    def test_regressions(self):
+        old = {
+            "results": [
+                self.result("as_svg", 1.0, nodes=10),
+                self.result("as_svg", 1.0, nodes=100),
+                self.result("as_dot", 1.0, nodes=10),
+            ]
+        }
+        new = {
+            "results": [
+                self.result("as_svg", 1.2, nodes=10),
+                self.result("as_svg", 2.0, nodes=100),
+                self.result("as_text", 9.0, nodes=10),
+            ]
+        }
+        self.assertEqual(
+            suite.compare(old, new, threshold=1.25),
+            [("as_svg", "nodes=100", 1.0, 2.0)],
+        )
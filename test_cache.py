@@ -0,0 +1,158 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import cache
+from model import Polycule
+
+
+class Renderer(object):
+    def __init__(self, value):
+        self.value = value
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.value
+
+
+class TestRenderCache(TestCase):
+    def setUp(self):
+        self.polycule = Polycule(graph='{"a": 1}', graph_hash="a" * 40)
+
+    def test_hit(self):
+        renders = cache.RenderCache()
+        render = Renderer("graph polycule {}")
+        for _ in range(2):
+            value = renders.get_or_render(self.polycule, "dot", render, labels=False)
+        self.assertEqual(value, b"graph polycule {}")
+        self.assertEqual(render.calls, 1)
+        renders.get_or_render(self.polycule, "dot", render, labels=True)
+        self.assertEqual(render.calls, 2)
+
+    def test_content_change(self):
+        renders = cache.RenderCache()
+        render = Renderer("x")
+        renders.get_or_render(self.polycule, "txt", render)
+        self.polycule.graph = '{"a": 2}'
+        renders.get_or_render(self.polycule, "txt", render)
+        self.assertEqual(render.calls, 2)
+
+    def test_eviction(self):
+        renders = cache.RenderCache(max_bytes=10)
+        first, second = Renderer(b"x" * 6), Renderer(b"y" * 6)
+        renders.get_or_render(self.polycule, "a", first)
+        renders.get_or_render(self.polycule, "b", second)
+        renders.get_or_render(self.polycule, "a", first)
+        self.assertEqual(first.calls, 2)
+        self.assertLessEqual(renders.stats()["bytes"], 10)
+
+    def test_get_and_put(self):
+        renders = cache.RenderCache()
+        self.assertIsNone(renders.get(self.polycule, "txt", encoding="gzip"))
+        renders.put(self.polycule, "txt", b"x", encoding="gzip")
+        self.assertEqual(renders.get(self.polycule, "txt", encoding="gzip"), b"x")
+        self.assertIsNone(renders.get(self.polycule, "txt"))
+
+    def test_invalidate(self):
+        renders = cache.RenderCache()
+        render = Renderer("x")
+        renders.get_or_render(self.polycule, "txt", render)
+        renders.invalidate(self.polycule.graph_hash)
+        renders.get_or_render(self.polycule, "txt", render)
+        self.assertEqual(render.calls, 2)
+
+
+class TestDiskTier(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.polycule = Polycule(graph='{"a": 1}', graph_hash="a" * 40)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_shared_between_caches(self):
+        render = Renderer("x")
+        cache.RenderCache(directory=self.directory).get_or_render(
+            self.polycule, "svg", render, embed=True
+        )
+        renders = cache.RenderCache(directory=self.directory)
+        self.assertEqual(
+            renders.get_or_render(self.polycule, "svg", render, embed=True), b"x"
+        )
+        self.assertEqual(render.calls, 1)
+        self.assertEqual(renders.stats()["disk_hits"], 1)
+        renders.invalidate(self.polycule.graph_hash)
+        cache.RenderCache(directory=self.directory).get_or_render(
+            self.polycule, "svg", render, embed=True
+        )
+        self.assertEqual(render.calls, 2)
+
+    def test_disk_limit(self):
+        renders = cache.RenderCache(directory=self.directory, max_disk_bytes=250)
+        for fmt in ("a", "b"):
+            renders.put(self.polycule, fmt, b"x" * 100)
+        os.utime(renders._path(renders._key(self.polycule, "a", {})), (0, 0))
+        os.utime(renders._path(renders._key(self.polycule, "b", {})), (1, 1))
+        # Reading "a" from disk marks it as the most recently used
+        self.assertEqual(
+            cache.RenderCache(directory=self.directory).get(self.polycule, "a"),
+            b"x" * 100,
+        )
+        renders.put(self.polycule, "c", b"x" * 100)
+        fresh = cache.RenderCache(directory=self.directory)
+        self.assertIsNone(fresh.get(self.polycule, "b"))
+        self.assertIsNotNone(fresh.get(self.polycule, "a"))
+        self.assertIsNotNone(fresh.get(self.polycule, "c"))
+
+    def test_pruned_when_started(self):
+        cache.RenderCache(directory=self.directory).put(
+            self.polycule, "a", b"x" * 100
+        )
+        renders = cache.RenderCache(directory=self.directory, max_disk_bytes=50)
+        renders.put(self.polycule, "b", b"y" * 10)
+        self.assertIsNone(renders.get(self.polycule, "a"))
+        self.assertEqual(os.listdir(self.directory), [self.polycule.graph_hash])
+
+
+class TestStream(TestCase):
+    def setUp(self):
+        self.polycule = Polycule(graph='{"a": 1}', graph_hash="a" * 40)
+
+    def test_stream(self):
+        renders = cache.RenderCache()
+        render = Renderer(["ab", "cd"])
+        stream = renders.stream(self.polycule, "dot", render)
+        self.assertEqual(list(stream), [b"ab", b"cd"])
+        stream = renders.stream(self.polycule, "dot", render)
+        self.assertEqual(list(stream), [b"abcd"])
+        self.assertEqual(render.calls, 1)
+
+    def test_too_big_to_keep(self):
+        renders = cache.RenderCache(max_bytes=3)
+        render = Renderer(["ab", "cd"])
+        for _ in range(2):
+            stream = renders.stream(self.polycule, "dot", render)
+            self.assertEqual(b"".join(stream), b"abcd")
+        self.assertEqual(render.calls, 2)
+
+    def test_tee(self):
+        renders = cache.RenderCache()
+        chunks = renders.tee(self.polycule, "svg", iter([b"a", b"b"]), encoding="gzip")
+        self.assertIsNone(renders.get(self.polycule, "svg", encoding="gzip"))
+        self.assertEqual(list(chunks), [b"a", b"b"])
+        self.assertEqual(renders.get(self.polycule, "svg", encoding="gzip"), b"ab")
+
+    def test_abandoned_stream(self):
+        directory = tempfile.mkdtemp()
+        try:
+            renders = cache.RenderCache(directory=directory)
+            render = Renderer(["ab", "cd"])
+            chunks = renders.stream(self.polycule, "dot", render)
+            next(chunks)
+            chunks.close()
+            renders.stream(self.polycule, "dot", render)
+            self.assertEqual(render.calls, 2)
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,47 @@
+import gzip
+from unittest import TestCase, mock
+
+from werkzeug.http import parse_accept_header
+
+import compression
+
+
+class TestNegotiate(TestCase):
+    def negotiate(self, header):
+        return compression.negotiate(parse_accept_header(header))
+
+    def test_gzip(self):
+        self.assertEqual(self.negotiate("gzip, deflate"), "gzip")
+
+    def test_refused(self):
+        self.assertIsNone(self.negotiate("gzip;q=0"))
+        self.assertIsNone(self.negotiate("identity"))
+        self.assertIsNone(self.negotiate(""))
+
+    def test_brotli_preferred(self):
+        with mock.patch("compression.ENCODINGS", ["br", "gzip"]):
+            self.assertEqual(self.negotiate("gzip, br"), "br")
+            self.assertEqual(self.negotiate("gzip, br;q=0.5"), "gzip")
+
+
+class TestCompress(TestCase):
+    def test_gzip(self):
+        data = b"graph polycule {}" * 100
+        compressed = compression.compress(data, "gzip", 6)
+        self.assertEqual(gzip.decompress(compressed), data)
+        # Stable output keeps cached copies and their ETags consistent
+        self.assertEqual(compression.compress(data, "gzip", 6), compressed)
+
+    def test_unsupported(self):
+        with self.assertRaises(ValueError):
+            compression.compress(b"", "deflate", 6)
+
+    def test_stream(self):
+        chunks = [b"graph polycule {}" * 100, b"", b"node1 -- node2" * 50]
+        compressed = b"".join(compression.compress_stream(chunks, "gzip", 6))
+        self.assertEqual(gzip.decompress(compressed), b"".join(chunks))
+        self.assertEqual(
+            b"".join(compression.compress_stream(iter(chunks), "gzip", 6)), compressed
+        )
+        with self.assertRaises(ValueError):
+            list(compression.compress_stream(chunks, "deflate", 6))
@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+from contextlib import closing
+from unittest import TestCase, mock
+
+import jobs
+import model
+import storage
+from migrations import runner
+from test_model import GRAPH, make_db
+
+
+SVG = {"edge_labels": False, "style": False, "embed": True}
+
+
+class TestQueue(TestCase):
+    def setUp(self):
+        self.db = make_db()
+        self.polycule = model.Polycule.create(self.db, GRAPH, None, None)
+
+    def test_identical_exports_share_a_job(self):
+        job_id = jobs.enqueue(self.db, self.polycule, "svg", SVG)
+        self.assertEqual(jobs.enqueue(self.db, self.polycule, "svg", dict(SVG)), job_id)
+        other = jobs.enqueue(self.db, self.polycule, "svg", dict(SVG, embed=False))
+        self.assertNotEqual(other, job_id)
+        self.assertEqual(jobs.get(self.db, job_id).status, jobs.QUEUED)
+        self.assertEqual(jobs.get(self.db, job_id).options, SVG)
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            jobs.enqueue(self.db, self.polycule, "gif", {})
+        with self.assertRaises(ValueError):
+            jobs.enqueue(self.db, self.polycule, "png", dict(SVG, source="bogus"))
+
+    def test_claim_oldest_first(self):
+        first = jobs.enqueue(self.db, self.polycule, "svg", SVG)
+        jobs.enqueue(self.db, self.polycule, "svg", dict(SVG, embed=False))
+        job = jobs.claim(self.db)
+        self.assertEqual((job.id, job.status, job.attempts), (first, jobs.RUNNING, 1))
+        self.assertNotEqual(jobs.claim(self.db).id, first)
+        self.assertIsNone(jobs.claim(self.db))
+
+    def test_stale_job_taken_over(self):
+        job_id = jobs.enqueue(self.db, self.polycule, "svg", SVG)
+        jobs.claim(self.db, now=1000)
+        self.assertIsNone(jobs.claim(self.db, now=1000 + jobs.STALE_AFTER - 1))
+        self.assertEqual(jobs.claim(self.db, now=1001 + jobs.STALE_AFTER).id, job_id)
+
+    def test_gives_up(self):
+        job_id = jobs.enqueue(self.db, self.polycule, "svg", SVG)
+        now = 1000
+        for _ in range(jobs.MAX_ATTEMPTS):
+            self.assertEqual(jobs.claim(self.db, now=now).id, job_id)
+            now += jobs.STALE_AFTER + 1
+        self.assertIsNone(jobs.claim(self.db, now=now))
+        self.assertEqual(jobs.get(self.db, job_id).status, jobs.FAILED)
+
+    def test_run(self):
+        job_id = jobs.enqueue(self.db, self.polycule, "svg", SVG)
+        jobs.run(self.db, jobs.claim(self.db))
+        self.assertEqual(jobs.get(self.db, job_id).status, jobs.DONE)
+        data, mimetype = jobs.result(self.db, job_id)
+        self.assertEqual(data.decode("utf-8"), self.polycule.as_svg(embed=True))
+        self.assertEqual(mimetype, "image/svg+xml")
+
+    def test_failed_render_queued_again(self):
+        job_id = jobs.enqueue(self.db, self.polycule, "png", dict(SVG, source="dot"))
+        with mock.patch("rendering.run", side_effect=OSError("no neato")):
+            jobs.run(self.db, jobs.claim(self.db))
+        job = jobs.get(self.db, job_id)
+        self.assertEqual((job.status, job.error), (jobs.FAILED, "no neato"))
+        self.assertIsNone(jobs.result(self.db, job_id))
+        jobs.enqueue(self.db, self.polycule, "png", dict(SVG, source="dot"))
+        self.assertEqual(jobs.get(self.db, job_id).status, jobs.QUEUED)
+
+    def test_changed_polycule(self):
+        job_id = jobs.enqueue(self.db, self.polycule, "svg", SVG)
+        job = jobs.claim(self.db)
+        self.polycule.save('{"nodes": [], "links": []}', None, None)
+        jobs.run(self.db, job)
+        self.assertEqual(jobs.get(self.db, job_id).status, jobs.FAILED)
+
+    def test_purge(self):
+        job_id = jobs.enqueue(self.db, self.polycule, "svg", SVG)
+        jobs.run(self.db, jobs.claim(self.db))
+        self.assertEqual(jobs.purge(self.db, lifetime=60), 0)
+        self.assertEqual(jobs.purge(self.db, lifetime=-1), 1)
+        self.assertIsNone(jobs.get(self.db, job_id))
+
+
+class TestWork(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.database = os.path.join(self.tmpdir, "test.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_work_once(self):
+        with closing(storage.connect(self.database)) as db:
+            runner.migrate(db, log=lambda message: None)
+            polycule = model.Polycule.create(db, GRAPH, None, None)
+            job_ids = [
+                jobs.enqueue(db, polycule, "svg", dict(SVG, embed=embed))
+                for embed in (True, False)
+            ]
+        jobs.work(self.database, once=True)
+        with closing(storage.connect(self.database)) as db:
+            for job_id in job_ids:
+                self.assertEqual(jobs.get(db, job_id).status, jobs.DONE)
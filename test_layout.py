@@ -0,0 +1,101 @@
+import random
+from unittest import TestCase, mock, skipUnless
+
+import layout
+import model
+import validation
+
+
+def random_links(count, seed=0):
+    r = random.Random(seed)
+    links = []
+    for i in range(1, count):
+        strength = r.randint(1, 10)
+        links.append((i, r.randrange(i), layout.link_length(strength, count - 1)))
+    return links
+
+
+@skipUnless(layout.available(), "needs numpy")
+class TestLayout(TestCase):
+    def test_deterministic(self):
+        links = random_links(50)
+        first = layout.layout(50, links, seed=1)
+        self.assertEqual(first.tolist(), layout.layout(50, links, seed=1).tolist())
+        self.assertNotEqual(first.tolist(), layout.layout(50, links, seed=2).tolist())
+
+    def test_fits(self):
+        for count in (1, 2, 50, layout.EXACT_LIMIT + 100):
+            positions = layout.layout(count, random_links(count))
+            self.assertEqual(positions.shape, (count, 2))
+            self.assertTrue((positions >= layout.MARGIN).all())
+            self.assertTrue((positions[:, 0] <= layout.WIDTH - layout.MARGIN).all())
+            self.assertTrue((positions[:, 1] <= layout.HEIGHT - layout.MARGIN).all())
+
+    def test_strong_links_are_shorter(self):
+        # A chain alternating strong and weak links
+        links = [
+            (i, i + 1, layout.link_length(10 if i % 2 else 1, 19)) for i in range(19)
+        ]
+        positions = layout.layout(20, links)
+        lengths = [
+            ((positions[a] - positions[b]) ** 2).sum() ** 0.5 for a, b, _ in links
+        ]
+        self.assertLess(max(lengths[1::2]), min(lengths[::2]))
+
+    def test_nodes_spread_out(self):
+        positions = layout.layout(10, [])
+        distances = ((positions[:, None] - positions) ** 2).sum(axis=2) ** 0.5
+        self.assertGreater(distances[distances > 0].min(), 5)
+
+    def test_cells_close_to_exact(self):
+        numpy = layout.numpy
+        positions = numpy.random.default_rng(0).uniform(-500, 500, (1000, 2))
+        exact = layout._repulsion_exact(positions, 100.0)
+        cells = layout._repulsion_cells(positions, 100.0)
+        error = numpy.linalg.norm(exact - cells) / numpy.linalg.norm(exact)
+        self.assertLess(error, 0.1)
+
+    def test_empty(self):
+        self.assertEqual(layout.layout(0, []).shape, (0, 2))
+
+
+GRAPH = """{
+    "nodes": [{"id": 1, "name": "Alice"}, {"id": 2, "name": "Bob", "r": 8}],
+    "links": [
+        {"source": {"id": 1, "name": "Alice"}, "target": {"id": 2, "name": "Bob"},
+         "strength": 5}
+    ]
+}"""
+
+
+class TestLaidOut(TestCase):
+    @skipUnless(layout.available(), "needs numpy")
+    def test_fills_positions(self):
+        graph = model.Graph.from_json(GRAPH).laid_out()
+        self.assertEqual([node.r for node in graph.nodes], [model.NODE_RADIUS, 8])
+        for node in graph.nodes:
+            self.assertIsInstance(node.x, int)
+            self.assertIsInstance(node.y, int)
+        svg = model.Polycule(graph=GRAPH).as_svg()
+        self.assertNotIn("None", svg)
+        self.assertEqual(svg, model.Polycule(graph=GRAPH).as_svg())
+
+    def test_odd_strengths(self):
+        default = layout.link_length(layout.DEFAULT_STRENGTH, 1)
+        for strength in ("0", "x", -3, "nan", "inf", None):
+            self.assertEqual(layout.link_length(strength, 1), default)
+        for strength in ('"0"', '"x"'):
+            graph = GRAPH.replace('"strength": 5', '"strength": ' + strength)
+            validation.parse(graph)
+            self.assertIn("<line", model.Polycule(graph=graph).as_svg())
+
+    def test_placed_graph_unchanged(self):
+        graph = model.Graph.from_json(
+            '{"nodes": [{"id": 1, "name": "A", "x": 1, "y": 2, "r": 3}], "links": []}'
+        )
+        self.assertIs(graph.laid_out(), graph)
+
+    def test_without_numpy(self):
+        graph = model.Graph.from_json(GRAPH)
+        with mock.patch("layout.numpy", None):
+            self.assertIs(graph.laid_out(), graph)
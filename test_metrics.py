@@ -0,0 +1,88 @@
+import threading
+import time
+from unittest import TestCase
+
+import metrics
+
+
+class TestRegistry(TestCase):
+    def test_histogram(self):
+        registry = metrics.Registry(buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            registry.observe("latency", value, stage="lookup")
+        registry.observe("latency", 0.5, stage="bcrypt")
+        ((name, kind, _, samples),) = registry.families()
+        self.assertEqual((name, kind), ("latency", "histogram"))
+        self.assertIn(("latency_bucket", {"stage": "lookup", "le": "0.1"}, 2), samples)
+        self.assertIn(("latency_bucket", {"stage": "lookup", "le": "1"}, 3), samples)
+        self.assertIn(("latency_bucket", {"stage": "lookup", "le": "+Inf"}, 4), samples)
+        self.assertIn(("latency_count", {"stage": "lookup"}, 4), samples)
+        self.assertIn(("latency_sum", {"stage": "lookup"}, 2.65), samples)
+        self.assertIn(("latency_count", {"stage": "bcrypt"}, 1), samples)
+
+    def test_timer(self):
+        registry = metrics.Registry()
+        with registry.timer("latency", stage="sleep"):
+            time.sleep(0.01)
+        samples = registry.families()[0][3]
+        (total,) = [value for name, _, value in samples if name == "latency_sum"]
+        self.assertGreaterEqual(total, 0.01)
+
+    def test_disabled(self):
+        registry = metrics.Registry(enabled=False)
+        with registry.timer("latency"):
+            pass
+        registry.observe("latency", 1)
+        self.assertEqual(registry.families(), [])
+
+
+class TestRender(TestCase):
+    def test_text_format(self):
+        text = metrics.render(
+            [
+                metrics.family("up", "gauge", "Whether it is up.", 1),
+                metrics.family(
+                    "renders_total",
+                    "counter",
+                    "Renders.\nBy command.",
+                    [({"command": 'ne"ato'}, 3), ({"command": "convert"}, 0)],
+                ),
+            ]
+        )
+        self.assertEqual(
+            text,
+            "# HELP up Whether it is up.\n"
+            "# TYPE up gauge\n"
+            "up 1.0\n"
+            "# HELP renders_total Renders.\\nBy command.\n"
+            "# TYPE renders_total counter\n"
+            'renders_total{command="ne\\"ato"} 3.0\n'
+            'renders_total{command="convert"} 0.0\n',
+        )
+
+
+def busy(seconds):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+
+class TestSampler(TestCase):
+    def test_samples_watched_thread(self):
+        sampler = metrics.Sampler(interval=0.001)
+        sampler.start()
+        busy(0.1)
+        samples = sampler.stop()
+        self.assertTrue(samples)
+        self.assertTrue(any("test_metrics.py:busy" in stack for stack in samples))
+        self.assertIn(" ", metrics.folded(samples, limit=1))
+
+    def test_unwatched_thread(self):
+        sampler = metrics.Sampler(interval=0.001)
+        sampler.start()
+        other = []
+        thread = threading.Thread(target=lambda: other.append(sampler.stop()))
+        thread.start()
+        thread.join()
+        sampler.stop()
+        self.assertEqual(other, [{}])
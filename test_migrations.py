@@ -0,0 +1,203 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+from contextlib import closing
+from unittest import TestCase, mock
+
+import model
+from migrations import data, hashify, pack, runner
+from test_model import make_db
+
+
+class Crash(Exception):
+    pass
+
+
+class TestMigrateRows(TestCase):
+    def setUp(self):
+        self.db = make_db()
+        for i in range(10):
+            self.db.execute(
+                "insert into polycules (graph) values (?)", ['{"a": %d}' % i]
+            )
+        self.db.commit()
+        self.log = []
+
+    def test_hashify(self):
+        hashify.migrate(self.db)
+        graph, graph_hash = self.db.execute(
+            "select graph, hash from polycules where id = 3"
+        ).fetchone()
+        self.assertEqual(graph_hash, hashlib.sha1(graph.encode("utf-8")).hexdigest())
+
+    def test_pack(self):
+        self.db.execute("insert into polycules (graph) values ('not json')")
+        pack.migrate(self.db)
+        pack.migrate(self.db)
+        rows = self.db.execute("select graph from polycules order by id").fetchall()
+        self.assertTrue(rows[3][0].startswith(model.GRAPH_MAGIC))
+        self.assertEqual(model.decode_graph(rows[3][0]), '{"a":3}')
+        self.assertEqual(rows[-1][0], "not json")
+
+    def test_resume(self):
+        seen = []
+
+        def crash_at_seven(row):
+            if row[0] == 7:
+                raise Crash
+            seen.append(row[0])
+            return ["x{}".format(row[0]), row[0]]
+
+        with self.assertRaises(Crash):
+            data.migrate_rows(
+                self.db,
+                "test",
+                "graph",
+                "update polycules set hash = ? where id = ?",
+                crash_at_seven,
+                batch_size=3,
+                log=self.log.append,
+            )
+        # The batch holding row 7 was never committed
+        self.assertEqual(
+            self.db.execute(
+                "select count(*) from polycules where hash like 'x%'"
+            ).fetchone()[0],
+            6,
+        )
+        seen[:] = []
+        done = data.migrate_rows(
+            self.db,
+            "test",
+            "graph",
+            "update polycules set hash = ? where id = ?",
+            lambda row: seen.append(row[0]) or ["x{}".format(row[0]), row[0]],
+            batch_size=3,
+            log=self.log.append,
+        )
+        self.assertEqual(seen, [7, 8, 9, 10])
+        self.assertEqual(done, 4)
+        self.assertIn("test: resuming after id 6", self.log)
+        self.assertIsNone(
+            self.db.execute("select * from migration_checkpoints").fetchone()
+        )
+
+
+class TestRunner(TestCase):
+    def test_every_script_is_registered(self):
+        scripts = sorted(
+            name for name in os.listdir(runner.MIGRATIONS_DIR) if name.endswith(".sql")
+        )
+        self.assertEqual(
+            scripts, [m.sql for m in runner.MIGRATIONS if m.sql is not None]
+        )
+
+    def test_upgrade(self):
+        db = sqlite3.connect(":memory:")
+        log = []
+        runner.migrate(db, log=log.append)
+        self.assertEqual(runner.current_version(db), runner.LATEST)
+        self.assertEqual(len(log), len(runner.MIGRATIONS))
+        runner.migrate(db, log=log.append)
+        self.assertEqual(len(log), len(runner.MIGRATIONS))
+
+    def test_current_schema_does_no_io(self):
+        db = make_db()
+        with mock.patch("builtins.open") as open_:
+            runner.migrate(db)
+        open_.assert_not_called()
+
+    def test_failed_migration_is_rolled_back(self):
+        db = sqlite3.connect(":memory:")
+
+        def fail(db, log):
+            db.execute("create table half_done (id integer)")
+            raise Crash
+
+        migrations = runner.MIGRATIONS + [
+            runner.Migration(runner.LATEST + 1, python=fail)
+        ]
+        with mock.patch.object(runner, "MIGRATIONS", migrations), mock.patch.object(
+            runner, "LATEST", runner.LATEST + 1
+        ):
+            with self.assertRaises(Crash):
+                runner.migrate(db, log=lambda message: None)
+        self.assertEqual(runner.current_version(db), runner.LATEST)
+        with self.assertRaises(sqlite3.OperationalError):
+            db.execute("select * from half_done")
+
+    def at_version(self, version, rows):
+        db = sqlite3.connect(":memory:")
+        with mock.patch.object(
+            runner, "MIGRATIONS", runner.MIGRATIONS[: version + 1]
+        ), mock.patch.object(runner, "LATEST", version):
+            runner.migrate(db, log=lambda message: None)
+        db.executemany(
+            "insert into polycules (graph) values (?)",
+            [['{"a": %d}' % i] for i in range(rows)],
+        )
+        db.commit()
+        return db
+
+    def test_interrupted_python_step_resumes(self):
+        db = self.at_version(2, 3000)
+        rehash = hashify.rehash
+
+        def crash_at_1500(row):
+            if row[0] == 1500:
+                raise Crash
+            return rehash(row)
+
+        with mock.patch("migrations.hashify.rehash", crash_at_1500):
+            with self.assertRaises(Crash):
+                runner.migrate(db, log=lambda message: None)
+        self.assertEqual(runner.current_version(db), 2)
+        log = []
+        runner.migrate(db, log=log.append)
+        self.assertIn("hashify: resuming after id 1000", log)
+        self.assertEqual(runner.current_version(db), runner.LATEST)
+        self.assertEqual(
+            db.execute("select count(*) from polycules where hash is null").fetchone(),
+            (0,),
+        )
+        self.assertEqual(
+            db.execute("select count(*) from migration_checkpoints").fetchone(), (0,)
+        )
+
+    def test_batches_are_transactions(self):
+        db = self.at_version(5, 3000)
+        statements = []
+        db.set_trace_callback(statements.append)
+        runner.migrate(db, log=lambda message: None)
+        # One transaction for each batch, rather than one for each row
+        self.assertLess(
+            sum(statement.upper().startswith("BEGIN") for statement in statements),
+            100,
+        )
+
+    def test_concurrent_workers(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "test.db")
+            errors = []
+
+            def worker():
+                try:
+                    with closing(sqlite3.connect(path)) as db:
+                        runner.migrate(db, log=lambda message: None)
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=worker) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            with closing(sqlite3.connect(path)) as db:
+                self.assertEqual(runner.current_version(db), runner.LATEST)
+        finally:
+            shutil.rmtree(tmpdir)
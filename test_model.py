@@ -1,8 +1,241 @@
+import json
+import sqlite3
 from unittest import TestCase
 
 import model
+from migrations import runner
+
+
+def make_db():
+    db = sqlite3.connect(":memory:")
+    runner.migrate(db, log=lambda message: None)
+    return db
+
+
+def insert(db, graph, graph_hash):
+    db.execute(
+        "insert into polycules (graph, hash) values (?, ?)", [graph, graph_hash]
+    )
+    db.commit()
 
 
 class TestMe(TestCase):
     def test_me(self):
         self.assertFalse(model.Polycule is None)
+
+
+class TestGet(TestCase):
+    def setUp(self):
+        self.db = make_db()
+        insert(self.db, '{"a": 1}', "abcdef0" + "1" * 33)
+        insert(self.db, '{"a": 2}', "abcdef0" + "2" * 33)
+        insert(self.db, '{"a": 3}', "0123456" + "f" * 33)
+
+    def test_full_hash(self):
+        polycule = model.Polycule.get(self.db, "abcdef0" + "1" * 33, None)
+        self.assertEqual(polycule.graph, '{"a": 1}')
+
+    def test_prefix(self):
+        polycule = model.Polycule.get(self.db, "0123456", None)
+        self.assertEqual(polycule.graph, '{"a": 3}')
+
+    def test_prefix_is_case_insensitive(self):
+        polycule = model.Polycule.get(self.db, "ABCDEF01", None)
+        self.assertEqual(polycule.graph, '{"a": 1}')
+
+    def test_ambiguous_prefix(self):
+        self.assertIsNone(model.Polycule.get(self.db, "abcdef0", None))
+
+    def test_bad_lengths(self):
+        self.assertIsNone(model.Polycule.get(self.db, "abcde", None))
+        self.assertIsNone(model.Polycule.get(self.db, "0123456" + "f" * 34, None))
+
+    def test_missing(self):
+        self.assertIsNone(model.Polycule.get(self.db, "fffffff", None))
+
+    def test_hash_is_unique(self):
+        with self.assertRaises(sqlite3.IntegrityError):
+            insert(self.db, '{"a": 4}', "0123456" + "f" * 33)
+
+
+class TestCreate(TestCase):
+    def setUp(self):
+        self.db = make_db()
+
+    def test_create(self):
+        polycule = model.Polycule.create(self.db, '{"a": 1}', None, None)
+        self.assertEqual(
+            model.Polycule.get(self.db, polycule.graph_hash, None).id, polycule.id
+        )
+
+    def test_identical_graph(self):
+        model.Polycule.create(self.db, '{"a": 1}', None, None)
+        with self.assertRaises(model.Polycule.IdenticalGraph):
+            model.Polycule.create(self.db, '{"a": 1}', None, None)
+
+    def test_lost_race(self):
+        polycule = model.Polycule(graph='{"a": 1}')
+        db = self.db
+
+        class RacingDB(object):
+            def execute(self, sql, params=()):
+                result = db.execute(sql, params)
+                if sql.startswith("select 1"):
+                    # Let the probe miss, as if the other insert had not landed
+                    insert(db, polycule.graph, params[0])
+                return result
+
+            def __getattr__(self, name):
+                return getattr(db, name)
+
+        with self.assertRaises(model.Polycule.IdenticalGraph):
+            model.Polycule.create(RacingDB(), polycule.graph, None, None)
+
+    def test_immutable(self):
+        locked = model.Polycule.create(self.db, '{"a": 1}', None, "")
+        editable = model.Polycule.create(self.db, '{"a": 2}', None, "edit")
+        self.assertTrue(model.Polycule.get(self.db, locked.graph_hash, None).immutable)
+        polycule = model.Polycule.get(self.db, editable.graph_hash, None)
+        self.assertFalse(polycule.immutable)
+        polycule.save('{"a": 3}', None, None, remove_edit_pass=True)
+        polycule = model.Polycule.get(self.db, editable.graph_hash, None)
+        self.assertTrue(polycule.immutable)
+
+    def test_protected(self):
+        polycule = model.Polycule.create(self.db, '{"a": 1}', "", "edit")
+        self.assertIsNotNone(polycule.view_pass)
+        self.assertFalse(polycule.protected)
+        polycule.save('{"a": 2}', "secret", None)
+        polycule = model.Polycule.get(self.db, polycule.graph_hash, None, force=True)
+        self.assertTrue(polycule.protected)
+        polycule.save('{"a": 3}', "", None)
+        self.assertTrue(polycule.protected)
+        polycule.save('{"a": 4}', None, None, remove_view_pass=True)
+        polycule = model.Polycule.get(self.db, polycule.graph_hash, None)
+        self.assertFalse(polycule.protected)
+
+
+class TestCodec(TestCase):
+    def test_round_trip(self):
+        stored = model.encode_graph(GRAPH)
+        self.assertTrue(stored.startswith(model.GRAPH_MAGIC))
+        self.assertLess(len(stored), len(GRAPH))
+        self.assertEqual(json.loads(model.decode_graph(stored)), json.loads(GRAPH))
+
+    def test_links_refer_to_listed_nodes(self):
+        graph = json.loads(GRAPH)
+        graph["nodes"][0]["x"] = 300
+        links = model.pack_links(graph)
+        self.assertEqual(links[0]["source"], 1)
+        decoded = json.loads(model.decode_graph(model.encode_graph(json.dumps(graph))))
+        self.assertEqual(decoded["links"][0]["source"]["x"], 300)
+
+    def test_unlisted_end_kept(self):
+        graph = json.loads(GRAPH)
+        del graph["nodes"][1]
+        decoded = json.loads(model.decode_graph(model.encode_graph(json.dumps(graph))))
+        self.assertEqual(decoded["links"][0]["target"]["name"], 'Zo\u00eb "Z"')
+
+    def test_unexpected_shape(self):
+        self.assertIsNone(model.pack_links({"nodes": [], "links": [1]}))
+        stored = model.encode_graph('{"nodes": 1}')
+        self.assertEqual(model.decode_graph(stored), '{"nodes":1}')
+
+    def test_not_json(self):
+        self.assertEqual(model.encode_graph("not json"), "not json")
+        self.assertEqual(model.decode_graph("not json"), "not json")
+
+    def test_stored_graph(self):
+        db = make_db()
+        created = model.Polycule.create(db, GRAPH, None, None)
+        self.assertEqual(created.graph, GRAPH)
+        polycule = model.Polycule.get(db, created.graph_hash, None)
+        self.assertEqual(polycule.content_hash, created.content_hash)
+        self.assertEqual(polycule.as_svg(), created.as_svg())
+
+
+GRAPH = """{
+    "lastId": 2,
+    "nodes": [
+        {"id": 1, "name": "Alice", "x": 100, "y": 50, "r": 12},
+        {"id": 2, "name": "Zo\\u00eb \\"Z\\"", "x": 200, "y": 150, "r": "8"}
+    ],
+    "links": [
+        {
+            "source": {"id": 1, "name": "Alice", "x": 100, "y": 50, "r": 12},
+            "target": {
+                "id": 2, "name": "Zo\\u00eb \\"Z\\"", "x": 200, "y": 150, "r": "8"
+            },
+            "strength": "10",
+            "sourceText": "alice",
+            "centerText": "center",
+            "dashed": true
+        }
+    ]
+}"""
+
+
+class TestRenderers(TestCase):
+    def setUp(self):
+        self.polycule = model.Polycule(graph=GRAPH, graph_hash="a" * 40)
+
+    def test_text(self):
+        self.assertTrue(
+            self.polycule.as_text().endswith(
+                '* _Alice_ (alice) is in a loosely defined relationship (center) '
+                'with _Zoë "Z"_\n'
+            )
+        )
+        self.assertIn("<em>Alice</em>", self.polycule.as_html())
+
+    def test_dot(self):
+        dot = self.polycule.as_dot(edge_labels=True)
+        self.assertIn('\tnode2 [label="Zoë \\"Z\\""]\n', dot)
+        self.assertIn('\tnode1 -- node2 [len=2.0,label="center",style=dashed]\n', dot)
+
+    def test_svg(self):
+        svg = self.polycule.as_svg(edge_labels=True, embed=True)
+        self.assertTrue(svg.startswith('\n        <svg width="1000"'))
+        self.assertIn('stroke-dasharray="10 10"', svg)
+        self.assertIn(">center</text>", svg)
+        self.assertNotIn("<style>", svg)
+
+    def test_iter_matches_as(self):
+        self.assertEqual("".join(self.polycule.iter_text()), self.polycule.as_text())
+        self.assertEqual(
+            "".join(self.polycule.iter_svg(include_style=True)),
+            self.polycule.as_svg(include_style=True),
+        )
+
+    def test_chunked(self):
+        self.assertEqual(
+            list(model.chunked(["ab", "cd", "e"], size=3)), ["abcd", "e"]
+        )
+
+
+class TestGraph(TestCase):
+    def test_edges_refer_to_nodes(self):
+        graph = model.Graph.from_json(GRAPH)
+        self.assertEqual([node.name for node in graph.nodes], ["Alice", 'Zoë "Z"'])
+        edge = graph.edges[0]
+        self.assertEqual((edge.source, edge.target), (0, 1))
+        self.assertTrue(edge.dashed)
+        self.assertEqual(edge.center_text, "center")
+        self.assertIsNone(edge.target_text)
+
+    def test_unlisted_link_end(self):
+        graph = model.Graph.from_json(
+            """{"nodes": [{"id": 1, "name": "Alice"}],
+            "links": [{"source": {"id": 1, "name": "Alice"},
+                       "target": {"id": 3, "name": "Carol"},
+                       "strength": 1}]}"""
+        )
+        self.assertEqual(graph.listed, 1)
+        self.assertEqual([node.name for node in graph.listed_nodes()], ["Alice"])
+        self.assertEqual(graph.nodes[graph.edges[0].target].name, "Carol")
+
+    def test_parsed_once(self):
+        polycule = model.Polycule(graph=GRAPH, graph_hash="a" * 40)
+        self.assertIs(polycule.parsed, polycule.parsed)
+        polycule.graph = '{"nodes": [], "links": []}'
+        self.assertEqual(polycule.parsed.nodes, [])
@@ -0,0 +1,38 @@
+import threading
+from unittest import TestCase
+
+import passwords
+
+
+class TestPasswordPool(TestCase):
+    def setUp(self):
+        self.pool = passwords.PasswordPool(workers=1, queue_size=0)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_hash_and_check(self):
+        hashed = self.pool.hash("secret")
+        self.assertTrue(self.pool.check("secret", hashed))
+        self.assertFalse(self.pool.check("wrong", hashed))
+        self.assertEqual(self.pool.stats()["completed"], 3)
+
+    def test_full_queue(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        thread = threading.Thread(target=self.pool.run, args=(block,))
+        thread.start()
+        started.wait()
+        with self.assertRaises(passwords.Busy):
+            self.pool.run(lambda: None)
+        self.assertEqual(self.pool.stats()["running"], 1)
+        self.assertEqual(self.pool.stats()["rejected"], 1)
+        release.set()
+        thread.join()
+        self.assertEqual(self.pool.run(lambda: 42), 42)
+        self.assertEqual(self.pool.stats()["running"], 0)
@@ -0,0 +1,53 @@
+from unittest import TestCase
+
+import patch
+
+
+class TestApply(TestCase):
+    def setUp(self):
+        self.document = {"nodes": [{"id": 1}, {"id": 2}], "lastId": 2}
+
+    def test_operations(self):
+        result = patch.apply(
+            self.document,
+            [
+                {"op": "add", "path": "/nodes/-", "value": {"id": 3}},
+                {"op": "replace", "path": "/lastId", "value": 3},
+                {"op": "remove", "path": "/nodes/0"},
+                {"op": "copy", "from": "/nodes/0", "path": "/nodes/1"},
+                {"op": "move", "from": "/lastId", "path": "/last~1id"},
+                {"op": "test", "path": "/nodes/2/id", "value": 3},
+            ],
+        )
+        self.assertEqual(
+            result, {"nodes": [{"id": 2}, {"id": 2}, {"id": 3}], "last/id": 3}
+        )
+        # The original is left alone
+        self.assertEqual(len(self.document["nodes"]), 2)
+
+    def test_check(self):
+        seen = []
+        patch.apply(
+            self.document,
+            [
+                {"op": "move", "from": "/nodes/0", "path": "/nodes/1"},
+                {"op": "add", "path": "/nodes/-", "value": {"id": 3}},
+            ],
+            lambda document, path: seen.append(path),
+        )
+        self.assertEqual(seen, [["nodes", "0"], ["nodes", "1"], ["nodes", "-"]])
+
+    def test_invalid(self):
+        for operations in [
+            {"op": "add"},
+            [{"op": "add", "path": "/nodes/5", "value": 1}],
+            [{"op": "remove", "path": "/missing"}],
+            [{"op": "replace", "path": "/nodes/01", "value": 1}],
+            [{"op": "test", "path": "/lastId", "value": 3}],
+            [{"op": "move", "from": "/nodes", "path": "/nodes/0"}],
+            [{"op": "frobnicate", "path": "/lastId"}],
+            [{"op": "add", "path": "lastId", "value": 1}],
+            [{"op": "add", "path": "/lastId/x", "value": 1}],
+        ]:
+            with self.assertRaises(patch.InvalidPatch):
+                patch.apply(self.document, operations)
@@ -1,8 +1,544 @@
-from unittest import TestCase
+import gzip
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+from contextlib import closing
+from unittest import TestCase, mock
 
+from model import Polycule
+from test_model import GRAPH
+import cache
+import jobs
+import passwords
 import polycules
+import rendering
+
+
+EMPTY_GRAPH = '{"lastId": 0, "nodes": [], "links": []}'
 
 
 class TestMe(TestCase):
     def test_me(self):
         self.assertFalse(polycules.app is None)
+
+
+class AppTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        polycules.app.config["DATABASE"] = os.path.join(self.tmpdir, "test.db")
+        polycules.app.config["TESTING"] = True
+        polycules.migrate()
+        self.client = polycules.app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def create(self, graph=EMPTY_GRAPH, view_pass=None, edit_pass=None):
+        with closing(polycules.connect_db()) as db:
+            return Polycule.create(db, graph, view_pass, edit_pass)
+
+    def post(self, url, **data):
+        with self.client.session_transaction() as sess:
+            sess["_csrf_token"] = "token"
+        data["_csrf_token"] = "token"
+        return self.client.post(url, data=data)
+
+
+class TestViewGrants(AppTestCase):
+    def export_dot(self, polycule):
+        return self.client.get("/export/{}/polycule.dot".format(polycule.graph_hash))
+
+    def test_unprotected(self):
+        polycule = self.create()
+        response = self.export_dot(polycule)
+        self.assertEqual(response.mimetype, "text/plain")
+
+    def test_password_required(self):
+        polycule = self.create(view_pass="secret")
+        response = self.export_dot(polycule)
+        self.assertIn(b"A password is required", response.data)
+
+    def test_grant_skips_bcrypt(self):
+        polycule = self.create(view_pass="secret")
+        response = self.post("/{}".format(polycule.graph_hash), view_pass="secret")
+        self.assertNotIn(b"A password is required", response.data)
+        with mock.patch("passwords.bcrypt.checkpw") as checkpw:
+            response = self.export_dot(polycule)
+        self.assertEqual(response.mimetype, "text/plain")
+        checkpw.assert_not_called()
+
+    def test_wrong_password(self):
+        polycule = self.create(view_pass="secret")
+        self.post("/{}".format(polycule.graph_hash), view_pass="wrong")
+        response = self.export_dot(polycule)
+        self.assertIn(b"A password is required", response.data)
+
+    def test_changed_password_revokes_grant(self):
+        polycule = self.create(view_pass="secret")
+        self.post("/{}".format(polycule.graph_hash), view_pass="secret")
+        with closing(polycules.connect_db()) as db:
+            Polycule.get(db, polycule.graph_hash, None, force=True).save(
+                EMPTY_GRAPH, "changed", None
+            )
+        response = self.export_dot(polycule)
+        self.assertIn(b"A password is required", response.data)
+
+    def test_expired_grant(self):
+        polycule = self.create(view_pass="secret")
+        self.post("/{}".format(polycule.graph_hash), view_pass="secret")
+        with mock.patch("polycules.time.time", return_value=1e12):
+            response = self.export_dot(polycule)
+        self.assertIn(b"A password is required", response.data)
+
+
+class TestPasswordsBusy(AppTestCase):
+    def test_busy(self):
+        polycule = self.create(view_pass="secret")
+        with mock.patch("passwords.check_password", side_effect=passwords.Busy):
+            response = self.post("/{}".format(polycule.graph_hash), view_pass="secret")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["Retry-After"], "1")
+
+
+class TestExports(AppTestCase):
+    def test_svg(self):
+        polycule = self.create(graph=GRAPH)
+        response = self.client.get(
+            "/export/{}/polycule.svg?link-labels=on".format(polycule.graph_hash)
+        )
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(
+            response.get_data(as_text=True), polycule.as_svg(edge_labels=True)
+        )
+
+
+class TestHTTPCaching(AppTestCase):
+    def get_svg(self, graph_hash, **headers):
+        return self.client.get(
+            "/export/{}/polycule.svg".format(graph_hash), headers=headers
+        )
+
+    def test_not_modified(self):
+        polycule = self.create(GRAPH)
+        etag = self.get_svg(polycule.graph_hash).headers["ETag"]
+        with mock.patch("model.Polycule.iter_svg") as iter_svg:
+            response = self.get_svg(polycule.graph_hash, **{"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        iter_svg.assert_not_called()
+
+    def test_options_change_etag(self):
+        polycule = self.create(GRAPH)
+        plain = self.get_svg(polycule.graph_hash)
+        labelled = self.client.get(
+            "/export/{}/polycule.svg?link-labels=1".format(polycule.graph_hash)
+        )
+        self.assertNotEqual(plain.headers["ETag"], labelled.headers["ETag"])
+
+    def test_save_changes_etag(self):
+        polycule = self.create(edit_pass="edit")
+        etag = self.get_svg(polycule.graph_hash).headers["ETag"]
+        with closing(polycules.connect_db()) as db:
+            Polycule.get(db, polycule.graph_hash, None, force=True).save(
+                GRAPH, None, None
+            )
+        response = self.get_svg(polycule.graph_hash, **{"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_last_modified(self):
+        polycule = self.create()
+        response = self.get_svg(polycule.graph_hash)
+        self.assertIn("Last-Modified", response.headers)
+
+    def test_immutable_full_hash(self):
+        polycule = self.create(edit_pass="")
+        response = self.get_svg(polycule.graph_hash)
+        self.assertIn("immutable", response.headers["Cache-Control"])
+        self.assertIn("public", response.headers["Cache-Control"])
+
+    def test_short_hash_revalidates(self):
+        polycule = self.create(edit_pass="")
+        response = self.get_svg(polycule.graph_hash[:7])
+        self.assertEqual(response.headers["Cache-Control"], "public, no-cache")
+
+    def test_editable_revalidates(self):
+        polycule = self.create(edit_pass="edit")
+        response = self.get_svg(polycule.graph_hash)
+        self.assertEqual(response.headers["Cache-Control"], "public, no-cache")
+
+    def test_protected_is_private(self):
+        polycule = self.create(view_pass="secret")
+        self.post("/{}".format(polycule.graph_hash), view_pass="secret")
+        response = self.get_svg(polycule.graph_hash)
+        self.assertEqual(response.headers["Cache-Control"], "private, no-cache")
+
+    def test_protected_needs_access_for_304(self):
+        polycule = self.create(view_pass="secret")
+        self.post("/{}".format(polycule.graph_hash), view_pass="secret")
+        etag = self.get_svg(polycule.graph_hash).headers["ETag"]
+        self.client.delete_cookie("session")
+        response = self.get_svg(polycule.graph_hash, **{"If-None-Match": etag})
+        self.assertIn(b"A password is required", response.data)
+
+    def test_empty_passwords_from_the_form_are_public(self):
+        response = self.post("/save", graph=GRAPH, view_pass="", edit_pass="")
+        graph_hash = response.headers["Location"].rsplit("/", 1)[1]
+        with mock.patch("passwords.check_password") as check_password:
+            svg = self.get_svg(graph_hash)
+            embed = self.client.get("/embed/{}".format(graph_hash))
+        check_password.assert_not_called()
+        self.assertIn("public", svg.headers["Cache-Control"])
+        self.assertIn("immutable", svg.headers["Cache-Control"])
+        self.assertIn("public", embed.headers["Cache-Control"])
+        with self.client.session_transaction() as sess:
+            self.assertNotIn("view_grants", sess)
+
+    def test_old_row_with_empty_view_password(self):
+        polycule = self.create(GRAPH, view_pass="", edit_pass="")
+        with closing(polycules.connect_db()) as db:
+            db.execute("update polycules set view_protected = null")
+            db.commit()
+        with mock.patch(
+            "passwords.check_password", wraps=passwords.check_password
+        ) as check_password:
+            for _ in range(2):
+                response = self.get_svg(polycule.graph_hash)
+                self.assertIn("public", response.headers["Cache-Control"])
+        # Only the first view finds out that the empty password opens it
+        self.assertEqual(check_password.call_count, 1)
+
+    def test_delete_form_is_private(self):
+        polycule = self.create(edit_pass="")
+        response = self.client.get("/{}".format(polycule.graph_hash))
+        self.assertEqual(response.headers["Cache-Control"], "private, no-cache")
+
+
+class TestCompression(AppTestCase):
+    def get(self, url, encoding="gzip"):
+        return self.client.get(url, headers={"Accept-Encoding": encoding})
+
+    def test_large_export(self):
+        polycule = self.create(GRAPH)
+        url = "/export/{}/polycule.svg".format(polycule.graph_hash)
+        plain = self.client.get(url).data
+        with mock.patch.dict(polycules.app.config, COMPRESSION_MIN_SIZE=1):
+            for _ in range(2):
+                response = self.get(url)
+                self.assertEqual(response.headers["Content-Encoding"], "gzip")
+                self.assertEqual(gzip.decompress(response.data), plain)
+        self.assertIn("Accept-Encoding", response.headers["Vary"])
+
+    def test_export_streamed_while_compressed(self):
+        polycule = self.create(GRAPH)
+        rendered = []
+
+        def render():
+            for i in range(100):
+                rendered.append(i)
+                yield "line {:04d}\n".format(i) * 10
+
+        with mock.patch.dict(polycules.app.config, COMPRESSION_MIN_SIZE=500):
+            with polycules.app.test_request_context(
+                headers={"Accept-Encoding": "gzip"}
+            ):
+                response = polycules.export(polycule, "lines", render, "text/plain", {})
+                self.assertTrue(response.is_streamed)
+                self.assertNotIsInstance(response.response, (bytes, list))
+                # Only enough was rendered to decide on compressing
+                self.assertEqual(len(rendered), 5)
+                body = b"".join(response.response)
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(body).decode(), "".join(render()))
+        self.assertEqual(cache.get(polycule, "lines", encoding="gzip"), body)
+
+    def test_small_export(self):
+        polycule = self.create()
+        response = self.get("/export/{}/polycule.txt".format(polycule.graph_hash))
+        self.assertNotIn("Content-Encoding", response.headers)
+
+    def test_encoding_changes_etag(self):
+        polycule = self.create(GRAPH)
+        url = "/export/{}/polycule.dot".format(polycule.graph_hash)
+        self.assertNotEqual(
+            self.get(url).headers["ETag"], self.get(url, "identity").headers["ETag"]
+        )
+
+    def test_page(self):
+        polycule = self.create(GRAPH)
+        with mock.patch.dict(polycules.app.config, COMPRESSION_MIN_SIZE=1):
+            response = self.get("/{}".format(polycule.graph_hash))
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertIn(b"Alice", gzip.decompress(response.data))
+
+    def test_not_accepted(self):
+        polycule = self.create(GRAPH)
+        with mock.patch.dict(polycules.app.config, COMPRESSION_MIN_SIZE=1):
+            response = self.get("/{}".format(polycule.graph_hash), "identity")
+        self.assertNotIn("Content-Encoding", response.headers)
+
+
+class TestSave(AppTestCase):
+    def test_invalid_new_graph(self):
+        response = self.post("/save", graph='{"nodes": 1}')
+        self.assertIn(b"could not be parsed", response.data)
+
+    def test_invalid_edit(self):
+        polycule = self.create(edit_pass="edit")
+        with self.client.session_transaction() as sess:
+            sess["currently_editing"] = polycule.graph_hash
+        response = self.post("/edit/save", graph='{"nodes": 1}')
+        self.assertIn(b"could not be parsed", response.data)
+        with closing(polycules.connect_db()) as db:
+            self.assertEqual(
+                json.loads(Polycule.get(db, polycule.graph_hash, None).graph),
+                json.loads(EMPTY_GRAPH),
+            )
+
+    def test_save(self):
+        response = self.post("/save", graph=GRAPH)
+        self.assertEqual(response.status_code, 302)
+
+
+class TestPatch(AppTestCase):
+    def setUp(self):
+        super(TestPatch, self).setUp()
+        self.polycule = self.create(GRAPH, edit_pass="edit")
+        with self.client.session_transaction() as sess:
+            sess["currently_editing"] = self.polycule.graph_hash
+
+    def patch(self, operations, base=None):
+        if base is None:
+            base = self.current().content_hash
+        return self.post("/edit/patch", base=base, patch=json.dumps(operations))
+
+    def current(self):
+        with closing(polycules.connect_db()) as db:
+            return Polycule.get(db, self.polycule.graph_hash, None)
+
+    def test_patch(self):
+        response = self.patch(
+            [{"op": "replace", "path": "/nodes/0/name", "value": "Alicia"}]
+        )
+        self.assertEqual(response.status_code, 200)
+        current = self.current()
+        self.assertEqual(response.json["version"], current.content_hash)
+        self.assertEqual(json.loads(current.graph)["nodes"][0]["name"], "Alicia")
+        self.assertIn("Alicia", current.as_text())
+
+    def test_expired_token(self):
+        data = {
+            "_csrf_token": "stale",
+            "base": self.current().content_hash,
+            "patch": json.dumps([{"op": "replace", "path": "/lastId", "value": 3}]),
+        }
+        response = self.client.post("/edit/patch", data=data)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json["error"], "Token expired")
+        self.assertNotEqual(json.loads(self.current().graph).get("lastId"), 3)
+        # The fresh token in the response lets the client try again
+        data["_csrf_token"] = response.json["csrf_token"]
+        self.assertEqual(self.client.post("/edit/patch", data=data).status_code, 200)
+
+    def test_stale_base(self):
+        base = self.current().content_hash
+        self.patch([{"op": "replace", "path": "/lastId", "value": 3}])
+        response = self.patch(
+            [{"op": "replace", "path": "/lastId", "value": 4}], base=base
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json["version"], self.current().content_hash)
+        self.assertEqual(json.loads(self.current().graph)["lastId"], 3)
+
+    def test_lost_race(self):
+        base = self.current().content_hash
+        # Another save lands after the base is checked, before the write
+        with mock.patch("model.stored_hash", side_effect=[base, "other", "other"]):
+            response = self.patch(
+                [{"op": "replace", "path": "/lastId", "value": 3}], base=base
+            )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(json.loads(self.current().graph)["lastId"], 2)
+
+    def test_invalid_patch(self):
+        response = self.patch([{"op": "remove", "path": "/nodes/7"}])
+        self.assertEqual(response.status_code, 400)
+        response = self.patch(
+            [{"op": "add", "path": "/nodes/0/watcher", "value": "Eve"}]
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(self.current().graph)["nodes"][0]["id"], 1)
+
+    def test_not_editing(self):
+        with self.client.session_transaction() as sess:
+            del sess["currently_editing"]
+        response = self.patch([])
+        self.assertEqual(response.status_code, 403)
+
+
+class TestExportJobs(AppTestCase):
+    def test_async_export(self):
+        polycule = self.create(GRAPH)
+        url = "/export/{}/polycule.svg?async=1&embed=1".format(polycule.graph_hash)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 202)
+        job = response.get_json()
+        self.assertEqual(job["status"], "queued")
+        self.assertEqual(response.headers["Location"], job["status_url"])
+        self.assertEqual(self.client.get(url).get_json()["id"], job["id"])
+
+        jobs.work(polycules.app.config["DATABASE"], once=True)
+        status = self.client.get(job["status_url"]).get_json()
+        self.assertEqual(status["status"], "done")
+        response = self.client.get(status["result_url"])
+        self.assertEqual(response.mimetype, "image/svg+xml")
+        self.assertEqual(response.data.decode("utf-8"), polycule.as_svg(embed=True))
+
+    def test_wait(self):
+        polycule = self.create(GRAPH)
+        url = "/export/{}/polycule.png?async=1&from=svg".format(polycule.graph_hash)
+        job = self.client.get(url).get_json()
+        with mock.patch("time.sleep") as sleep:
+            sleep.side_effect = lambda seconds: jobs.work(
+                polycules.app.config["DATABASE"], once=True
+            )
+            status = self.client.get(job["status_url"] + "?wait=5").get_json()
+        self.assertEqual(status["status"], "done")
+        self.assertEqual(self.client.get(status["result_url"]).mimetype, "image/png")
+
+    @mock.patch.dict(polycules.app.config, DATABASE_POOL_SIZE=1)
+    def test_wait_returns_connection(self):
+        polycule = self.create(GRAPH)
+        url = "/export/{}/polycule.svg?async=1".format(polycule.graph_hash)
+        job = self.client.get(url).get_json()
+        checked_out = []
+
+        def sleep(seconds):
+            stats = polycules.get_pool().stats()
+            checked_out.append(stats["open"] - stats["idle"])
+            if len(checked_out) == 3:
+                jobs.work(polycules.app.config["DATABASE"], once=True)
+
+        with mock.patch("time.sleep", side_effect=sleep):
+            status = self.client.get(job["status_url"] + "?wait=5").get_json()
+        self.assertEqual(status["status"], "done")
+        self.assertEqual(checked_out, [0, 0, 0])
+
+    def test_unknown_png_source(self):
+        polycule = self.create(GRAPH)
+        url = "/export/{}/polycule.png?from=bogus".format(polycule.graph_hash)
+        self.assertEqual(self.client.get(url).status_code, 400)
+        self.assertEqual(self.client.get(url + "&async=1").status_code, 400)
+        with polycules.app.app_context():
+            self.assertIsNone(jobs.claim(polycules.get_db()))
+
+    def test_missing(self):
+        self.assertEqual(self.client.get("/export/jobs/nope").status_code, 404)
+        self.assertEqual(self.client.get("/export/jobs/nope/result").status_code, 404)
+
+
+class TestBackup(AppTestCase):
+    def get(self, token):
+        return self.client.get(
+            "/admin/backup?format=tar",
+            headers={"Authorization": "Bearer {}".format(token)},
+        )
+
+    def test_disabled(self):
+        self.assertEqual(self.get("None").status_code, 404)
+
+    def test_backup(self):
+        polycule = self.create(GRAPH)
+        with mock.patch.dict(polycules.app.config, BACKUP_TOKEN="secret"):
+            self.assertEqual(self.get("wrong").status_code, 401)
+            response = self.get("secret")
+        with tarfile.open(fileobj=io.BytesIO(response.data)) as archive:
+            self.assertIn(
+                "{}/graph.json".format(polycule.graph_hash), archive.getnames()
+            )
+
+    def test_hash_prefixes(self):
+        polycule = self.create(GRAPH)
+        headers = {"Authorization": "Bearer secret"}
+        with mock.patch.dict(polycules.app.config, BACKUP_TOKEN="secret"):
+            response = self.client.get(
+                "/admin/backup?format=tar&hash=" + polycule.graph_hash[:7],
+                headers=headers,
+            )
+            missing = self.client.get("/admin/backup?hash=fffffff", headers=headers)
+        directory = polycule.graph_hash
+        with tarfile.open(fileobj=io.BytesIO(response.data)) as archive:
+            self.assertEqual(
+                archive.getnames(),
+                [directory + "/meta.json", directory + "/graph.json"],
+            )
+        self.assertEqual(missing.status_code, 404)
+
+
+class TestConnections(AppTestCase):
+    def test_front_page_needs_no_connection(self):
+        with mock.patch("storage.ConnectionPool.acquire") as acquire:
+            self.client.get("/")
+            self.client.get("/create")
+        acquire.assert_not_called()
+
+    def test_connection_is_returned(self):
+        polycule = self.create()
+        self.client.get("/{}".format(polycule.graph_hash))
+        self.client.get("/{}".format(polycule.graph_hash))
+        stats = polycules.get_pool().stats()
+        self.assertEqual((stats["open"], stats["idle"]), (1, 1))
+
+
+class TestConfigure(AppTestCase):
+    def test_config_changed_after_import(self):
+        config = {"RENDER_WORKERS": 3, "PASSWORD_QUEUE_SIZE": 5, "RENDER_CACHE_SIZE": 7}
+        with mock.patch.dict(polycules.app.config, config):
+            self.client.get("/")
+            self.assertEqual(rendering.pool.workers, 3)
+            self.assertEqual(passwords.pool.queue_size, 5)
+            self.assertEqual(cache.renders.max_bytes, 7)
+            pool = rendering.pool
+            self.client.get("/")
+            self.assertIs(rendering.pool, pool)
+        self.client.get("/")
+        self.assertEqual(rendering.pool.workers, 2)
+
+
+class TestMetrics(AppTestCase):
+    def test_metrics(self):
+        polycule = self.create(view_pass="secret")
+        self.post("/{}".format(polycule.graph_hash), view_pass="secret")
+        text = self.client.get("/metrics").data.decode("utf-8")
+        self.assertIn("# TYPE polycules_request_seconds histogram", text)
+        self.assertIn(
+            'polycules_request_seconds_count{method="POST",route="view_polycule",'
+            'status="200"}',
+            text,
+        )
+        for stage in ("lookup", "bcrypt", "template"):
+            self.assertIn(
+                'polycules_stage_seconds_count{{stage="{}"}}'.format(stage), text
+            )
+        self.assertIn("polycules_db_pool_wait_seconds_count", text)
+        self.assertIn("polycules_render_cache_hit_ratio", text)
+
+    def test_switched_off(self):
+        with mock.patch.dict(polycules.app.config, METRICS=False):
+            self.assertEqual(self.client.get("/metrics").status_code, 404)
+
+    def test_token(self):
+        with mock.patch.dict(polycules.app.config, METRICS_TOKEN="secret"):
+            self.assertEqual(self.client.get("/metrics").status_code, 401)
+            response = self.client.get(
+                "/metrics", headers={"Authorization": "Bearer secret"}
+            )
+        self.assertEqual(response.status_code, 200)
+
+    def test_slow_requests_logged(self):
+        with mock.patch.dict(polycules.app.config, PROFILE_SLOW_REQUESTS=0):
+            with mock.patch.object(polycules.app.logger, "warning") as warning:
+                self.client.get("/")
+        self.assertEqual(warning.call_args[0][1:3], ("GET", "/?"))
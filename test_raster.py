@@ -0,0 +1,162 @@
+import struct
+import time
+import zlib
+from unittest import TestCase, mock, skipUnless
+
+import model
+import raster
+import rendering
+from raster import numpy
+from test_model import GRAPH
+
+
+def read_png(png):
+    """ Return (width, height, rows of RGB tuples) for a PNG from write_png. """
+    assert png.startswith(b"\x89PNG\r\n\x1a\n")
+    position, chunks = 8, {}
+    while position < len(png):
+        (length,) = struct.unpack(">I", png[position:position + 4])
+        kind = png[position + 4:position + 8]
+        data = png[position + 8:position + 8 + length]
+        (crc,) = struct.unpack(">I", png[position + 8 + length:position + 12 + length])
+        assert crc == zlib.crc32(kind + data) & 0xFFFFFFFF
+        chunks[kind] = data
+        position += 12 + length
+    width, height = struct.unpack(">II", chunks[b"IHDR"][:8])
+    data = zlib.decompress(chunks[b"IDAT"])
+    rows = []
+    for y in range(height):
+        row = data[y * (width * 3 + 1):(y + 1) * (width * 3 + 1)]
+        assert row[0] == 0
+        rows.append([tuple(row[1 + x * 3:4 + x * 3]) for x in range(width)])
+    return width, height, rows
+
+
+class TestParse(TestCase):
+    def test_colour(self):
+        self.assertEqual(raster.parse_colour("#55F"), [0x55, 0x55, 0xFF])
+        self.assertEqual(raster.parse_colour("#102030"), [0x10, 0x20, 0x30])
+        self.assertEqual(raster.parse_colour("black"), [0, 0, 0])
+        with self.assertRaises(raster.Unsupported):
+            raster.parse_colour("rgb(1, 2, 3)")
+
+    def test_transform(self):
+        self.assertEqual(raster.parse_transform(""), (1.0, 0.0, 0.0))
+        self.assertEqual(raster.parse_transform("translate(0, 0)"), (1.0, 0.0, 0.0))
+        self.assertEqual(
+            raster.parse_transform("translate(10 20) scale(2)"), (2.0, 10.0, 20.0)
+        )
+        self.assertEqual(
+            raster.parse_transform("scale(2) translate(10,20)"), (2.0, 20.0, 40.0)
+        )
+        for transform in ("rotate(45)", "scale(1, 2)", "translate(a)", "x"):
+            with self.assertRaises(raster.Unsupported):
+                raster.parse_transform(transform)
+
+
+@skipUnless(raster.available(), "needs numpy")
+class TestCanvas(TestCase):
+    def test_png(self):
+        canvas = raster.Canvas(3, 2)
+        canvas.pixels[1, 2] = [255, 0, 0]
+        width, height, rows = read_png(canvas.png())
+        self.assertEqual((width, height), (3, 2))
+        self.assertEqual(rows[0][0], (255, 255, 255))
+        self.assertEqual(rows[1][2], (255, 0, 0))
+
+    def test_circle(self):
+        canvas = raster.Canvas(40, 40)
+        canvas.circle(20, 20, 10.25, [0, 0, 0])
+        self.assertEqual(canvas.pixels[20, 20].tolist(), [0, 0, 0])
+        self.assertEqual(canvas.pixels[20, 35].tolist(), [255, 255, 255])
+        # The edge is antialiased
+        self.assertTrue(0 < canvas.pixels[20, 30, 0] < 255)
+
+    def test_dashed_line(self):
+        canvas = raster.Canvas(100, 10)
+        canvas.line(0, 5, 100, 5, 4, [0, 0, 0], dasharray=[10, 10])
+        row = canvas.pixels[5, :, 0]
+        self.assertEqual(row[5], 0)
+        self.assertEqual(row[15], 255)
+        self.assertEqual(row[25], 0)
+        self.assertEqual(canvas.pixels[0, 5, 0], 255)
+
+    def test_text(self):
+        canvas = raster.Canvas(60, 20)
+        canvas.text(30, 15, "Zoë", [0, 0, 0], anchor="middle")
+        inked = (canvas.pixels[:, :, 0] < 128).nonzero()
+        self.assertEqual(inked[0].max(), 14)
+        self.assertGreaterEqual(inked[1].min(), 30 - 9)
+        self.assertLessEqual(inked[1].max(), 30 + 9)
+
+    def test_diagonal_line(self):
+        canvas = raster.Canvas(40, 30)
+        canvas.line(3, 25, 37, 4, 3, [0, 0, 0], dasharray=[5, 2, 1])
+        # The same coverage, worked out over every pixel of the canvas
+        x = numpy.arange(40) + 0.5
+        y = numpy.arange(30)[:, None] + 0.5
+        length = numpy.hypot(34, 21)
+        dx, dy = 34 / length, -21 / length
+        along = (x - 3) * dx + (y - 25) * dy
+        across = numpy.abs((y - 25) * dx - (x - 3) * dy)
+        coverage = numpy.clip(2 - across, 0, 1)
+        coverage *= numpy.clip(along + 0.5, 0, 1)
+        coverage *= numpy.clip(length - along + 0.5, 0, 1)
+        ends = [5, 7, 8, 13, 15, 16]
+        coverage *= numpy.searchsorted(ends, along % 16, side="right") % 2 == 0
+        numpy.testing.assert_allclose(
+            canvas.pixels[:, :, 0], 255 * (1 - coverage), atol=1e-3
+        )
+
+    def test_huge_text(self):
+        canvas = raster.Canvas(100, 20)
+        start = time.monotonic()
+        canvas.text(0, 10, "Hi", [0, 0, 0], scale=1e5)
+        self.assertLess(time.monotonic() - start, 1)
+        # Only the corner of the first glyph lands on the canvas
+        self.assertEqual(canvas.pixels[0, 0].tolist(), [0, 0, 0])
+        svg = '<svg width="10" height="10"><g transform="scale({})">{}</g></svg>'
+        raster.rasterize(svg.format(1e5, '<text x="0" y="1">Hi</text>'))
+        for scale in ("1e400", "1e200) scale(1e200"):
+            with self.assertRaises(raster.Unsupported):
+                raster.rasterize(svg.format(scale, '<text x="0" y="1">Hi</text>'))
+
+    def test_clipped(self):
+        canvas = raster.Canvas(10, 10)
+        canvas.circle(-50, -50, 5, [0, 0, 0])
+        canvas.text(5, 100, "off the canvas", [0, 0, 0])
+        self.assertTrue((canvas.pixels == 255).all())
+
+
+@skipUnless(raster.available(), "needs numpy")
+class TestRasterize(TestCase):
+    def test_polycule(self):
+        polycule = model.Polycule(graph=GRAPH, graph_hash="a" * 40)
+        pool = rendering.RenderPool()
+        with mock.patch("rendering.run") as run, mock.patch("rendering.pool", pool):
+            png = polycule.as_png_from_svg(edge_labels=True)
+        run.assert_not_called()
+        self.assertEqual(pool.stats()["commands"]["rasterize"]["renders"], 1)
+        width, height, rows = read_png(png)
+        self.assertEqual((width, height), (1000, 540))
+        self.assertEqual(rows[50][100], (0x88, 0x88, 0x88))
+
+    def test_falls_back(self):
+        polycule = model.Polycule(
+            graph=GRAPH.replace("Alice", "Alice & Bob"), graph_hash="a" * 40
+        )
+        with self.assertRaises(raster.Unsupported):
+            raster.rasterize(polycule.as_svg())
+        with mock.patch("rendering.run", return_value=b"png") as run:
+            self.assertEqual(polycule.as_png_from_svg(), b"png")
+        self.assertEqual(run.call_args[0][0], ["convert", "svg:-", "png:-"])
+
+    def test_deadline(self):
+        svg = '<svg width="10" height="10"><circle r="5" /></svg>'
+        with self.assertRaises(TimeoutError):
+            raster.rasterize(svg, deadline=time.monotonic() - 1)
+        self.assertTrue(raster.rasterize(svg, deadline=time.monotonic() + 10))
+
+    def test_unsupported_element(self):
+        with self.assertRaises(raster.Unsupported):
+            raster.rasterize('<svg width="10" height="10"><path d="M0 0" /></svg>')
@@ -0,0 +1,100 @@
+import shutil
+import sys
+import threading
+import time
+from unittest import TestCase, mock, skipUnless
+
+import rendering
+
+
+class TestRenderPool(TestCase):
+    def test_pipes(self):
+        pool = rendering.RenderPool()
+        self.assertEqual(pool.run(["cat"], b"graph {}"), b"graph {}")
+        self.assertEqual(pool.stats()["commands"]["cat"]["renders"], 1)
+
+    def test_failure(self):
+        pool = rendering.RenderPool()
+        with self.assertRaises(rendering.RenderFailed):
+            pool.run(["false"], b"")
+        with self.assertRaises(rendering.RenderFailed):
+            pool.run(["not-a-real-renderer"], b"")
+        self.assertEqual(pool.stats()["commands"]["false"]["failures"], 1)
+
+    def test_timeout(self):
+        pool = rendering.RenderPool(timeout=0.1)
+        with self.assertRaises(rendering.RenderFailed):
+            pool.run(["sleep", "5"], b"")
+        self.assertEqual(pool.stats()["commands"]["sleep"]["timeouts"], 1)
+
+    @skipUnless(shutil.which("prlimit"), "needs prlimit")
+    def test_memory_limit(self):
+        pool = rendering.RenderPool(memory_limit=256 * 1024 * 1024)
+        with self.assertRaises(rendering.RenderFailed):
+            pool.run([sys.executable, "-c", "bytearray(1024 ** 3)"], b"")
+
+    def test_memory_limit_without_preexec_fn(self):
+        with mock.patch("shutil.which", return_value="/usr/bin/prlimit"):
+            pool = rendering.RenderPool(memory_limit=1024)
+        with mock.patch("subprocess.run") as run:
+            run.return_value.returncode = 0
+            pool.run(["neato"], b"")
+        self.assertEqual(
+            run.call_args[0][0], ["/usr/bin/prlimit", "--as=1024", "--", "neato"]
+        )
+        self.assertNotIn("preexec_fn", run.call_args[1])
+        self.assertEqual(list(pool.stats()["commands"]), ["neato"])
+
+    def test_memory_limit_without_prlimit(self):
+        with mock.patch("shutil.which", return_value=None):
+            pool = rendering.RenderPool(memory_limit=256 * 1024 * 1024)
+        self.assertEqual(pool.run(["cat"], b"graph {}"), b"graph {}")
+        with self.assertRaises(rendering.RenderFailed):
+            pool.run([sys.executable, "-c", "bytearray(1024 ** 3)"], b"")
+        self.assertEqual(list(pool.stats()["commands"])[0], "cat")
+
+    def test_memory_limit_unavailable(self):
+        with mock.patch("shutil.which", return_value=None), mock.patch(
+            "rendering.resource", None
+        ), self.assertLogs("rendering", "WARNING"):
+            pool = rendering.RenderPool(memory_limit=1024)
+        self.assertEqual(pool.run(["cat"], b"x"), b"x")
+
+    def test_full_queue(self):
+        pool = rendering.RenderPool(workers=1, queue_size=0)
+        thread = threading.Thread(target=pool.run, args=(["sleep", "0.5"], b""))
+        thread.start()
+        while pool.stats()["running"] == 0:
+            pass
+        with self.assertRaises(rendering.Busy):
+            pool.run(["cat"], b"")
+        thread.join()
+        self.assertEqual(pool.stats()["rejected"], 1)
+
+    def test_call(self):
+        pool = rendering.RenderPool(timeout=5)
+
+        def draw(data, deadline):
+            self.assertGreater(deadline, time.monotonic())
+            return data.upper()
+
+        def stuck(deadline):
+            raise TimeoutError
+
+        self.assertEqual(pool.call("draw", draw, b"png"), b"PNG")
+        with self.assertRaises(rendering.RenderFailed):
+            pool.call("stuck", stuck)
+        stats = pool.stats()["commands"]
+        self.assertEqual(stats["draw"]["renders"], 1)
+        self.assertEqual(stats["stuck"]["timeouts"], 1)
+        self.assertEqual(pool.stats()["running"], 0)
+
+    def test_call_takes_a_slot(self):
+        pool = rendering.RenderPool(workers=1, queue_size=0)
+        thread = threading.Thread(target=pool.run, args=(["sleep", "0.5"], b""))
+        thread.start()
+        while pool.stats()["running"] == 0:
+            pass
+        with self.assertRaises(rendering.Busy):
+            pool.call("draw", lambda deadline: b"")
+        thread.join()
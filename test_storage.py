@@ -0,0 +1,141 @@
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+import storage
+
+
+class TestConnect(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.database = os.path.join(self.tmpdir, "test.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_pragmas(self):
+        db = storage.connect(self.database, busy_timeout=1234)
+        self.assertEqual(db.execute("pragma journal_mode").fetchone()[0], "wal")
+        self.assertEqual(db.execute("pragma busy_timeout").fetchone()[0], 1234)
+        db.close()
+
+
+class TestConnectionPool(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pool = storage.ConnectionPool(
+            os.path.join(self.tmpdir, "test.db"), size=2, timeout=0.1
+        )
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_opens_lazily(self):
+        self.assertEqual(self.pool.stats()["open"], 0)
+        db = self.pool.acquire()
+        self.pool.release(db)
+        self.assertIs(self.pool.acquire(), db)
+        self.assertEqual(self.pool.stats()["open"], 1)
+
+    def test_timeout(self):
+        self.pool.acquire()
+        self.pool.acquire()
+        with self.assertRaises(storage.PoolTimeout):
+            self.pool.acquire()
+        self.assertEqual(self.pool.stats()["timeouts"], 1)
+
+    def test_waits_for_release(self):
+        self.pool.timeout = 5
+        first = self.pool.acquire()
+        self.pool.acquire()
+        threading.Timer(0.05, self.pool.release, [first]).start()
+        self.assertIs(self.pool.acquire(), first)
+        self.assertGreater(self.pool.stats()["wait_seconds_max"], 0)
+
+    def test_release_rolls_back(self):
+        db = self.pool.acquire()
+        db.execute("create table t (id integer)")
+        db.commit()
+        db.execute("insert into t values (1)")
+        self.pool.release(db)
+        self.assertFalse(db.in_transaction)
+        self.assertEqual(db.execute("select count(*) from t").fetchone()[0], 0)
+
+
+class TestWriter(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.database = os.path.join(self.tmpdir, "test.db")
+        db = storage.connect(self.database)
+        db.execute("create table t (id integer primary key)")
+        db.commit()
+        db.close()
+        self.writer = storage.Writer(self.database)
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.tmpdir)
+
+    def count(self):
+        db = storage.connect(self.database, readonly=True)
+        try:
+            return db.execute("select count(*) from t").fetchone()[0]
+        finally:
+            db.close()
+
+    def test_write(self):
+        row_id = self.writer.write(
+            lambda db: db.execute("insert into t values (null)").lastrowid
+        )
+        self.assertEqual(row_id, 1)
+        self.assertEqual(self.count(), 1)
+
+    def test_failed_write_is_isolated(self):
+        self.writer.write(lambda db: db.execute("insert into t values (1)"))
+        with self.assertRaises(Exception):
+            self.writer.write(lambda db: db.execute("insert into t values (1)"))
+        self.writer.write(lambda db: db.execute("insert into t values (2)"))
+        self.assertEqual(self.count(), 2)
+
+    def test_group_commit(self):
+        release = threading.Event()
+        # Hold the writer up so the other writes queue behind this one
+        first = threading.Thread(
+            target=self.writer.write, args=(lambda db: release.wait(),)
+        )
+        first.start()
+        while self.writer.stats()["writes"] == 0 and not self.writer._queue.empty():
+            pass
+        threads = [
+            threading.Thread(
+                target=self.writer.write,
+                args=(lambda db: db.execute("insert into t values (null)"),),
+            )
+            for _ in range(10)
+        ]
+        for thread in threads:
+            thread.start()
+        while self.writer.stats()["queued"] < 10:
+            pass
+        release.set()
+        for thread in [first] + threads:
+            thread.join()
+        self.assertEqual(self.count(), 10)
+        self.assertEqual(self.writer.stats()["writes"], 11)
+        self.assertEqual(self.writer.stats()["commits"], 2)
+
+    def test_readonly(self):
+        db = storage.connect(self.database, readonly=True)
+        with self.assertRaises(Exception):
+            db.execute("insert into t values (null)")
+        db.close()
+
+    def test_database(self):
+        reader = storage.connect(self.database, readonly=True)
+        db = storage.Database(reader, self.writer)
+        storage.write(db, lambda conn: conn.execute("insert into t values (null)"))
+        self.assertEqual(db.execute("select count(*) from t").fetchone()[0], 1)
+        reader.close()
@@ -0,0 +1,55 @@
+import io
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+from unittest import TestCase
+
+import model
+import validate_db
+from test_model import GRAPH, make_db
+
+
+class TestValidateDB(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.database = os.path.join(self.tmpdir, "test.db")
+        db = make_db()
+        for i in range(25):
+            graph = GRAPH if i % 10 else '{"nodes": 1}'
+            if i % 2:
+                graph = model.encode_graph(graph)
+            db.execute(
+                "insert into polycules (graph, hash) values (?, ?)",
+                [graph, "{:040x}".format(i)],
+            )
+        db.commit()
+        db.backup(sqlite3.connect(self.database))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_validate(self, start_id=0):
+        report = io.StringIO()
+        db = sqlite3.connect(self.database)
+        result = validate_db.validate(
+            db,
+            report,
+            start_id=start_id,
+            batch_size=4,
+            workers=2,
+            progress=io.StringIO(),
+        )
+        return result, [json.loads(line) for line in report.getvalue().splitlines()]
+
+    def test_validate(self):
+        (checked, invalid), report = self.run_validate()
+        self.assertEqual((checked, invalid), (25, 3))
+        self.assertEqual([row["id"] for row in report], [1, 11, 21])
+        self.assertEqual(report[0]["hash"], "0" * 40)
+
+    def test_resume(self):
+        (checked, invalid), report = self.run_validate(start_id=11)
+        self.assertEqual((checked, invalid), (14, 1))
+        self.assertEqual(report[0]["id"], 21)
@@ -1,7 +1,12 @@
 from unittest import TestCase
 from jsonschema import validate
+from jsonschema.exceptions import best_match
+import copy
 import json
 
+import validation
+from benchmarks.graphs import make_graph
+
 
 def validatejson(body):
     with open('schema.json') as json_data:
@@ -204,3 +209,92 @@ class TestLinkFullParamaters(TestCase):
 }
             '''
         ))
+
+
+class TestParse(TestCase):
+    def test_valid(self):
+        self.assertEqual(validation.parse('{"nodes": []}'), {"nodes": []})
+
+    def test_not_json(self):
+        with self.assertRaises(validation.InvalidGraph):
+            validation.parse('{"nodes": [')
+        with self.assertRaises(validation.InvalidGraph):
+            validation.parse(None)
+
+    def test_invalid(self):
+        with self.assertRaises(validation.InvalidGraph):
+            validation.parse('{"nodes": [{"id": 1, "watcher": "Eve"}]}')
+
+
+class TestCheckChange(TestCase):
+    def setUp(self):
+        self.graph = {"nodes": [{"id": 1}, {"id": 2, "watcher": "Eve"}], "links": []}
+
+    def test_changed_item_only(self):
+        self.graph["nodes"][0]["name"] = "Alice"
+        validation.check_change(self.graph, ["nodes", "0", "name"])
+        with self.assertRaises(validation.InvalidGraph):
+            validation.check_change(self.graph, ["nodes", "1"])
+
+    def test_appended(self):
+        self.graph["links"].append({"strength": []})
+        with self.assertRaises(validation.InvalidGraph):
+            validation.check_change(self.graph, ["links", "-"])
+
+    def test_removed(self):
+        validation.check_change(self.graph, ["links", "0"])
+
+    def test_other_changes_check_everything(self):
+        with self.assertRaises(validation.InvalidGraph):
+            validation.check_change(self.graph, ["lastId"])
+
+
+class TestCompiled(TestCase):
+    VALUES = [0, 1.0, 1.5, -2, True, None, "4", [], [1, "a"], {}, {"a": 1}]
+
+    def test_agrees_with_jsonschema(self):
+        graph = json.loads(make_graph(3, labels=1, dashed=1))
+        graph["scale"], graph["translate"] = 1.5, [1, 2]
+        instances = [graph, [], "graph", None]
+        for parents in (
+            [graph],
+            graph["nodes"][:1],
+            graph["links"][:1],
+            [graph["links"][0]["source"]],
+        ):
+            for parent in parents:
+                for name in list(parent) + ["watcher"]:
+                    for value in self.VALUES:
+                        changed = copy.deepcopy(graph)
+                        target = self.find(changed, graph, parent)
+                        target[name] = value
+                        instances.append(changed)
+        for instance in instances:
+            self.assertEqual(
+                validation.is_valid(instance),
+                validation.validator.is_valid(instance),
+                instance,
+            )
+
+    def find(self, changed, graph, parent):
+        # The copy of `parent` within `changed`
+        if parent is graph:
+            return changed
+        for section in ("nodes", "links"):
+            for i, item in enumerate(graph[section]):
+                if item is parent:
+                    return changed[section][i]
+                if section == "links" and item["source"] is parent:
+                    return changed[section][i]["source"]
+
+    def test_same_message(self):
+        graph = json.loads(make_graph(50))
+        graph["links"][40]["target"]["r"] = 1.5
+        error = best_match(validation.validator.iter_errors(graph))
+        with self.assertRaises(validation.InvalidGraph) as raised:
+            validation.parse(json.dumps(graph))
+        self.assertEqual(str(raised.exception), error.message)
+
+    def test_unknown_keyword(self):
+        with self.assertRaises(ValueError):
+            validation.compile_schema({"type": "string", "maxLength": 3}, {})
@@ -1,23 +1,108 @@
 # Validate every row in the database to make sure the graph is valid JSON
+#
+# Rows are read in batches by id, each batch in its own short query, so the
+# tool never holds a long read transaction on a live database and can resume
+# from the last id it reported. Batches are validated across a process pool;
+# invalid rows are written as JSON lines to the report, progress to stderr.
+#
+#     python validate_db.py --database db/prod.db --report invalid.jsonl
 
-from jsonschema import validate
+import argparse
+import collections
 import json
+import multiprocessing
 import sqlite3
+import sys
+import time
+
+import model
+import validation
 
 
 DATABASE = 'prod.db'
 
 
-def validatejson(body):
-    with open('schema.json') as json_data:
-        schema = json.load(json_data)
-    return validate(json.loads(body), schema)
+def batches(db, start_id, batch_size):
+    last_id = start_id
+    while True:
+        rows = db.execute(
+            'SELECT id, graph, hash FROM polycules WHERE id > ? '
+            'ORDER BY id LIMIT ?', [last_id, batch_size]).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield rows
+
+
+def validate_batch(rows):
+    invalid = []
+    for id, graph, graph_hash in rows:
+        try:
+            validation.parse(model.decode_graph(graph))
+        except validation.InvalidGraph as e:
+            invalid.append({'id': id, 'hash': graph_hash, 'error': str(e)})
+    return rows[-1][0], len(rows), invalid
+
 
+def validate(db, report, start_id=0, batch_size=500, workers=None,
+             progress=sys.stderr):
+    """ Validate rows after `start_id`, returning (rows checked, invalid). """
+    checked = invalid = 0
+    start = time.monotonic()
+    with multiprocessing.Pool(workers) as pool:
+        # Only keep a couple of batches per worker in flight, so memory stays
+        # flat however large the table is.
+        pending = collections.deque()
+        limit = 2 * (workers or multiprocessing.cpu_count())
+        rows = batches(db, start_id, batch_size)
+        while True:
+            for batch in rows:
+                pending.append(pool.apply_async(validate_batch, [batch]))
+                if len(pending) >= limit:
+                    break
+            if not pending:
+                break
+            last_id, count, errors = pending.popleft().get()
+            for error in errors:
+                report.write(json.dumps(error) + '\n')
+            report.flush()
+            checked += count
+            invalid += len(errors)
+            elapsed = time.monotonic() - start
+            progress.write(
+                '{} rows checked, {} invalid, {:.0f} rows/s, '
+                'resume with --start-id {}\n'.format(
+                    checked, invalid, checked / elapsed if elapsed else 0,
+                    last_id))
+    return checked, invalid
 
-db = sqlite3.connect(DATABASE)
-for row in db.execute('SELECT graph, hash FROM polycules'):
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Validate every polycule graph in the database.')
+    parser.add_argument('--database', default=DATABASE)
+    parser.add_argument('--report', default='-',
+                        help='file for invalid rows as JSON lines')
+    parser.add_argument('--start-id', type=int, default=0,
+                        help='only check rows with a larger id')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    db = sqlite3.connect('file:{}?mode=ro'.format(args.database), uri=True)
+    report = sys.stdout if args.report == '-' else open(args.report, 'a')
     try:
-        print(row[1], validatejson(row[0]))
-    except Exception as e:
-        print(row[1])
-        print(e)
+        checked, invalid = validate(
+            db, report, start_id=args.start_id, batch_size=args.batch_size,
+            workers=args.workers)
+    finally:
+        db.close()
+        if report is not sys.stdout:
+            report.close()
+    sys.stderr.write('Done: {} rows checked, {} invalid\n'.format(
+        checked, invalid))
+    return 1 if invalid else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
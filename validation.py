@@ -0,0 +1,197 @@
+import json
+import numbers
+import os
+
+from jsonschema import Draft7Validator
+from jsonschema.exceptions import best_match
+
+import metrics
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.json")
+
+with open(SCHEMA_PATH) as json_data:
+    SCHEMA = json.load(json_data)
+
+# schema.json names a metaschema jsonschema doesn't know, for which it falls
+# back to its latest draft; pin the draft and build the validator only once.
+Draft7Validator.check_schema(SCHEMA)
+validator = Draft7Validator(SCHEMA)
+
+# Validators for a single node or link, so a patched graph can be checked
+# one changed item at a time. The definitions come along for "$ref"s.
+item_validators = {
+    section: Draft7Validator(
+        dict(SCHEMA["properties"][section]["items"], definitions=SCHEMA["definitions"])
+    )
+    for section in ("nodes", "links")
+}
+
+
+# How Draft7Validator tells JSON types apart, and the types json.loads gives
+# that are sure to pass
+TYPES = {
+    "object": (lambda value: isinstance(value, dict), {dict}),
+    "array": (lambda value: isinstance(value, list), {list}),
+    "string": (lambda value: isinstance(value, str), {str}),
+    "boolean": (lambda value: isinstance(value, bool), {bool}),
+    "null": (lambda value: value is None, {type(None)}),
+    "number": (
+        lambda value: isinstance(value, numbers.Number)
+        and not isinstance(value, bool),
+        {int, float},
+    ),
+    "integer": (
+        lambda value: isinstance(value, int)
+        and not isinstance(value, bool)
+        or isinstance(value, float)
+        and value.is_integer(),
+        {int},
+    ),
+}
+# Keywords that do not affect whether an instance is valid
+IGNORED = {"$schema", "definitions", "description", "optional", "title"}
+COMPILED = {"$ref", "type", "properties", "additionalProperties", "items"}
+
+
+def compile_schema(schema, definitions):
+    """ Build a function telling whether an instance matches `schema`.
+
+    It gives the same answers as Draft7Validator, many times faster, but
+    understands only the keywords schema.json uses: type, properties,
+    additionalProperties, items and local "$ref"s.
+    """
+    unknown = set(schema) - IGNORED - COMPILED
+    if unknown or not isinstance(schema.get("additionalProperties", True), bool):
+        raise ValueError("Schema keywords not compiled: {}".format(sorted(unknown)))
+    if "$ref" in schema:
+        # A "$ref" replaces the rest of its schema in draft 7
+        name = schema["$ref"].replace("#/definitions/", "", 1)
+        return compile_schema(definitions[name], definitions)
+    checks = []
+    if "type" in schema:
+        checks.append(_compile_type(schema["type"]))
+    if "properties" in schema or "additionalProperties" in schema:
+        checks.append(_compile_properties(schema, definitions))
+    if "items" in schema:
+        check_item = compile_schema(schema["items"], definitions)
+        checks.append(
+            lambda value: not isinstance(value, list) or all(map(check_item, value))
+        )
+    if len(checks) == 1:
+        return checks[0]
+    return lambda value: all(check(value) for check in checks)
+
+
+def _compile_type(names):
+    names = _names(names)
+    exact = set().union(*(TYPES[name][1] for name in names))
+    is_types = [TYPES[name][0] for name in names]
+    return lambda value: type(value) in exact or any(
+        is_type(value) for is_type in is_types
+    )
+
+
+def _compile_properties(schema, definitions):
+    properties = {
+        name: compile_schema(subschema, definitions)
+        for name, subschema in schema.get("properties", {}).items()
+    }
+    # Properties only constrained by type are checked inline, as most are
+    exact = {
+        name: set().union(*(TYPES[t][1] for t in _names(subschema["type"])))
+        for name, subschema in schema.get("properties", {}).items()
+        if set(subschema) - IGNORED == {"type"}
+    }
+    additional = schema.get("additionalProperties", True)
+
+    def check_properties(value):
+        if not isinstance(value, dict):
+            return True
+        for name, item in value.items():
+            if type(item) in exact.get(name, ()):
+                continue
+            check = properties.get(name)
+            if check is None:
+                if not additional:
+                    return False
+            elif not check(item):
+                return False
+        return True
+
+    return check_properties
+
+
+def _names(names):
+    return [names] if isinstance(names, str) else names
+
+
+is_valid = compile_schema(SCHEMA, SCHEMA["definitions"])
+item_checks = {
+    section: compile_schema(validator.schema, SCHEMA["definitions"])
+    for section, validator in item_validators.items()
+}
+
+
+class InvalidGraph(Exception):
+    pass
+
+
+def _check(validator, instance):
+    error = best_match(validator.iter_errors(instance))
+    if error is not None:
+        raise InvalidGraph(error.message)
+
+
+def _check_graph(parsed):
+    # Valid graphs only go through the compiled checks. For an invalid one,
+    # jsonschema explains the first bad item, or the graph without its items,
+    # rather than walking every item of a large graph.
+    if is_valid(parsed):
+        return
+    if isinstance(parsed, dict):
+        parsed = dict(parsed)
+        for section, check in item_checks.items():
+            if isinstance(parsed.get(section), list):
+                for item in parsed[section]:
+                    if not check(item):
+                        _check(item_validators[section], item)
+                parsed[section] = []
+    _check(validator, parsed)
+
+
+def parse(graph):
+    """ Parse and validate a submitted graph, returning the parsed JSON. """
+    try:
+        with metrics.stage("json"):
+            parsed = json.loads(graph)
+    except (TypeError, ValueError) as e:
+        raise InvalidGraph("Not valid JSON: {}".format(e))
+    with metrics.stage("validate"):
+        _check_graph(parsed)
+    return parsed
+
+
+def check_change(parsed, path):
+    """ Validate a graph after a change at `path`, a list of pointer tokens.
+
+    A change inside one node or link only needs that item checked against
+    its schema; any other change checks the whole graph.
+    """
+    if (
+        len(path) < 2
+        or not isinstance(parsed, dict)
+        or path[0] not in item_validators
+        or not isinstance(parsed.get(path[0]), list)
+    ):
+        _check_graph(parsed)
+        return
+    items = parsed[path[0]]
+    if path[1] == "-":
+        index = len(items) - 1
+    elif path[1].isdigit():
+        index = int(path[1])
+    else:
+        index = len(items)
+    # A removed item leaves nothing to check at its index
+    if index < len(items) and not item_checks[path[0]](items[index]):
+        _check(item_validators[path[0]], items[index])